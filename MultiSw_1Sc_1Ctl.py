@@ -7,6 +7,10 @@ from twisted.internet import reactor
 import struct
 import logging
 import random
+
+from openflow_framer import OpenFlowFramer, TunnelFramer
+from packet_in_scheduler import PacketInScheduler, PacketIn, LeastOutstandingPolicy
+
 logging.basicConfig(level=logging.INFO)
 
 '''
@@ -37,8 +41,7 @@ The controller is associated with the transaction ID of the packet
 class OpenFlowProxyServerProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = OpenFlowFramer()
 
     def connectionMade(self):
         self.factory.add_switchConnection(self)
@@ -50,25 +53,10 @@ class OpenFlowProxyServerProtocol(Protocol):
         logging.info("Losing a switch connection!")
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.debug("Receiving new data from switch %d, buffer data %d"%(len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 8:
-                    # logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">bbHI", self.data_buffer[:8])
-                # logging.debug("Switch Msg Version:%d Type:%d Length:%d ID:%d" % parsed_header)
-                self.pending_bytes = parsed_header[2]
-
-            if self.pending_bytes > available_bytes:
-                # logging.debug("Waiting switch entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_switch_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        msgs = self.framer.feed(data)
+        # logging.debug("Receiving new data from switch %d, %d msgs, buffer data %d"%(len(data), len(msgs), self.framer.pending_bytes()))
+        if msgs:
+            self.factory.handle_switch_openflow_batch(msgs, self)
 
 
 '''################## Handle connections between scheduler and ONOS tunnels ##########################'''
@@ -77,28 +65,13 @@ class OpenFlowProxyServerProtocol(Protocol):
 class OpenFlowClientProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = TunnelFramer()
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.debug("Receiving new data from controller %d, buffer data %d"%(len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 10:
-                    # logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">QH", self.data_buffer[:10])
-                #logging.debug("Tunnel Msg DPID:%d length:%d" % parsed_header)
-                self.pending_bytes = parsed_header[1]+10
-            if self.pending_bytes > available_bytes:
-                # logging.debug("Waiting controller entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_tunnel_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        frames = self.framer.feed(data)
+        # logging.debug("Receiving new data from controller %d, %d msgs, buffer data %d"%(len(data), len(frames), self.framer.pending_bytes()))
+        if frames:
+            self.factory.handle_tunnel_openflow_batch(frames, self)
 
     def connectionMade(self):
         logging.info("Connecting to a tunnel!")
@@ -130,7 +103,7 @@ class OpenFlowService():
     dpid2sw_dict = {}     # dpid2sw_dict = { Datapath ID: switch_connection }
     sw2dpid_dict = {}     # sw2dpid_dict = { switch_connection: Datapath ID }
     xid2tun = {}          # xid2tun = { transaction ID: tunnel }
-    rr = 0                # round-robin factor
+    packet_in_scheduler = PacketInScheduler([LeastOutstandingPolicy()], "least_outstanding")
     SWITCH_REPLY_TYPES = [3, 8, 19, 21, 25, 27]  # messages from switches to tunnel
     TUNNEL_IGNORE_TYPES = [13, 14, 15, 16, 17, 28, 29] # messages from tunnel, no reply from switch is required
 
@@ -159,8 +132,10 @@ class OpenFlowService():
 
     def add_tunnelConnection(self, conn):
         self.tunnels.append(conn)
+        self.packet_in_scheduler.on_connect(conn)
 
     def remove_tunnelConnection(self, conn):
+        self.packet_in_scheduler.on_disconnect(conn)
         self.tunnels.remove(conn)
         if len(self.tunnels) == 0:
             logging.info("No available tunnel anymore")
@@ -185,16 +160,19 @@ class OpenFlowService():
         switch_conn.transport.write(msg)
         logging.debug("Writing a msg to switch")
 
-    def scheduling(self):
-        tunnel_num = len(self.tunnels)
-        self.rr = (self.rr+1)%len(self.tunnels)
-        logging.info("Packet_in msg: switch==>tunnel%d" % self.rr)
-        return self.tunnels[self.rr]
+    # packet_ins go to the tunnel with the fewest unanswered packet_ins, round-robin on ties
+    def scheduling(self, dpid, packet_in):
+        tunnel = self.packet_in_scheduler.select(dpid, packet_in, self.tunnels)
+        self.packet_in_scheduler.on_request(dpid, packet_in, tunnel)
+        logging.debug("Packet_in msg: switch==>tunnel%d" % self.tunnels.index(tunnel))
+        return tunnel
+
+    # a batch holds every complete (dpid, msg) frame of one read from the tunnel
+    def handle_tunnel_openflow_batch(self, frames, conn):
+        for dpid, msg in frames:
+            self.handle_tunnel_openflow_msg(dpid, msg, conn)
 
-    def handle_tunnel_openflow_msg(self, msg, conn):
-        header = struct.unpack(">QH", msg[:10])
-        dpid = header[0]
-        msg = msg[10:]
+    def handle_tunnel_openflow_msg(self, dpid, msg, conn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
         type = openflow_header[1]
         xid = openflow_header[3]
@@ -205,6 +183,8 @@ class OpenFlowService():
             exit(1)
         swi = self.dpid2sw_dict[dpid]
         self.write_switch(str(msg), swi)
+        if type == 13 or type == 14:    # PACKET_OUT/FLOW_MOD answers a packet_in scheduled to this tunnel
+            self.packet_in_scheduler.on_response(dpid, type, msg, conn)
         if type not in self.TUNNEL_IGNORE_TYPES:  # write down the xid for the message because reply from switch is needed
             if dpid not in self.xid2tun:
                 self.xid2tun[dpid] = {}
@@ -213,6 +193,11 @@ class OpenFlowService():
         # else:
         #     logging.debug("No need to save")
 
+    # a batch holds every complete message of one read from the switch
+    def handle_switch_openflow_batch(self, msgs, conn):
+        for msg in msgs:
+            self.handle_switch_openflow_msg(msg, conn)
+
     def handle_switch_openflow_msg(self, msg, conn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
         type = openflow_header[1]
@@ -270,8 +255,8 @@ class OpenFlowService():
 
         elif type == 10:  # Packet_in(10) message should be sent to the tunnel according to the scheduling algorithm
             logging.debug("Switch sends packet_in to scheduler")
-            tunnel = self.scheduling()
             dpid = self.sw2dpid_dict[conn]
+            tunnel = self.scheduling(dpid, PacketIn(msg, xid))
             self.write_tunnel(dpid, str(msg), tunnel)
 
         else:
@@ -290,7 +275,7 @@ class OpenFlowService():
     def getOpenFlowServerFactory(self):
         f = ServerFactory()
         f.protocol = OpenFlowProxyServerProtocol
-        f.handle_switch_openflow_msg = self.handle_switch_openflow_msg
+        f.handle_switch_openflow_batch = self.handle_switch_openflow_batch
         f.add_switchConnection = self.add_switchConnection
         f.remove_switchConnection = self.remove_switchConnection
         return f
@@ -299,7 +284,7 @@ class OpenFlowService():
         f = ClientFactory()
         f.protocol = OpenFlowClientProtocol
         f.add_tunnelConnection = self.add_tunnelConnection
-        f.handle_tunnel_openflow_msg = self.handle_tunnel_openflow_msg
+        f.handle_tunnel_openflow_batch = self.handle_tunnel_openflow_batch
         f.remove_tunnelConnection = self.remove_tunnelConnection
         return f
 
@@ -340,6 +325,8 @@ import struct
 import logging
 import random
 
+from openflow_framer import OpenFlowFramer, TunnelFramer
+
 logging.basicConfig(level=logging.DEBUG)
 
 
@@ -347,8 +334,7 @@ logging.basicConfig(level=logging.DEBUG)
 class OpenFlowTunnelProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = TunnelFramer()
 
     def connectionMade(self):
         self.factory.add_tunnelConnection(self)
@@ -360,56 +346,23 @@ class OpenFlowTunnelProtocol(Protocol):
         logging.info("Losing a tunnel connection")
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.debug("Receiving new data from switch %d, buffer data %d" % (len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 10:
-                    # logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">QH", self.data_buffer[:10])
-                #logging.debug("DPID:%s length:%s" % parsed_header)
-                self.pending_bytes = parsed_header[1] + 10
-
-            if self.pending_bytes > available_bytes:
-                # logging.debug("Waiting switch entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.forward_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        frames = self.framer.feed(data)
+        # logging.debug("Receiving new data from tunnel %d, %d msgs, buffer data %d" % (len(data), len(frames), self.framer.pending_bytes()))
+        if frames:
+            self.factory.forward_openflow_batch(frames, self)
 
 
 # Handle Connections between Tunnels and Controllers
 class OpenFlowClientProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-
-        self.data_buffer = bytearray()
+        self.framer = OpenFlowFramer()
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.d
-        # ebug("Receiving new data from controller %d, buffer data %d"%(len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 8:
-                    #logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">bbHI", self.data_buffer[:8])
-                #logging.debug("Controller Msg Version:%d Type:%d Length:%d ID:%d" % parsed_header)
-                self.pending_bytes = parsed_header[2]
-
-            if self.pending_bytes > available_bytes:
-                #logging.debug("Waiting controller entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_controller_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        msgs = self.framer.feed(data)
+        # logging.debug("Receiving new data from controller %d, %d msgs, buffer data %d"%(len(data), len(msgs), self.framer.pending_bytes()))
+        if msgs:
+            self.factory.handle_controller_openflow_batch(msgs, self)
 
     def connectionMade(self):
         logging.info("Connecting to a controller!")
@@ -457,6 +410,11 @@ class OpenFlowService():
         else:
             print "Unable to remove dpid non-exist"
 
+    # a batch holds every complete message of one read from the controller
+    def handle_controller_openflow_batch(self, msgs, conn):
+        for msg in msgs:
+            self.handle_controller_openflow_msg(msg, conn)
+
     def handle_controller_openflow_msg(self, msg, conn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
         # logging.debug("Controller Msg Version:%d Type:%d Length:%d ID:%d" % openflow_header)
@@ -477,11 +435,15 @@ class OpenFlowService():
         else:
             logging.error("Unexpected Error for handling controller msg: no dpid")
 
-    def forward_openflow_msg(self, msg, conn):
+    # a batch holds every complete (dpid, msg) frame of one read from the tunnel
+    def forward_openflow_batch(self, frames, conn):
+        for dpid, msg in frames:
+            self.forward_openflow_msg(dpid, msg, conn)
+
+    def forward_openflow_msg(self, dpid, msg, conn):
         #print "Len %d"%(len(msg))
-        openflow_header = struct.unpack(">QHbbHI", msg[:18])
-        dpid = openflow_header[0]
-        type = openflow_header[3]
+        openflow_header = struct.unpack(">bbHI", msg[:8])
+        type = openflow_header[1]
         # logging.debug("Tunnel Msg Version: Type:%d DPID:%d" % (type, dpid))
         if dpid not in self.dpid_controller:
             if type == 0:
@@ -489,16 +451,16 @@ class OpenFlowService():
                 logging.debug("Established a connection to controller")
                 reactor.connectTCP("localhost", 6633, clientF)
             else:
-                logging.error("Protocol error!!!!! Type:%s dpid:%s xid:%d"%(type,dpid,openflow_header[5]))
+                logging.error("Protocol error!!!!! Type:%s dpid:%s xid:%d"%(type,dpid,openflow_header[3]))
         elif dpid in self.dpid_controller:
             logging.debug("Tunnel===>Controller, type:%s, dpid:%d"%( type, dpid))
-            self.dpid_controller[dpid].transport.write(str(msg[10:]))
+            self.dpid_controller[dpid].transport.write(msg)
 
 
     def getOpenFlowServerFactory(self):
         f = ServerFactory()
         f.protocol = OpenFlowTunnelProtocol
-        f.forward_openflow_msg = self.forward_openflow_msg
+        f.forward_openflow_batch = self.forward_openflow_batch
         f.add_tunnelConnection = self.add_tunnelConnection
         f.remove_tunnelConnection = self.remove_tunnelConnection
         return f
@@ -508,7 +470,7 @@ class OpenFlowService():
         f.protocol = OpenFlowClientProtocol
         f.dpid = dpid
         f.add_controllerConnection = self.add_controllerConnection
-        f.handle_controller_openflow_msg = self.handle_controller_openflow_msg
+        f.handle_controller_openflow_batch = self.handle_controller_openflow_batch
         f.remove_controllerConnection = self.remove_controllerConnection
         return f
 
@@ -0,0 +1,159 @@
+from collections import OrderedDict, deque
+import logging
+
+from twisted.internet import reactor
+
+'''
+Token bucket admission control for packet_ins
+
+Every switch gets its own bucket and all switches share a global one, a packet_in is
+admitted only when both have a token. A host flooding one switch with new flows empties
+that switch's bucket and no more, the global bucket keeps the controllers under their
+saturation point when many switches are busy at once.
+
+A packet_in over the limit is dropped (the switch still holds the buffered packet and
+the next packet of the flow raises a new packet_in) or, with overload="defer", queued
+per switch and forwarded once tokens are back, round-robin among the waiting switches.
+A rate of None means no limit.
+'''
+
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate            # tokens per second
+        self.burst = burst          # bucket size
+        self.tokens = float(burst)
+        self.last = now
+
+    def refill(self, now):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    # seconds until the bucket holds a whole token
+    def wait_time(self):
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class PacketInAdmission(object):
+    min_drain_delay = 0.001     # a refill rounded just under a whole token must not spin the reactor
+
+    def __init__(self, rate, burst, global_rate=None, global_burst=None, overload="drop",
+                 max_deferred=1024, clock=None):
+        if overload not in ("drop", "defer"):
+            raise ValueError("Unknown overload policy %s" % overload)
+        self.rate = rate
+        self.burst = burst
+        self.overload = overload
+        self.max_deferred = max_deferred    # deferred packet_ins kept per switch, the rest are dropped
+        self.clock = clock or reactor
+        self.buckets = {}                   # buckets = { switch: TokenBucket }
+        self.global_bucket = None
+        if global_rate is not None:
+            self.global_bucket = TokenBucket(global_rate, global_burst or global_rate, self.clock.seconds())
+        self.deferred = OrderedDict()       # deferred = { switch: deque of (forward, args) }
+        self.drain_call = None
+        # counters
+        self.admitted = 0
+        self.dropped = 0
+        self.deferred_total = 0
+        self.dropped_per_switch = {}
+
+    def bucket(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None and self.rate is not None:
+            bucket = self.buckets[key] = TokenBucket(self.rate, self.burst, now)
+        return bucket
+
+    # take a token from the switch's bucket and the global one, only if both have one
+    def take(self, key, now):
+        bucket = self.bucket(key, now)
+        if bucket is not None:
+            bucket.refill(now)
+            if bucket.tokens < 1:
+                return False
+        if self.global_bucket is not None:
+            self.global_bucket.refill(now)
+            if self.global_bucket.tokens < 1:
+                return False
+            self.global_bucket.tokens -= 1
+        if bucket is not None:
+            bucket.tokens -= 1
+        return True
+
+    # forward(*args) now if the switch is under its limit, otherwise drop or defer the packet_in
+    def admit(self, key, forward, *args):
+        queue = self.deferred.get(key)
+        if queue is None and self.take(key, self.clock.seconds()):    # deferred packet_ins keep their order
+            self.admitted += 1
+            forward(*args)
+            return True
+        if self.overload == "drop" or (queue is not None and len(queue) >= self.max_deferred):
+            self.drop(key)
+            return False
+        if queue is None:
+            queue = self.deferred[key] = deque()
+        queue.append((forward, args))
+        self.deferred_total += 1
+        self.schedule_drain()
+        return False
+
+    def drop(self, key):
+        self.dropped += 1
+        self.dropped_per_switch[key] = self.dropped_per_switch.get(key, 0) + 1
+        logging.debug("Packet_in over the limit dropped, switch %s" % (key,))
+
+    def schedule_drain(self):
+        if self.drain_call is not None or not self.deferred:
+            return
+        now = self.clock.seconds()
+        wait = None
+        for key in self.deferred:
+            bucket = self.bucket(key, now)
+            if bucket is None:
+                wait = 0
+                break
+            bucket.refill(now)
+            if wait is None or bucket.wait_time() < wait:
+                wait = bucket.wait_time()
+        if self.global_bucket is not None:
+            self.global_bucket.refill(now)
+            wait = max(wait, self.global_bucket.wait_time())
+        self.drain_call = self.clock.callLater(max(wait, self.min_drain_delay), self.drain)
+
+    # forward deferred packet_ins one switch at a time while there are tokens
+    def drain(self):
+        self.drain_call = None
+        now = self.clock.seconds()
+        progress = True
+        while self.deferred and progress:
+            progress = False
+            for key in list(self.deferred):
+                if not self.take(key, now):
+                    continue
+                progress = True
+                queue = self.deferred[key]
+                forward, args = queue.popleft()
+                if not queue:
+                    del self.deferred[key]
+                self.admitted += 1
+                forward(*args)
+        self.schedule_drain()
+
+    # the switch is gone, so are its deferred packet_ins
+    def forget(self, key):
+        self.buckets.pop(key, None)
+        self.dropped_per_switch.pop(key, None)
+        queue = self.deferred.pop(key, None)
+        if queue:
+            self.dropped += len(queue)
+        if not self.deferred and self.drain_call is not None:
+            self.drain_call.cancel()
+            self.drain_call = None
+
+    def metrics(self):
+        return {"admitted": self.admitted, "dropped": self.dropped, "deferred": self.deferred_total,
+                "waiting": sum(len(queue) for queue in self.deferred.values())}
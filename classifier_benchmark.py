@@ -0,0 +1,54 @@
+import struct
+import sys
+import timeit
+
+from packet_classifier import classify_packet_in, packet_in_data_offset
+
+'''
+Benchmark of packet_classifier against scapy on packet_ins like the ones client.py
+raises: UDP over IPv4, with and without a VLAN tag
+
+    python classifier_benchmark.py [number of packet_ins]
+'''
+
+
+def packet_in(sport, vlan=False):
+    ip = struct.pack(">BBHHHBBH4s4s", 0x45, 0, 28, 0, 0, 64, 17, 0, b'\x0a\x00\x00\x02', b'\x0a\x00\x00\x01')
+    udp = struct.pack(">HHHH", sport, 8080, 8, 0)
+    eth = b'\x00\x00\x00\x00\x00\x01' + b'\x00\x00\x00\x00\x00\x02'
+    if vlan:
+        eth += struct.pack(">HH", 0x8100, 5)
+    data = eth + struct.pack(">H", 0x0800) + ip + udp
+    match = struct.pack(">HHII", 1, 12, 0x80000004, 1) + b'\x00' * 4
+    body = struct.pack(">IHBBQ", 0xffffffff, len(data), 0, 0, 0) + match + b'\x00\x00' + data
+    return struct.pack(">bbHI", 4, 10, 8 + len(body), 1) + body
+
+
+def scapy_classify(msg):
+    pkt = Ether(msg[packet_in_data_offset(msg):])
+    if UDP in pkt:
+        return pkt.type, pkt[IP].src, pkt[IP].dst, pkt[IP].proto, pkt[UDP].sport, pkt[UDP].dport
+    return pkt.type, None, None, None, None, None
+
+
+number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+msgs = [packet_in(30000 + i % 1000, vlan=i % 2 == 1) for i in range(1000)]
+rounds = max(1, number // len(msgs))
+
+seconds = timeit.timeit(lambda: [classify_packet_in(msg) for msg in msgs], number=rounds)
+print("packet_classifier: %.2f us per packet_in" % (seconds / (rounds * len(msgs)) * 1e6))
+
+try:
+    from scapy.layers.l2 import Ether
+    from scapy.layers.inet import IP, UDP
+except ImportError:
+    print("scapy: not installed")
+    sys.exit(0)
+
+for msg in msgs:    # both must agree before their speeds are compared
+    fields = classify_packet_in(msg)
+    expected = scapy_classify(msg)
+    assert fields.l4_src == expected[4] and fields.l4_dst == expected[5], (fields, expected)
+scapy_rounds = max(1, rounds // 100)
+seconds = timeit.timeit(lambda: [scapy_classify(msg) for msg in msgs], number=scapy_rounds)
+print("scapy: %.2f us per packet_in" % (seconds / (scapy_rounds * len(msgs)) * 1e6))
@@ -0,0 +1,131 @@
+'''
+Registry of the switch, tunnel and controller connections of a scheduler or proxy
+
+Every connection gets a record with a small integer id. The indexes between datapath IDs,
+switches, tunnels and controllers are dicts, so every lookup is O(1) whatever the number
+of switches. The connections of one kind, and the controllers of one switch, are also
+kept in a list for iteration and for the scheduling policies' candidates; a removal moves
+the last connection of the list into the freed position, so it is O(1) as well (the order
+of the list is not kept).
+'''
+
+SWITCH = 0
+TUNNEL = 1
+CONTROLLER = 2
+
+
+class ConnectionRecord(object):
+    __slots__ = ("id", "conn", "kind", "pool", "index", "dpid", "switch", "controllers")
+
+    def __init__(self, id, conn, kind, pool):
+        self.id = id
+        self.conn = conn
+        self.kind = kind
+        self.pool = pool            # the list holding the connection
+        self.index = len(pool)      # and its position there
+        self.dpid = None
+        self.switch = None          # the switch connection a controller serves
+        self.controllers = None     # controllers = [ controller connections ] of a switch
+
+
+class ConnectionRegistry(object):
+
+    def __init__(self):
+        self.next_id = 1
+        self.records = {}           # records = { connection: ConnectionRecord }
+        self.by_id = {}             # by_id = { id: ConnectionRecord }
+        self.dpids = {}             # dpids = { Datapath ID: switch connection, or controller connection in the proxy }
+        self.masters = {}           # masters = { switch connection: master controller connection }
+        self.switches = []
+        self.tunnels = []
+        self.controllers = []       # controllers not attached to a switch connection
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, conn):
+        return conn in self.records
+
+    def add(self, conn, kind, pool):
+        record = self.records.get(conn)
+        if record is not None:
+            return record
+        record = ConnectionRecord(self.next_id, conn, kind, pool)
+        self.next_id += 1
+        pool.append(conn)
+        self.records[conn] = record
+        self.by_id[record.id] = record
+        return record
+
+    def add_switch(self, conn):
+        record = self.add(conn, SWITCH, self.switches)
+        if record.controllers is None:
+            record.controllers = []
+        return record
+
+    def add_tunnel(self, conn):
+        return self.add(conn, TUNNEL, self.tunnels)
+
+    # a controller connection serving switch_conn (sch.py) or dpid (proxy.py)
+    def add_controller(self, conn, switch_conn=None, dpid=None):
+        if switch_conn is None:
+            record = self.add(conn, CONTROLLER, self.controllers)
+        else:
+            record = self.add(conn, CONTROLLER, self.records[switch_conn].controllers)
+            record.switch = switch_conn
+        if dpid is not None:
+            self.bind_dpid(conn, dpid)
+        return record
+
+    # the record of the removed connection, None if it was not registered. The controllers
+    # of a removed switch stay registered until they are removed themselves
+    def remove(self, conn):
+        record = self.records.pop(conn, None)
+        if record is None:
+            return None
+        conn = record.conn
+        last = record.pool.pop()
+        if last is not conn:
+            record.pool[record.index] = last
+            self.records[last].index = record.index
+        del self.by_id[record.id]
+        if record.dpid is not None and self.dpids.get(record.dpid) is conn:
+            del self.dpids[record.dpid]
+        if record.kind == SWITCH:
+            self.masters.pop(conn, None)
+        elif record.switch is not None and self.masters.get(record.switch) is conn:
+            del self.masters[record.switch]
+        return record
+
+    def bind_dpid(self, conn, dpid):
+        record = self.records[conn]
+        record.dpid = dpid
+        self.dpids[dpid] = record.conn
+
+    # the connection serving dpid, None if there is none
+    def connection(self, dpid):
+        return self.dpids.get(dpid)
+
+    # the dpid of a connection, None until it is known
+    def dpid(self, conn):
+        record = self.records.get(conn)
+        return record.dpid if record is not None else None
+
+    def record(self, id):
+        return self.by_id.get(id)
+
+    # the controllers of switch_conn, None for an unknown switch
+    def switch_controllers(self, switch_conn):
+        record = self.records.get(switch_conn)
+        return record.controllers if record is not None else None
+
+    # the switch connection a controller serves, None for an unknown controller
+    def controller_switch(self, conn):
+        record = self.records.get(conn)
+        return record.switch if record is not None else None
+
+    def set_master(self, switch_conn, controller_conn):
+        self.masters[switch_conn] = controller_conn
+
+    def master(self, switch_conn):
+        return self.masters.get(switch_conn)
@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ClientFactory
+from twisted.internet.address import UNIXAddress
+from twisted.internet import reactor
+
+import os
+import struct
+import sys
+import time
+
+from openflow_framer import OpenFlowFramer, OFP_HEADER
+from echo_controller import EchoControllerFactory, listen
+from shm_ring import connect_ring
+
+'''
+Messages/s and latency of the proxy's hop to a colocated controller, over TCP, a Unix socket
+or a shared-memory ring
+
+`connections` clients open a connection each to echo_controller.py, as proxy.py does for
+every dpid, and keep `window` packet_ins in flight on it until `packet_ins` have been
+answered in total. The controller runs in the same process and on the same reactor, so
+the numbers compare the transports, not a deployment.
+
+    python controller_transport_benchmark.py tcp|unix|ring [packet_ins] [connections] [window]
+'''
+
+CONTROLLER_PORT = 16653
+CONTROLLER_SOCKET = "/tmp/controller_transport_benchmark.sock"
+CONTROLLER_RING = "/tmp/controller_transport_benchmark.ring"
+PACKET_IN_BODY = struct.pack(">IHBBQ", 0xffffffff, 60, 0, 0, 0) + struct.pack(">HHII", 1, 12, 0x80000004, 1) + \
+    b'\0' * 4 + b'\0\0' + b'\xff' * 12 + struct.pack(">H", 0x0800) + b'\0' * 46
+
+
+class BenchmarkProtocol(Protocol):
+
+    def __init__(self):
+        self.framer = OpenFlowFramer()
+        self.sent = {}      # sent = { xid: send time }
+
+    def connectionMade(self):
+        if not isinstance(self.transport.getPeer(), UNIXAddress):
+            self.transport.setTcpNoDelay(True)
+        self.factory.connected(self)
+
+    def send_packet_in(self):
+        xid = self.factory.next_xid()
+        if xid is None:
+            return
+        self.sent[xid] = time.time()
+        self.transport.write(OFP_HEADER.pack(4, 10, OFP_HEADER.size + len(PACKET_IN_BODY), xid) + PACKET_IN_BODY)
+
+    def dataReceived(self, data):
+        for msg in self.framer.feed(data):
+            version, type, length, xid = OFP_HEADER.unpack_from(msg)
+            if type == 13 and xid in self.sent:
+                self.factory.answered(time.time() - self.sent.pop(xid))
+                self.send_packet_in()
+
+
+class BenchmarkFactory(ClientFactory):
+    protocol = BenchmarkProtocol
+
+    def __init__(self, count, connections, window):
+        self.count = count
+        self.connections = connections
+        self.window = window
+        self.clients = []
+        self.last_xid = 0
+        self.latencies = []
+        self.started = None
+        self.finished = None
+
+    def connected(self, client):
+        self.clients.append(client)
+        if len(self.clients) == self.connections:    # every connection is up, start the packet_ins
+            self.started = time.time()
+            for client in self.clients:
+                for i in range(self.window):
+                    client.send_packet_in()
+
+    def next_xid(self):
+        if self.last_xid == self.count:
+            return None
+        self.last_xid += 1
+        return self.last_xid
+
+    def answered(self, latency):
+        self.latencies.append(latency)
+        if len(self.latencies) == self.count:
+            self.finished = time.time()
+            reactor.stop()
+
+    def clientConnectionFailed(self, connector, reason):
+        print("Unable to connect: %s" % reason.getErrorMessage())
+        reactor.stop()
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv):
+    transport = argv[1] if len(argv) > 1 else "tcp"
+    count = int(argv[2]) if len(argv) > 2 else 100000
+    connections = int(argv[3]) if len(argv) > 3 else 16
+    window = int(argv[4]) if len(argv) > 4 else 8
+    listen(EchoControllerFactory(), CONTROLLER_PORT, CONTROLLER_SOCKET, "127.0.0.1", CONTROLLER_RING)
+    factory = BenchmarkFactory(count, connections, window)
+    for i in range(connections):
+        if transport == "unix":
+            reactor.connectUNIX(CONTROLLER_SOCKET, factory)
+        elif transport == "ring":
+            connect_ring(CONTROLLER_RING, factory)
+        else:
+            reactor.connectTCP("127.0.0.1", CONTROLLER_PORT, factory)
+    reactor.run()
+    for path in (CONTROLLER_SOCKET, CONTROLLER_RING):
+        if os.path.exists(path):
+            os.unlink(path)
+    if factory.finished is None:
+        print("%s: stopped before the last PACKET_OUT" % transport)
+        return 1
+    seconds = factory.finished - factory.started
+    latencies = sorted(factory.latencies)
+    print("%s: %d packet_ins over %d connections in %.2f s, %.0f packet_in/packet_out pairs per second, latency p50 %.0f us p99 %.0f us"
+          % (transport, count, connections, seconds, count / seconds, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
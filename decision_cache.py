@@ -0,0 +1,213 @@
+from collections import OrderedDict, deque
+import struct
+
+from packet_classifier import ip_flow_key, packet_in_in_port, classify_packet_in
+from packet_classifier import ETH_TYPE_IPV4, ETH_TYPE_IPV6, MATCH_HEADER, OXM_HEADER
+from packet_classifier import OFPXMC_OPENFLOW_BASIC, OXM_IP_PROTO, OXM_L4_PORTS
+from packet_classifier import OXM_IPV4_SRC, OXM_IPV4_DST, OXM_IPV6_SRC, OXM_IPV6_DST
+from packet_in_scheduler import packet_in_request_key, response_request_key
+from packet_in_scheduler import BUFFER_ID, PACKET_IN_BUFFER_ID_OFFSET, OFP_NO_BUFFER
+from packet_in_scheduler import FLOW_MOD_BUFFER_ID_OFFSET, FLOW_MOD_MATCH_OFFSET
+
+'''
+Reactive flow decision cache
+
+The controller answers the packet_in of a new flow with a FLOW_MOD, either carrying the
+packet_in's buffer_id or followed by a PACKET_OUT for it. Answers are matched to the
+packet_in like packet_in_scheduler does: by buffer_id, or for an unbuffered packet_in by
+the flow of the PACKET_OUT's frame or the FLOW_MOD's match, never by xid. The cache learns that FLOW_MOD
+for (dpid, in_port, flow key), provided its match names nothing but fields that
+(in_port, flow key) determine and agrees with them, so that replayed for another packet
+of the flow it installs a flow that packet matches. When the switch later raises a
+packet_in for the same flow again (the entry idled out, or was evicted from the switch's
+table), the scheduler replays the FLOW_MOD itself: with the new buffer_id for a buffered
+packet, or followed by a PACKET_OUT to OFPP_TABLE for an unbuffered one. The controller
+is not involved.
+
+Decisions are kept per switch and ingress port, the actions of a FLOW_MOD name the ports
+of the switch it was sent to. An entry is evicted `ttl` seconds after it was learned, a
+hit does not extend it: the packet_in hitting a decision shows that the flow it installed
+is gone from the switch already. A FLOW_MOD modifying or deleting flows, a PORT_STATUS
+or a switch disconnecting drops every decision of that switch.
+
+FLOW_MOD (OpenFlow 1.3):
+    header 8, cookie 8, cookie_mask 8, table_id 1, command 1, idle_timeout 2,
+    hard_timeout 2, priority 2, buffer_id 4, out_port 4, out_group 4, flags 2, pad 2, match
+    match: type 2, length 2, OXM fields (class 2, field 7 bits, has_mask 1 bit, length 1, value, mask)
+'''
+
+FLOW_MOD_COMMAND_OFFSET = 25
+FLOW_MOD_PRIORITY_OFFSET = 30
+OFPFC_ADD = 0
+RECENT_FLOW_MODS = 8            # unbuffered FLOW_MODs per switch a PACKET_OUT may have been sent behind
+UINT8 = struct.Struct(">B")
+UINT16 = struct.Struct(">H")
+UINT32 = struct.Struct(">I")
+XID = struct.Struct(">I")
+OXM_IN_PORT, OXM_ETH_TYPE = 0, 5
+
+
+# the OXM field values (in_port, flow key) of the packet_in determine
+def packet_in_oxm_values(msg):
+    fields = classify_packet_in(msg)
+    values = {OXM_ETH_TYPE: UINT16.pack(fields.eth_type), OXM_IP_PROTO: UINT8.pack(fields.ip_proto)}
+    in_port = packet_in_in_port(msg)
+    if in_port is not None:
+        values[OXM_IN_PORT] = UINT32.pack(in_port)
+    if fields.eth_type == ETH_TYPE_IPV4:
+        values[OXM_IPV4_SRC] = fields.ip_src
+        values[OXM_IPV4_DST] = fields.ip_dst
+    elif fields.eth_type == ETH_TYPE_IPV6:
+        values[OXM_IPV6_SRC] = fields.ip_src
+        values[OXM_IPV6_DST] = fields.ip_dst
+    if fields.l4_src is not None and fields.ip_proto in OXM_L4_PORTS:
+        src, dst = OXM_L4_PORTS[fields.ip_proto]
+        values[src] = UINT16.pack(fields.l4_src)
+        values[dst] = UINT16.pack(fields.l4_dst)
+    return values
+
+
+# True if every OXM field of the FLOW_MOD's match is one of values and agrees with it
+def match_covers(flow_mod, values):
+    end = min(len(flow_mod), FLOW_MOD_MATCH_OFFSET + MATCH_HEADER.unpack_from(flow_mod, FLOW_MOD_MATCH_OFFSET)[1])
+    pos = FLOW_MOD_MATCH_OFFSET + MATCH_HEADER.size
+    while pos + OXM_HEADER.size <= end:
+        oxm = OXM_HEADER.unpack_from(flow_mod, pos)[0]
+        length = oxm & 0xff
+        value = values.get((oxm >> 9) & 0x7f)
+        if oxm >> 16 != OFPXMC_OPENFLOW_BASIC or value is None or pos + OXM_HEADER.size + length > end:
+            return False
+        field = bytearray(flow_mod[pos + OXM_HEADER.size:pos + OXM_HEADER.size + length])
+        if oxm & 0x100:     # has_mask: the value is followed by a mask of the same length
+            size = length // 2
+            if size != len(value) or any(b & m != f for b, m, f in zip(bytearray(value), field[size:], field[:size])):
+                return False
+        elif field != bytearray(value):
+            return False
+        pos += OXM_HEADER.size + length
+    return True
+
+
+class Decision(object):
+    __slots__ = ("flow_mod", "learned")
+
+    def __init__(self, flow_mod, now):
+        self.flow_mod = flow_mod
+        self.learned = now
+
+
+class DecisionCache(object):
+
+    def __init__(self, ttl=10.0, max_entries=65536, request_timeout=1.0):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.request_timeout = request_timeout
+        self.decisions = OrderedDict()  # decisions = { (dpid, in_port, flow key): Decision }, least recently used first
+        self.requests = OrderedDict()   # requests = { request key: ((dpid, in_port, flow key), sent, packet_in) }, oldest first
+        self.recent_flow_mods = {}      # recent_flow_mods = { dpid: deque([(unbuffered FLOW_MOD, received)]) }, oldest first
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+        self.uncovered = 0
+        self.invalidated = 0
+
+    # (dpid, in_port, flow key) of the packet_in, None for packet_ins that are never cached
+    def decision_key(self, dpid, msg):
+        flow = ip_flow_key(msg)
+        if flow is None:
+            return None
+        return dpid, packet_in_in_port(msg), flow
+
+    # the messages installing the cached decision for this packet_in, None on a miss
+    def lookup(self, dpid, xid, msg, now):
+        key = self.decision_key(dpid, msg)
+        if key is None:
+            return None
+        decision = self.decisions.get(key)
+        if decision is None or now - decision.learned > self.ttl:
+            if decision is not None:
+                del self.decisions[key]
+            self.misses += 1
+            return None
+        del self.decisions[key]
+        self.decisions[key] = decision
+        self.hits += 1
+        flow_mod = bytearray(decision.flow_mod)
+        XID.pack_into(flow_mod, 4, xid)
+        buffer_id = BUFFER_ID.unpack_from(msg, PACKET_IN_BUFFER_ID_OFFSET)[0]
+        BUFFER_ID.pack_into(flow_mod, FLOW_MOD_BUFFER_ID_OFFSET, buffer_id)
+        return bytes(flow_mod), buffer_id == OFP_NO_BUFFER
+
+    # the packet_in was forwarded to the controller, its answer may be learned
+    def expect(self, dpid, msg, now):
+        key = self.decision_key(dpid, msg)
+        if key is None:
+            return
+        request = packet_in_request_key(dpid, msg)
+        self.requests.pop(request, None)
+        self.requests[request] = (key, now, msg)
+        deadline = now - self.request_timeout
+        while self.requests:
+            oldest = next(iter(self.requests))
+            if self.requests[oldest][1] > deadline:
+                break
+            del self.requests[oldest]
+
+    # a PACKET_OUT(13) or FLOW_MOD(14) from the controller passed back to switch dpid
+    def on_response(self, dpid, type, msg, now):
+        if type == 14:
+            if len(msg) < FLOW_MOD_MATCH_OFFSET:
+                return
+            if UINT8.unpack_from(msg, FLOW_MOD_COMMAND_OFFSET)[0] != OFPFC_ADD:
+                self.invalidate(dpid)
+                return
+            if UINT16.unpack_from(msg, FLOW_MOD_PRIORITY_OFFSET)[0] == 0:   # table-miss entry
+                return
+        request = self.requests.pop(response_request_key(dpid, type, msg), None)
+        if type == 14:
+            if request is not None:
+                self.learn_covering(request, [msg], now)
+            elif BUFFER_ID.unpack_from(msg, FLOW_MOD_BUFFER_ID_OFFSET)[0] == OFP_NO_BUFFER:
+                recent = self.recent_flow_mods.get(dpid)
+                if recent is None:
+                    recent = self.recent_flow_mods[dpid] = deque(maxlen=RECENT_FLOW_MODS)
+                recent.append((msg, now))
+            return
+        if request is None:
+            return
+        sent_since = [flow_mod for flow_mod, received in self.recent_flow_mods.get(dpid, ()) if received >= request[1]]
+        self.learn_covering(request, reversed(sent_since), now)     # the FLOW_MOD sent ahead of this PACKET_OUT
+
+    # learn the first of the flow_mods whose match covers the packet_in of request
+    def learn_covering(self, request, flow_mods, now):
+        values = packet_in_oxm_values(request[2])
+        for flow_mod in flow_mods:
+            if match_covers(flow_mod, values):
+                self.learn(request[0], flow_mod, now)
+                return
+        self.uncovered += 1
+
+    def learn(self, key, flow_mod, now):
+        self.decisions.pop(key, None)
+        self.decisions[key] = Decision(flow_mod, now)
+        self.learned += 1
+        if len(self.decisions) > self.max_entries:
+            self.decisions.popitem(last=False)
+
+    # flows of switch dpid were modified or deleted, or one of its ports changed
+    def invalidate(self, dpid):
+        for key in [key for key in self.decisions if key[0] == dpid]:
+            del self.decisions[key]
+            self.invalidated += 1
+        self.recent_flow_mods.pop(dpid, None)
+
+    # the switch is gone
+    def forget(self, dpid):
+        self.invalidate(dpid)
+        for request in [request for request in self.requests if request[0] == dpid]:
+            del self.requests[request]
+
+    def metrics(self):
+        return {"entries": len(self.decisions), "hits": self.hits, "misses": self.misses,
+                "learned": self.learned, "uncovered": self.uncovered, "invalidated": self.invalidated}
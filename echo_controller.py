@@ -0,0 +1,89 @@
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ServerFactory
+from twisted.internet import reactor
+
+import logging
+import os
+import struct
+import sys
+
+from openflow_framer import OpenFlowFramer, OFP_HEADER
+from shm_ring import listen_ring
+
+'''
+Stand-in for a colocated controller, for trying proxy.py's controller transports
+
+Every connection is a switch: it gets a HELLO, ECHO_REQUESTs are answered, and every
+PACKET_IN is answered with a PACKET_OUT of the same xid and buffer_id and no actions.
+The other messages are counted and ignored. It listens on TCP and, when paths are given, on a Unix domain
+socket and for shared-memory ring connections (shm_ring.py) as well.
+
+    python echo_controller.py [port] [unix socket path] [ring socket path]
+'''
+
+PACKET_OUT = struct.Struct(">bbHIIIH6x")   # header, buffer_id, in_port, actions_len, pad
+OFPP_CONTROLLER = 0xfffffffd
+
+
+def hello(version=4, xid=1):
+    return OFP_HEADER.pack(version, 0, OFP_HEADER.size, xid)
+
+
+class EchoControllerProtocol(Protocol):
+
+    def __init__(self):
+        self.framer = OpenFlowFramer()
+
+    def connectionMade(self):
+        self.factory.connections += 1
+        self.transport.write(hello())
+
+    def dataReceived(self, data):
+        replies = []
+        for msg in self.framer.feed(data):
+            version, type, length, xid = OFP_HEADER.unpack_from(msg)
+            self.factory.received += 1
+            if type == 10:
+                buffer_id = struct.unpack_from(">I", msg, 8)[0]
+                replies.append(PACKET_OUT.pack(version, 13, PACKET_OUT.size, xid, buffer_id, OFPP_CONTROLLER, 0))
+            elif type == 2:
+                replies.append(OFP_HEADER.pack(version, 3, length, xid) + msg[OFP_HEADER.size:])
+        if replies:
+            self.factory.replied += len(replies)
+            self.transport.write(b''.join(replies))
+
+    def connectionLost(self, reason):
+        self.factory.connections -= 1
+
+
+class EchoControllerFactory(ServerFactory):
+    protocol = EchoControllerProtocol
+
+    def __init__(self):
+        self.connections = 0
+        self.received = 0
+        self.replied = 0
+
+    def metrics(self):
+        return {"connections": self.connections, "received": self.received, "replied": self.replied}
+
+
+# listen on port and, if given, on the Unix domain socket path and the ring socket path
+def listen(factory, port=6633, path=None, interface='', ring_path=None):
+    ports = [reactor.listenTCP(port, factory, interface=interface)]
+    if path is not None:
+        if os.path.exists(path):    # left by a previous run
+            os.unlink(path)
+        ports.append(reactor.listenUNIX(path, factory))
+    if ring_path is not None:
+        ports.append(listen_ring(ring_path, factory))
+    return ports
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    factory = EchoControllerFactory()
+    listen(factory, int(sys.argv[1]) if len(sys.argv) > 1 else 6633, sys.argv[2] if len(sys.argv) > 2 else None,
+           ring_path=sys.argv[3] if len(sys.argv) > 3 else None)
+    logging.info("Start running echo controller")
+    reactor.run()
@@ -0,0 +1,179 @@
+from __future__ import print_function
+
+import logging
+import struct
+import sys
+import time
+
+from openflow_framer import OpenFlowFramer, OFP_HEADER
+
+'''
+Messages/s and latency of scheduler_modify.py and proxy.py on one event loop
+
+An emulated switch sends packet_ins through the scheduler's OpenFlowService, the tunnel and
+the proxy's OpenFlowService to an emulated controller answering each with a PACKET_OUT,
+which comes back the same way. The services are the real ones, started with
+start_scheduler and start_proxy; `window` packet_ins are kept in flight. Everything runs
+in one process on one event loop over loopback TCP, so the numbers compare the loops,
+not a deployment.
+
+The services are written against the Twisted reactor. "twisted" runs them on its default
+reactor, "asyncio" and "uvloop" on Twisted's asyncio reactor over an asyncio or uvloop
+event loop (Python 3). Logging is turned down to WARNING, the numbers are not those of
+writing the debug log.
+
+    python3 engine_benchmark.py asyncio|uvloop|twisted [packet_ins] [window]
+    python2 engine_benchmark.py twisted [packet_ins] [window]
+'''
+
+SCHEDULER_PORT = 16633
+TUNNEL_PORT = 19999
+CONTROLLER_PORT = 16653
+DPID = 1
+PACKET_IN = struct.Struct(">bbHIIHBBQHHII4x2x")      # header, buffer_id, total_len, reason, table_id, cookie, match with in_port
+FRAME = struct.Struct(">6s6sHBBHHHBBH4s4sHHHH")     # Ethernet, IPv4, UDP
+PACKET_OUT = struct.Struct(">bbHIIIH6x")
+FEATURES_REPLY = struct.Struct(">QIBB2xII")
+
+
+def ofmsg(type, xid, data=b''):
+    return OFP_HEADER.pack(4, type, OFP_HEADER.size + len(data), xid) + data
+
+
+# a buffered UDP packet_in, every xid a flow of its own so the pending flows hold none of them
+def packet_in_msg(xid):
+    frame = FRAME.pack(b'\x02' * 6, b'\x04' * 6, 0x0800, 0x45, 0, 28, 0, 0, 64, 17, 0,
+                       b'\x0a\0\0\x01', b'\x0a\0\0\x02', xid & 0xffff, xid >> 16, 8, 0)
+    return PACKET_IN.pack(4, 10, PACKET_IN.size + len(frame), xid, xid, len(frame), 0, 0, 0,
+                          1, 12, 0x80000004, 1) + frame
+
+
+# the reactor the services run on, installed before anything imports it
+def install_reactor(name):
+    if name == "twisted":
+        return True
+    try:
+        import asyncio
+    except ImportError:
+        print("%s: asyncio needs Python 3" % name)
+        return False
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            print("uvloop: not installed")
+            return False
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    from twisted.internet import asyncioreactor
+    asyncioreactor.install(loop)
+    return True
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main(argv):
+    name = argv[1] if len(argv) > 1 else "asyncio"
+    count = int(argv[2]) if len(argv) > 2 else 100000
+    window = int(argv[3]) if len(argv) > 3 else 64
+    if not install_reactor(name):
+        return 0
+    from twisted.internet.protocol import Protocol, ClientFactory, ServerFactory
+    from twisted.internet import reactor
+    import scheduler_modify
+    import proxy
+    logging.getLogger().setLevel(logging.WARNING)
+
+    class SwitchEmulator(Protocol):
+
+        def __init__(self):
+            self.framer = OpenFlowFramer()
+            self.sent = {}              # sent = { xid: send time }
+            self.next_xid = 1
+            self.latencies = []
+            self.started = None
+            self.finished = None
+
+        def connectionMade(self):
+            self.transport.setTcpNoDelay(True)
+            self.transport.write(ofmsg(0, 1))
+
+        # the controller is connected, start the packet_ins
+        def start(self):
+            self.started = time.time()
+            for i in range(window):
+                self.send_packet_in()
+
+        def send_packet_in(self):
+            if self.next_xid > count:
+                return
+            self.sent[self.next_xid] = time.time()
+            self.transport.write(packet_in_msg(self.next_xid))
+            self.next_xid += 1
+
+        def dataReceived(self, data):
+            for msg in self.framer.feed(data):
+                version, type, length, xid = OFP_HEADER.unpack_from(msg)
+                if type == 5:
+                    self.transport.write(ofmsg(6, xid, FEATURES_REPLY.pack(DPID, 256, 254, 0, 0, 0)))
+                elif type == 2:
+                    self.transport.write(ofmsg(3, xid))
+                elif type == 13 and xid in self.sent:
+                    self.latencies.append(time.time() - self.sent.pop(xid))
+                    if len(self.latencies) == count:
+                        self.finished = time.time()
+                        reactor.stop()
+                    else:
+                        self.send_packet_in()
+
+    class ControllerEmulator(Protocol):
+
+        def connectionMade(self):
+            self.transport.setTcpNoDelay(True)
+            self.framer = OpenFlowFramer()
+            self.transport.write(ofmsg(0, 1))
+            switch.start()
+
+        def dataReceived(self, data):
+            replies = []
+            for msg in self.framer.feed(data):
+                version, type, length, xid = OFP_HEADER.unpack_from(msg)
+                if type == 10:
+                    buffer_id = struct.unpack_from(">I", msg, 8)[0]
+                    replies.append(PACKET_OUT.pack(version, 13, PACKET_OUT.size, xid, buffer_id, 0xfffffffd, 0))
+                elif type == 2:
+                    replies.append(ofmsg(3, xid))
+            if replies:
+                self.transport.write(b''.join(replies))
+
+    switch = SwitchEmulator()
+    switch_factory = ClientFactory()
+    switch_factory.buildProtocol = lambda addr: switch
+    controller_factory = ServerFactory()
+    controller_factory.protocol = ControllerEmulator
+    reactor.listenTCP(CONTROLLER_PORT, controller_factory, interface="127.0.0.1")
+
+    proxy_service = proxy.OpenFlowService()
+    proxy_service.CONTROLLER_HOST = "127.0.0.1"
+    proxy_service.CONTROLLER_PORT = CONTROLLER_PORT
+    proxy.start_proxy(proxy_service, TUNNEL_PORT)
+    scheduler = scheduler_modify.OpenFlowService()
+    scheduler_modify.start_scheduler(scheduler, SCHEDULER_PORT, ["127.0.0.1"], [], TUNNEL_PORT)
+    reactor.callLater(0.2, reactor.connectTCP, "127.0.0.1", SCHEDULER_PORT, switch_factory)     # once the tunnel is up
+    reactor.run()
+    if switch.finished is None:
+        print("%s: stopped before the last PACKET_OUT" % name)
+        return 1
+    seconds = switch.finished - switch.started
+    latencies = sorted(switch.latencies)
+    print("%s: %d packet_ins in %.2f s, %.0f packet_in/packet_out pairs per second, latency p50 %.0f us p99 %.0f us"
+          % (name, count, seconds, count / seconds, percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,189 @@
+from collections import deque
+import math
+import random
+
+'''
+Accrual failure detection of controllers and tunnels, from the replies to their echoes
+
+Every target gets an ECHO_REQUEST each `interval` seconds and every ECHO_REPLY is a
+heartbeat. Instead of a yes/no timeout the detector keeps the last `window` intervals
+between heartbeats and gives phi, -log10 of the probability that a heartbeat still comes
+after the silence so far (the phi accrual failure detector of Hayashibara et al.). Phi
+grows with the silence, the faster the more regular the heartbeats were. A target is
+suspected once phi reaches `threshold`, and dead once it stayed suspected for
+`dead_after` seconds: the caller hands what a suspected target has in flight to the
+others, and closes a dead one.
+
+The round trip of every echo is smoothed as TCP does. A target whose smoothed round
+trip is over `slow_rtt` is slow: it keeps its requests but gets no new ones until it is
+fast again.
+
+A target that is added again (a reconnection) or recovers from a suspicion is
+reintegrated gradually: for `ramp` seconds available() keeps it among the candidates of
+a packet_in with a probability growing from `ramp_floor` to 1, and its share of the
+packet_ins with it. Targets never added, e.g. tunnels to a proxy that does not answer
+echoes, are not watched and always available.
+'''
+
+LN10 = math.log(10)
+
+
+# phi of a heartbeat `elapsed` seconds late, for intervals of this mean and standard deviation
+def phi(elapsed, mean, std_deviation):
+    y = (elapsed - mean) / std_deviation
+    x = y * (1.5976 + 0.070566 * y * y)     # logistic approximation of the normal distribution
+    if x > 0:
+        return x / LN10 + math.log10(1.0 + math.exp(-x))
+    return math.log10(1.0 + math.exp(x))
+
+
+class TargetState(object):
+    __slots__ = ("intervals", "total", "squares", "last", "srtt", "since", "suspected_since", "dead")
+
+    def __init__(self, interval, window, now, ramp_start):
+        self.intervals = deque(maxlen=window)   # seconds between heartbeats, oldest first
+        self.total = 0.0
+        self.squares = 0.0
+        self.last = now             # time of the last heartbeat, or of the connection
+        self.srtt = None
+        self.since = ramp_start     # start of the reintegration ramp, None for none
+        self.suspected_since = None
+        self.dead = False
+        for bootstrap in (interval * 0.75, interval * 1.25):    # until real heartbeats come in
+            self.add(bootstrap)
+
+    def add(self, interval):
+        if len(self.intervals) == self.intervals.maxlen:
+            oldest = self.intervals[0]
+            self.total -= oldest
+            self.squares -= oldest * oldest
+        self.intervals.append(interval)
+        self.total += interval
+        self.squares += interval * interval
+
+
+class FailureDetector(object):
+
+    def __init__(self, interval=1.0, threshold=8.0, dead_after=3.0, slow_rtt=0.5, window=100,
+                 min_std_deviation=0.2, acceptable_pause=0.5, ramp=10.0, ramp_floor=0.1):
+        self.interval = interval
+        self.threshold = threshold
+        self.dead_after = dead_after
+        self.slow_rtt = slow_rtt
+        self.window = window
+        self.min_std_deviation = min_std_deviation
+        self.acceptable_pause = acceptable_pause    # seconds of silence expected on top of the interval
+        self.ramp = ramp
+        self.ramp_floor = ramp_floor
+        self.targets = {}           # targets = { target: TargetState }
+        # counters
+        self.heartbeats = 0
+        self.suspicions = 0
+        self.deaths = 0
+        self.recoveries = 0
+
+    def __contains__(self, target):
+        return target in self.targets
+
+    # watch target from now on, ramp=True reintegrates it gradually
+    def add(self, target, now, ramp=False):
+        self.targets[target] = TargetState(self.interval, self.window, now, now if ramp else None)
+
+    def remove(self, target):
+        self.targets.pop(target, None)
+
+    # an ECHO_REPLY from target, rtt the round trip of its request if known
+    def heartbeat(self, target, now, rtt=None):
+        state = self.targets.get(target)
+        if state is None:
+            return
+        state.add(now - state.last)
+        state.last = now
+        if rtt is not None:
+            state.srtt = rtt if state.srtt is None else state.srtt + (rtt - state.srtt) / 8.0
+        self.heartbeats += 1
+
+    def phi(self, target, now):
+        state = self.targets.get(target)
+        return self.state_phi(state, now) if state is not None else 0.0
+
+    def state_phi(self, state, now):
+        count = len(state.intervals)
+        mean = state.total / count
+        variance = max(0.0, state.squares / count - mean * mean)
+        return phi(now - state.last, mean + self.acceptable_pause, max(math.sqrt(variance), self.min_std_deviation))
+
+    # silent or slow, either way no new requests for target
+    def suspected(self, target, now):
+        state = self.targets.get(target)
+        return state is not None and self.unavailable(state, now)
+
+    def unavailable(self, state, now):
+        return state.suspected_since is not None or self.state_phi(state, now) >= self.threshold \
+            or (state.srtt is not None and state.srtt > self.slow_rtt)
+
+    # share of the packet_ins target gets while it is reintegrated, 1 once it is done
+    def weight(self, target, now):
+        state = self.targets.get(target)
+        if state is None or state.since is None:
+            return 1.0
+        progress = (now - state.since) / self.ramp if self.ramp else 1.0
+        if progress >= 1.0:
+            state.since = None
+            return 1.0
+        return self.ramp_floor + (1.0 - self.ramp_floor) * progress
+
+    # the candidates a packet_in may go to: neither suspected nor left out by their ramp.
+    # When every candidate is suspected they are all returned, a late answer beats none
+    def available(self, candidates, now):
+        if not candidates or not self.targets:
+            return candidates
+        live = []
+        admitted = []
+        for target in candidates:
+            state = self.targets.get(target)
+            if state is not None and self.unavailable(state, now):
+                continue
+            live.append(target)
+            if state is not None and state.since is not None and random.random() >= self.weight(target, now):
+                continue
+            admitted.append(target)
+        if admitted:
+            return admitted
+        return live or candidates
+
+    # targets that went silent, stayed silent for dead_after, and answered again since the last check
+    def check(self, now):
+        suspected = []
+        dead = []
+        recovered = []
+        for target, state in self.targets.items():
+            if self.state_phi(state, now) >= self.threshold:
+                if state.suspected_since is None:
+                    state.suspected_since = now
+                    self.suspicions += 1
+                    suspected.append(target)
+                elif not state.dead and now - state.suspected_since >= self.dead_after:
+                    state.dead = True
+                    self.deaths += 1
+                    dead.append(target)
+            elif state.suspected_since is not None:
+                state.suspected_since = None
+                state.dead = False
+                state.since = now
+                self.recoveries += 1
+                recovered.append(target)
+        return suspected, dead, recovered
+
+    def metrics(self, now):
+        targets = self.targets.values()
+        return {"watched": len(self.targets),
+                "suspected": sum(1 for state in targets if state.suspected_since is not None),
+                "slow": sum(1 for state in targets if state.srtt is not None and state.srtt > self.slow_rtt),
+                "ramping": sum(1 for state in targets if state.since is not None and now - state.since < self.ramp),
+                "max_phi": max([self.state_phi(state, now) for state in targets] or [0.0]),
+                "max_rtt": max([state.srtt for state in targets if state.srtt is not None] or [0.0]),
+                "heartbeats": self.heartbeats,
+                "suspicions": self.suspicions,
+                "deaths": self.deaths,
+                "recoveries": self.recoveries}
@@ -0,0 +1,96 @@
+from zope.interface import implementer
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet import reactor, task
+
+import time
+
+'''
+Backpressure from a slow tunnel to the switch reads
+
+Each tunnel transport is the consumer of one TunnelFlowControl producer. The transport's
+bufferSize is set to the high watermark, so Twisted calls pauseProducing once more than
+that is waiting to be sent. The service then stops reading from the switches, which
+pushes the queueing back into the switches' TCP windows instead of our heap.
+While congested, the backlog is polled and the switches resume once it falls under the
+low watermark (or when Twisted reports the tunnel drained, whichever comes first).
+'''
+
+
+# bytes waiting in a transport's write buffer, 0 if the transport does not expose them
+def transport_buffered_bytes(transport):
+    backlog = getattr(transport, "backlog_bytes", None)     # a RingTransport
+    if backlog is not None:
+        return backlog
+    data_buffer = getattr(transport, "dataBuffer", None)
+    if data_buffer is None:
+        return 0
+    return len(data_buffer) - getattr(transport, "offset", 0) + getattr(transport, "_tempDataLen", 0)
+
+
+@implementer(IPushProducer)
+class TunnelFlowControl(object):
+
+    def __init__(self, tunnel, on_congested, on_drained, high_watermark, low_watermark,
+                 poll_interval=0.01, clock=None):
+        self.tunnel = tunnel
+        self.on_congested = on_congested
+        self.on_drained = on_drained
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.poll_interval = poll_interval
+        self.clock = clock or reactor
+        self.poll = None
+        self.congested = False
+        self.paused_at = 0
+        # metrics
+        self.pauses = 0
+        self.paused_seconds = 0.0
+        self.max_backlog = 0
+        tunnel.transport.bufferSize = high_watermark
+        tunnel.transport.registerProducer(self, True)
+
+    # bytes queued for this tunnel, in our writer and in the transport
+    def backlog(self):
+        return self.tunnel.writer.buffered_bytes + transport_buffered_bytes(self.tunnel.transport)
+
+    # the tunnel transport holds more than the high watermark
+    def pauseProducing(self):
+        self.max_backlog = max(self.max_backlog, self.backlog())
+        if self.congested:
+            return
+        self.congested = True
+        self.pauses += 1
+        self.paused_at = time.time()
+        self.poll = task.LoopingCall(self.check_drained)
+        self.poll.clock = self.clock
+        self.poll.start(self.poll_interval, now=False)
+        self.on_congested(self.tunnel)
+
+    def check_drained(self):
+        if self.backlog() <= self.low_watermark:
+            self.resumeProducing()
+
+    # the backlog is under the low watermark, or the transport sent everything
+    def resumeProducing(self):
+        if not self.congested:
+            return
+        self.stop_poll()
+        self.congested = False
+        self.paused_seconds += time.time() - self.paused_at
+        self.on_drained(self.tunnel)
+
+    # the tunnel connection is gone, it must not keep the switches paused
+    def stopProducing(self):
+        self.resumeProducing()
+
+    def stop_poll(self):
+        if self.poll is not None and self.poll.running:
+            self.poll.stop()
+        self.poll = None
+
+    def metrics(self):
+        paused_seconds = self.paused_seconds
+        if self.congested:
+            paused_seconds += time.time() - self.paused_at
+        return {"congested": self.congested, "backlog": self.backlog(), "max_backlog": self.max_backlog,
+                "pauses": self.pauses, "paused_seconds": paused_seconds}
@@ -0,0 +1,165 @@
+from collections import OrderedDict
+import struct
+
+from multipart_coalescer import with_xid, MULTIPART_HEADER, MULTIPART_OFFSET, OFPMPF_MORE
+
+'''
+Per-switch cache of the replies every controller asks for when it meets a switch
+
+The FEATURES_REPLY(6) the scheduler receives while learning the dpid, the port descriptions
+(MULTIPART PORT_DESC) and the static multipart replies (DESC, GROUP_FEATURES,
+METER_FEATURES) are kept per dpid. A controller asking for them again is answered from the
+cache with its own xid, the switch is not involved. PORT_STATUS(12) keeps the port
+descriptions current: a port is added, replaced or deleted as the switch reports it.
+
+The cache learns from every reply passing through, and from the requests the scheduler
+sends itself right after the handshake (warm_up). The replies and ERRORs (1) answering
+those requests are the scheduler's own and are not passed on to the controllers.
+
+PORT_DESC reply: header 8, type 2, flags 2, pad 4, ofp_port 64 each
+PORT_STATUS: header 8, reason 1, pad 7, ofp_port 64
+'''
+
+OFPMP_DESC = 0
+OFPMP_GROUP_FEATURES = 8
+OFPMP_METER_FEATURES = 11
+OFPMP_PORT_DESC = 13
+STATIC_TYPES = (OFPMP_DESC, OFPMP_GROUP_FEATURES, OFPMP_METER_FEATURES)
+OFPPR_DELETE = 1
+PORT_SIZE = 64
+PORT_NO = struct.Struct(">I")
+PORT_STATUS_PORT_OFFSET = 16
+PORTS_OFFSET = MULTIPART_OFFSET + 8
+MAX_PORTS_PER_PART = (0xffff - PORTS_OFFSET) // PORT_SIZE
+OF_HEADER = struct.Struct(">bbHI")
+MULTIPART_REQUEST = struct.Struct(">bbHIHH4x")
+
+
+class SwitchHandshake(object):
+    __slots__ = ("features", "ports", "static", "partial")
+
+    def __init__(self):
+        self.features = None         # FEATURES_REPLY
+        self.ports = None            # ports = { port_no: ofp_port }, in the switch's order
+        self.static = {}             # static = { multipart type: [reply parts] }
+        self.partial = {}            # partial = { xid: [reply parts received so far] }
+
+
+class HandshakeCache(object):
+
+    def __init__(self, first_xid=0x68730000):
+        self.switches = {}           # switches = { dpid: SwitchHandshake }
+        self.next_xid = first_xid
+        self.own_xids = set()        # own_xids = { (dpid, xid) } of the requests sent by warm_up
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.port_updates = 0
+
+    def switch(self, dpid):
+        entry = self.switches.get(dpid)
+        if entry is None:
+            entry = self.switches[dpid] = SwitchHandshake()
+        return entry
+
+    def learn_features(self, dpid, msg):
+        self.switch(dpid).features = msg
+
+    # MULTIPART_REQUESTs (18) asking the switch for what the cache keeps, sent after the handshake
+    def warm_up(self, dpid, version=4):
+        requests = []
+        for mp_type in (OFPMP_PORT_DESC,) + STATIC_TYPES:
+            xid = self.next_xid
+            self.next_xid = (self.next_xid + 1) & 0xffffffff
+            self.own_xids.add((dpid, xid))
+            requests.append(MULTIPART_REQUEST.pack(version, 18, MULTIPART_REQUEST.size, xid, mp_type, 0))
+        return requests
+
+    # the cached reply to a FEATURES_REQUEST(5) or MULTIPART_REQUEST(18) as a list of messages
+    # with the requester's xid, None if the switch has to answer it
+    def answer(self, dpid, type, xid, msg):
+        entry = self.switches.get(dpid)
+        parts = None
+        if entry is not None:
+            if type == 5:
+                parts = [entry.features] if entry.features is not None else None
+            elif type == 18 and len(msg) == PORTS_OFFSET:    # no body: ports are all ports, the rest takes none
+                mp_type, flags = MULTIPART_HEADER.unpack_from(msg, MULTIPART_OFFSET)
+                if mp_type == OFPMP_PORT_DESC and entry.ports is not None:
+                    parts = self.port_desc_reply(entry, msg)
+                elif mp_type in STATIC_TYPES:
+                    parts = entry.static.get(mp_type)
+        if parts is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [with_xid(part, xid) for part in parts]
+
+    def port_desc_reply(self, entry, request):
+        version = OF_HEADER.unpack_from(request)[0]
+        ports = list(entry.ports.values())
+        chunks = [ports[i:i + MAX_PORTS_PER_PART] for i in range(0, len(ports), MAX_PORTS_PER_PART)] or [[]]
+        parts = []
+        for i, chunk in enumerate(chunks):
+            flags = OFPMPF_MORE if i < len(chunks) - 1 else 0
+            parts.append(MULTIPART_REQUEST.pack(version, 19, PORTS_OFFSET + PORT_SIZE * len(chunk), 0, OFPMP_PORT_DESC, flags)
+                         + b''.join(chunk))
+        return parts
+
+    # a MULTIPART_REPLY(19) from switch dpid, returns True if it answers a warm_up request
+    def on_reply(self, dpid, xid, msg):
+        own = (dpid, xid) in self.own_xids
+        if len(msg) < PORTS_OFFSET:
+            return own
+        mp_type, flags = MULTIPART_HEADER.unpack_from(msg, MULTIPART_OFFSET)
+        if mp_type != OFPMP_PORT_DESC and mp_type not in STATIC_TYPES:
+            return own
+        entry = self.switch(dpid)
+        parts = entry.partial.setdefault(xid, [])
+        parts.append(msg)
+        if flags & OFPMPF_MORE:
+            return own
+        del entry.partial[xid]
+        self.own_xids.discard((dpid, xid))
+        if mp_type == OFPMP_PORT_DESC:
+            entry.ports = OrderedDict()
+            for part in parts:
+                for offset in range(PORTS_OFFSET, len(part) - PORT_SIZE + 1, PORT_SIZE):
+                    port = part[offset:offset + PORT_SIZE]
+                    entry.ports[PORT_NO.unpack_from(port)[0]] = port
+        else:
+            entry.static[mp_type] = parts
+        return own
+
+    # an ERROR(1) from switch dpid, returns True if it answers a warm_up request, which is given up
+    def on_error(self, dpid, xid):
+        if (dpid, xid) not in self.own_xids:
+            return False
+        self.own_xids.discard((dpid, xid))
+        entry = self.switches.get(dpid)
+        if entry is not None:
+            entry.partial.pop(xid, None)
+        return True
+
+    # PORT_STATUS(12): the port was added, deleted or modified
+    def on_port_status(self, dpid, msg):
+        entry = self.switches.get(dpid)
+        if entry is None or entry.ports is None or len(msg) < PORT_STATUS_PORT_OFFSET + PORT_SIZE:
+            return
+        reason = struct.unpack_from(">B", msg, 8)[0]
+        port = msg[PORT_STATUS_PORT_OFFSET:PORT_STATUS_PORT_OFFSET + PORT_SIZE]
+        port_no = PORT_NO.unpack_from(port)[0]
+        if reason == OFPPR_DELETE:
+            entry.ports.pop(port_no, None)
+        else:
+            entry.ports[port_no] = port
+        self.port_updates += 1
+
+    # the switch is gone, a reconnecting switch is asked again
+    def forget(self, dpid):
+        self.switches.pop(dpid, None)
+        self.own_xids = set(own for own in self.own_xids if own[0] != dpid)
+
+    def metrics(self):
+        return {"switches": len(self.switches), "hits": self.hits, "misses": self.misses,
+                "port_updates": self.port_updates}
@@ -1,9 +1,7 @@
 import struct
 import traceback
 
-from scapy.layers.inet import UDP
-from scapy.layers.l2 import Ether
-from twink.ofp4 import parse
+from packet_classifier import classify_packet_in, classify_packet_out
 
 testFile = open("log.txt", "rb")
 udp_start_time = {}
@@ -25,21 +23,21 @@ while True:
         break
 
 for (start, length, msg) in data:
-    pkt = parse.parse(msg)
+    type = struct.unpack_from(">bbHI", msg)[1]
     print "working start%s"%start
-    if pkt.__class__.__name__ == "ofp_packet_in":
-        ether_pkt = Ether(pkt.data)
-        if UDP in ether_pkt:
-            udp_sport = ether_pkt[UDP].sport
+    if type == 10:  # packet_in
+        fields = classify_packet_in(msg)
+        if fields.ip_proto == 17 and fields.l4_src is not None:     # not for non-first fragments
+            udp_sport = fields.l4_src
             start_time = start
             udp_start_time[udp_sport]=start_time
 
 
-    elif pkt.__class__.__name__ == "ofp_packet_out":
-        ether_pkt = Ether(pkt.data)
-        if UDP in ether_pkt:
+    elif type == 13:  # packet_out
+        fields = classify_packet_out(msg)
+        if fields.ip_proto == 17 and fields.l4_src is not None:
             stop_time = start
-            udp_sport = ether_pkt[UDP].sport
+            udp_sport = fields.l4_src
             udp_stop_time.append(stop_time - udp_start_time[udp_sport])
 
 
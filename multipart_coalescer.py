@@ -0,0 +1,124 @@
+from collections import OrderedDict
+import struct
+import time
+
+'''
+Coalescing of equivalent MULTIPART_REQUESTs (18) from several controllers
+
+Every controller polls the same statistics of every switch. A request whose body is
+byte-for-byte the same as one already waiting for the switch's reply joins it instead of
+being sent again, and every part of the reply (OFPMPF_REPLY_MORE) is copied to each
+requester with its own xid. A complete reply is kept for `cache_ttl` seconds and
+answers equivalent requests arriving meanwhile without asking the switch at all.
+
+The coalesced request goes to the switch with an xid of our own, so its reply cannot be
+confused with the reply to any one controller's request.
+
+MULTIPART_REQUEST/REPLY: header 8, type 2, flags 2, pad 4, body
+'''
+
+MULTIPART_HEADER = struct.Struct(">HH")
+MULTIPART_OFFSET = 8
+OFPMPF_MORE = 1                  # REQ_MORE in requests, REPLY_MORE in replies
+COALESCED_TYPES = (0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 13)   # read-only statistics, not TABLE_FEATURES(12) or EXPERIMENTER
+XID = struct.Struct(">I")
+
+
+def with_xid(msg, xid):
+    return msg[:4] + XID.pack(xid) + msg[8:]
+
+
+class InflightRequest(object):
+    __slots__ = ("key", "sent", "waiters", "parts")
+
+    def __init__(self, key, sent):
+        self.key = key
+        self.sent = sent
+        self.waiters = []            # waiters = [ (target, xid of its request) ]
+        self.parts = []              # reply parts received so far
+
+
+class MultipartCoalescer(object):
+
+    def __init__(self, cache_ttl=1.0, request_timeout=10.0, first_xid=0x6d700000):
+        self.cache_ttl = cache_ttl
+        self.request_timeout = request_timeout
+        self.next_xid = first_xid
+        self.inflight = {}           # inflight = { (switch, request body): InflightRequest }
+        self.inflight_xids = {}      # inflight_xids = { (switch, our xid): InflightRequest }
+        self.cache = OrderedDict()   # cache = { (switch, request body): (reply parts, completed) }, oldest first
+        # counters
+        self.sent = 0
+        self.joined = 0
+        self.cache_hits = 0
+        self.expired = 0
+
+    # False for requests that must reach the switch as they are
+    def coalescible(self, msg):
+        if len(msg) < MULTIPART_OFFSET + MULTIPART_HEADER.size:
+            return False
+        mp_type, flags = MULTIPART_HEADER.unpack_from(msg, MULTIPART_OFFSET)
+        return mp_type in COALESCED_TYPES and not flags & OFPMPF_MORE
+
+    # returns (request to send to the switch, None), (None, cached reply parts for target)
+    # or (None, None) when the request joined one already waiting for the switch
+    def request(self, switch, xid, msg, target):
+        now = time.time()
+        self.expire(now)
+        key = (switch, msg[MULTIPART_OFFSET:])
+        cached = self.cache.get(key)
+        if cached is not None:
+            self.cache_hits += 1
+            return None, [with_xid(part, xid) for part in cached[0]]
+        entry = self.inflight.get(key)
+        if entry is not None:
+            entry.waiters.append((target, xid))
+            self.joined += 1
+            return None, None
+        entry = InflightRequest(key, now)
+        entry.waiters.append((target, xid))
+        own_xid = self.next_xid
+        self.next_xid = (self.next_xid + 1) & 0xffffffff
+        self.inflight[key] = entry
+        self.inflight_xids[(switch, own_xid)] = entry
+        self.sent += 1
+        return with_xid(msg, own_xid), None
+
+    # a MULTIPART_REPLY (19) from switch: [(target, part with its xid)] for a coalesced
+    # request, None if the reply belongs to a request that was not coalesced
+    def reply(self, switch, xid, msg):
+        entry = self.inflight_xids.get((switch, xid))
+        if entry is None:
+            return None
+        entry.parts.append(msg)
+        if len(msg) < MULTIPART_OFFSET + MULTIPART_HEADER.size or \
+                not MULTIPART_HEADER.unpack_from(msg, MULTIPART_OFFSET)[1] & OFPMPF_MORE:
+            del self.inflight_xids[(switch, xid)]
+            del self.inflight[entry.key]
+            if self.cache_ttl > 0:
+                self.cache[entry.key] = (entry.parts, time.time())
+        return [(target, with_xid(msg, waiter_xid)) for target, waiter_xid in entry.waiters]
+
+    def expire(self, now):
+        deadline = now - self.cache_ttl
+        while self.cache:
+            key = next(iter(self.cache))
+            if self.cache[key][1] > deadline:
+                break
+            del self.cache[key]
+        deadline = now - self.request_timeout
+        for own, entry in [(own, entry) for own, entry in self.inflight_xids.items() if entry.sent <= deadline]:
+            del self.inflight_xids[own]
+            del self.inflight[entry.key]
+            self.expired += 1
+
+    # the switch is gone, so are its requests and cached replies
+    def forget(self, switch):
+        for own in [own for own in self.inflight_xids if own[0] == switch]:
+            del self.inflight[self.inflight_xids.pop(own).key]
+        for key in [key for key in self.cache if key[0] == switch]:
+            del self.cache[key]
+
+    def metrics(self):
+        return {"sent": self.sent, "joined": self.joined, "cache_hits": self.cache_hits,
+                "inflight": len(self.inflight), "cached": len(self.cache), "expired": self.expired}
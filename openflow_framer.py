@@ -0,0 +1,199 @@
+import struct
+
+'''
+Stream framers shared by the switch, controller and tunnel protocols
+
+A framer keeps the bytes of one TCP stream and splits them into complete messages.
+Instead of reslicing the whole buffer after every message, it walks an offset over
+the buffer and only compacts it once per read, so a read full of small packet_ins
+costs linear copying. Each complete message is copied out exactly once.
+
+OpenFlow header:   >bbHI  version, type, length (including this header), xid
+
+Tunnel v1 frame, one OpenFlow message per frame:
+struct header {
+    unit64_t datapath_ID;               /* Datapath ID associated with this packet. */
+    unit16_t length;                    /* Length not including this header. */
+}
+
+Tunnel v2 frame, a batch of v1 records (header + OpenFlow message) per frame:
+struct v2_header {
+    unit8_t  version;                   /* TUNNEL_VERSION_2 */
+    unit8_t  flags;                     /* Reserved, 0. */
+    unit16_t count;                     /* Number of records in this frame. */
+    unit32_t length;                    /* Length of the records not including this header. */
+}
+
+Negotiation: each side speaks v1 until it has sent a SWITCH marker, and every frame
+after the marker is v2. The scheduler opens the tunnel with an OFFER, a proxy that
+understands v2 answers with its own SWITCH, and the scheduler then sends its SWITCH.
+Both markers are v1 frames with datapath_ID 0 carrying an OpenFlow EXPERIMENTER
+message, which a v1 proxy drops as a protocol error, so old proxies keep working.
+
+Stripes: a scheduler with several tunnels to one proxy sends a STRIPE marker, also
+with datapath_ID 0, on each of them: the group id shared by the tunnels, the index of
+this tunnel and the number of tunnels in the group (see tunnel_stripes.py).
+'''
+
+OFP_HEADER = struct.Struct(">bbHI")
+TUNNEL_HEADER = struct.Struct(">QH")
+TUNNEL_V2_HEADER = struct.Struct(">BBHI")
+DPID = struct.Struct(">Q")
+
+TUNNEL_VERSION_1 = 1
+TUNNEL_VERSION_2 = 2
+TUNNEL_V2_MAX_COUNT = 65535
+
+OFPT_EXPERIMENTER = 4
+TUNNEL_EXPERIMENTER = 0x0074756e     # "\0tun"
+TUNNEL_OFFER = 1                     # sender understands the version in the body
+TUNNEL_SWITCH = 2                    # every frame after this one uses the version in the body
+TUNNEL_STRIPE = 3                    # the tunnel is one stripe of a group
+TUNNEL_CONTROL = struct.Struct(">bbHIIII")   # OpenFlow header, experimenter, exp_type, version
+TUNNEL_STRIPE_CONTROL = struct.Struct(">bbHIIIIHH")     # OpenFlow header, experimenter, exp_type, group, index, count
+
+
+# OpenFlow EXPERIMENTER message used for tunnel negotiation, sent with datapath_ID 0
+def tunnel_control_msg(exp_type, version):
+    return TUNNEL_CONTROL.pack(4, OFPT_EXPERIMENTER, TUNNEL_CONTROL.size, 0,
+                               TUNNEL_EXPERIMENTER, exp_type, version)
+
+
+# (exp_type, version) if the message is a tunnel negotiation message, otherwise None
+def parse_tunnel_control(msg):
+    if len(msg) != TUNNEL_CONTROL.size:
+        return None
+    fields = TUNNEL_CONTROL.unpack(msg)
+    if fields[1] != OFPT_EXPERIMENTER or fields[4] != TUNNEL_EXPERIMENTER:
+        return None
+    return fields[5], fields[6]
+
+
+def tunnel_stripe_msg(group, index, count):
+    return TUNNEL_STRIPE_CONTROL.pack(4, OFPT_EXPERIMENTER, TUNNEL_STRIPE_CONTROL.size, 0,
+                                      TUNNEL_EXPERIMENTER, TUNNEL_STRIPE, group, index, count)
+
+
+# (group, index, count) if the message is a STRIPE marker, otherwise None
+def parse_tunnel_stripe(msg):
+    if len(msg) != TUNNEL_STRIPE_CONTROL.size:
+        return None
+    fields = TUNNEL_STRIPE_CONTROL.unpack(msg)
+    if fields[1] != OFPT_EXPERIMENTER or fields[4] != TUNNEL_EXPERIMENTER or fields[5] != TUNNEL_STRIPE:
+        return None
+    return fields[6], fields[7], fields[8]
+
+
+class StreamFramer(object):
+    header = None
+    compact_threshold = 65536   # compact the buffer once this many consumed bytes sit in front of it
+
+    def __init__(self):
+        self.data_buffer = bytearray()
+        self.offset = 0
+
+    # number of bytes of the frame starting with the unpacked header
+    def frame_length(self, header):
+        raise NotImplementedError
+
+    # append the objects handed to the service for the frame at view[start:end]
+    def make_messages(self, header, view, start, end, msgs):
+        raise NotImplementedError
+
+    def pending_bytes(self):
+        return len(self.data_buffer) - self.offset
+
+    # append the new data and return every complete message in it as one batch
+    def feed(self, data):
+        if self.data_buffer:
+            self.data_buffer.extend(data)
+            buf = self.data_buffer
+            pos = self.offset
+        else:           # nothing left from the previous read, parse the new data in place
+            buf = data
+            pos = 0
+        end = len(buf)
+        msgs = []
+        view = memoryview(buf)
+        try:
+            while True:
+                header_struct = self.header     # may change between frames when a tunnel switches version
+                if end - pos < header_struct.size:
+                    break
+                header = header_struct.unpack_from(buf, pos)
+                length = self.frame_length(header)
+                if length < header_struct.size:
+                    raise ValueError("Bad frame length %d at offset %d" % (length, pos))
+                if end - pos < length:
+                    break
+                self.make_messages(header, view, pos, pos + length, msgs)
+                pos += length
+            leftover = view[pos:end].tobytes() if buf is not self.data_buffer and pos < end else None
+        finally:
+            del view
+
+        if buf is self.data_buffer:
+            if pos == end:
+                del self.data_buffer[:]
+                self.offset = 0
+            else:
+                self.offset = pos
+                if pos >= self.compact_threshold or pos > end - pos:
+                    del self.data_buffer[:pos]
+                    self.offset = 0
+        elif leftover is not None:
+            self.data_buffer.extend(leftover)
+            self.offset = 0
+        return msgs
+
+
+# OpenFlow messages from switches or controllers, handed out with their OpenFlow header
+class OpenFlowFramer(StreamFramer):
+    header = OFP_HEADER
+
+    def frame_length(self, header):
+        return header[2]
+
+    def make_messages(self, header, view, start, end, msgs):
+        msgs.append(view[start:end].tobytes())
+
+
+# Tunnel frames between the scheduler and the proxy, handed out as (dpid, openflow message)
+# v1 frames are parsed until the peer's SWITCH marker arrives, v2 frames afterwards
+class TunnelFramer(StreamFramer):
+    header = TUNNEL_HEADER
+    version = TUNNEL_VERSION_1
+
+    def frame_length(self, header):
+        if self.version == TUNNEL_VERSION_1:
+            return header[1] + TUNNEL_HEADER.size
+        return header[3] + TUNNEL_V2_HEADER.size
+
+    def make_messages(self, header, view, start, end, msgs):
+        if self.version == TUNNEL_VERSION_1:
+            msg = view[start + TUNNEL_HEADER.size:end].tobytes()
+            msgs.append((header[0], msg))
+            if header[0] == 0:
+                control = parse_tunnel_control(msg)
+                if control is not None and control[0] == TUNNEL_SWITCH:
+                    self.switch_version(control[1])
+            return
+        if header[0] != TUNNEL_VERSION_2:
+            raise ValueError("Unknown tunnel frame version %d" % header[0])
+        pos = start + TUNNEL_V2_HEADER.size
+        for i in range(header[2]):
+            dpid, length = TUNNEL_HEADER.unpack_from(view, pos)
+            pos += TUNNEL_HEADER.size
+            msgs.append((dpid, view[pos:pos + length].tobytes()))
+            pos += length
+        if pos != end:
+            raise ValueError("Tunnel v2 frame records end at %d instead of %d" % (pos, end))
+
+    def switch_version(self, version):
+        if version == TUNNEL_VERSION_1:
+            self.header = TUNNEL_HEADER
+        elif version == TUNNEL_VERSION_2:
+            self.header = TUNNEL_V2_HEADER
+        else:
+            raise ValueError("Unknown tunnel version %d" % version)
+        self.version = version
@@ -0,0 +1,203 @@
+from zope.interface import implementer
+from twisted.internet.interfaces import IPullProducer
+from twisted.internet import reactor
+
+from collections import deque
+
+from openflow_framer import TUNNEL_HEADER, TUNNEL_V2_HEADER, TUNNEL_VERSION_1, TUNNEL_VERSION_2, TUNNEL_V2_MAX_COUNT
+from flow_control import transport_buffered_bytes
+
+'''
+Output accumulator for one connection
+
+Writes made while handling a reactor iteration are gathered in a list and handed to
+the transport with a single writeSequence, so a burst of small messages leaves as a
+few large segments instead of one syscall/segment per message.
+
+max_delay:  seconds the first buffered write may wait for company,
+            0 flushes at the end of the current reactor iteration
+max_bytes:  flush immediately once this many bytes are buffered
+
+A tunnel writer switched to version 2 wraps the records of each flush in one v2 frame,
+such a writer must only be used through write_tunnel.
+
+PriorityWriter sorts the writes of a flush into lanes instead, see below.
+'''
+
+LANE_CONTROL = 0     # hello, echo, role: order-insensitive, never held back
+LANE_TOPOLOGY = 1    # LLDP/ARP packet_ins and packet_outs, topology discovery
+LANE_BULK = 2        # every other packet_in, packet_out and flow_mod
+LANE_FENCE = -1      # barrier, *_MOD and the rest: never held back, but after everything written before
+
+
+class CoalescingWriter(object):
+
+    def __init__(self, transport, max_delay=0, max_bytes=65536, clock=None):
+        self.transport = transport
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.clock = clock or reactor
+        self.chunks = []
+        self.buffered_bytes = 0
+        self.delayed_flush = None
+        self.flushes = 0
+        self.writes = 0
+        self.tunnel_version = TUNNEL_VERSION_1
+        self.records = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered_bytes += len(data)
+        self.writes += 1
+        self.schedule_flush()
+
+    # header and payload are buffered as two chunks, no concatenation needed
+    # a broadcast packs the header once and passes it to every tunnel
+    def write_tunnel(self, dpid, msg, header=None):
+        if header is None:
+            header = TUNNEL_HEADER.pack(dpid, len(msg))
+        self.chunks.append(header)
+        self.chunks.append(msg)
+        self.buffered_bytes += TUNNEL_HEADER.size + len(msg)
+        self.writes += 1
+        self.records += 1
+        if self.records >= TUNNEL_V2_MAX_COUNT:
+            self.flush()
+        else:
+            self.schedule_flush()
+
+    # frames already buffered leave in the old version, later ones in the new one
+    def set_tunnel_version(self, version):
+        self.flush()
+        self.tunnel_version = version
+
+    def schedule_flush(self):
+        if self.buffered_bytes >= self.max_bytes:
+            self.flush()
+        elif self.delayed_flush is None:
+            self.delayed_flush = self.clock.callLater(self.max_delay, self.flush)
+
+    def flush(self):
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        if self.chunks:
+            chunks = self.chunks
+            if self.tunnel_version == TUNNEL_VERSION_2:
+                chunks.insert(0, TUNNEL_V2_HEADER.pack(TUNNEL_VERSION_2, 0, self.records, self.buffered_bytes))
+            self.chunks = []
+            self.buffered_bytes = 0
+            self.records = 0
+            self.flushes += 1
+            self.transport.writeSequence(chunks)
+
+    # drop whatever is still buffered, the connection is gone
+    def close(self):
+        if self.delayed_flush is not None and self.delayed_flush.active():
+            self.delayed_flush.cancel()
+        self.delayed_flush = None
+        self.chunks = []
+        self.buffered_bytes = 0
+        self.records = 0
+
+
+# Writes of one connection in priority lanes. The control lane always goes out at once,
+# the other lanes only while the transport holds less than backlog_limit bytes, so under
+# load the transport never buffers more bulk than that in front of an urgent message.
+# Held writes go out when the transport drains (it calls resumeProducing), highest lane
+# first, or weighted by deficit round-robin when quanta (bytes per lane per round) are given.
+# A write to LANE_FENCE takes everything queued in any lane before it along, in front of it,
+# so a BARRIER_REQUEST or FLOW_MOD never overtakes what the controller sent earlier.
+@implementer(IPullProducer)
+class PriorityWriter(object):
+
+    def __init__(self, transport, backlog_limit=65536, quanta=None, lanes=3, clock=None):
+        if quanta is not None and any(quantum <= 0 for quantum in quanta[LANE_CONTROL + 1:lanes]):
+            raise ValueError("Lane quanta must be positive, got %s" % (quanta,))
+        self.transport = transport
+        self.backlog_limit = backlog_limit
+        self.quanta = quanta
+        self.clock = clock or reactor
+        self.queues = [deque() for lane in range(lanes)]
+        self.fenced = []            # writes up to the last fence, they go out first and in this order
+        self.deficits = [0] * lanes
+        self.queued_bytes = 0
+        self.delayed_flush = None
+        self.flushes = 0
+        self.writes = [0] * lanes
+        transport.registerProducer(self, False)
+
+    def write(self, data, lane=LANE_BULK):
+        if lane == LANE_FENCE:
+            for queue in self.queues:
+                self.fenced.extend(queue)
+                queue.clear()
+            self.fenced.append(data)
+            lane = LANE_CONTROL
+        else:
+            self.queues[lane].append(data)
+        self.queued_bytes += len(data)
+        self.writes[lane] += 1
+        if self.delayed_flush is None:
+            self.delayed_flush = self.clock.callLater(0, self.flush)
+
+    def flush(self):
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        chunks = self.fenced
+        self.fenced = []
+        chunks.extend(self.queues[LANE_CONTROL])
+        self.queues[LANE_CONTROL].clear()
+        room = self.backlog_limit - transport_buffered_bytes(self.transport)
+        if self.quanta is None:
+            room = self.take_strict(chunks, room)
+        else:
+            room = self.take_weighted(chunks, room)
+        if chunks:
+            self.queued_bytes -= sum(len(chunk) for chunk in chunks)
+            self.flushes += 1
+            self.transport.writeSequence(chunks)
+
+    def take_strict(self, chunks, room):
+        for queue in self.queues[LANE_CONTROL + 1:]:
+            while queue and room > 0:
+                data = queue.popleft()
+                chunks.append(data)
+                room -= len(data)
+        return room
+
+    def take_weighted(self, chunks, room):
+        lanes = range(LANE_CONTROL + 1, len(self.queues))
+        while room > 0 and any(self.queues[lane] for lane in lanes):
+            for lane in lanes:
+                queue = self.queues[lane]
+                if not queue:
+                    self.deficits[lane] = 0
+                    continue
+                self.deficits[lane] += self.quanta[lane]
+                while queue and len(queue[0]) <= self.deficits[lane] and room > 0:
+                    data = queue.popleft()
+                    chunks.append(data)
+                    self.deficits[lane] -= len(data)
+                    room -= len(data)
+        return room
+
+    # the transport sent everything it had, pass on what was held
+    def resumeProducing(self):
+        if self.queued_bytes:
+            self.flush()
+
+    def stopProducing(self):
+        self.close()
+
+    def close(self):
+        if self.delayed_flush is not None and self.delayed_flush.active():
+            self.delayed_flush.cancel()
+        self.delayed_flush = None
+        self.fenced = []
+        for queue in self.queues:
+            queue.clear()
+        self.queued_bytes = 0
@@ -0,0 +1,189 @@
+from collections import namedtuple
+import struct
+
+'''
+Field extraction straight from the bytes of an OpenFlow 1.3 packet_in
+
+packet_in:
+    header 8, buffer_id 4, total_len 2, reason 1, table_id 1, cookie 8
+    match: type 2, length 2, OXM fields, padded to a multiple of 8 bytes
+    pad 2
+    the Ethernet frame
+
+packet_out:
+    header 8, buffer_id 4, in_port 4, actions_len 2, pad 6, actions, the Ethernet frame
+
+match (packet_in, FLOW_MOD):
+    type 2, length 2, OXM fields (class 2, field 7 bits, has_mask 1 bit, length 1, value, mask)
+'''
+
+PACKET_IN_MATCH_OFFSET = 24
+PACKET_OUT_ACTIONS_LEN_OFFSET = 16
+PACKET_OUT_ACTIONS_OFFSET = 24
+MATCH_HEADER = struct.Struct(">HH")
+UINT8 = struct.Struct(">B")
+UINT16 = struct.Struct(">H")
+UINT32 = struct.Struct(">I")
+OXM_HEADER = struct.Struct(">I")
+OXM_IN_PORT = 0x80000004           # OFPXMC_OPENFLOW_BASIC, OFPXMT_OFB_IN_PORT, 4 bytes
+OFPXMC_OPENFLOW_BASIC = 0x8000
+OXM_IP_PROTO = 10
+OXM_IPV4_SRC, OXM_IPV4_DST, OXM_IPV6_SRC, OXM_IPV6_DST = 11, 12, 26, 27
+OXM_IP_ADDRESSES = ((OXM_IPV4_SRC, OXM_IPV4_DST), (OXM_IPV6_SRC, OXM_IPV6_DST))
+OXM_L4_PORTS = {6: (13, 14), 17: (15, 16), 132: (17, 18)}     # IP protocol: (src, dst) OXM fields
+
+ETH_TYPE_IPV4 = 0x0800
+ETH_TYPE_IPV6 = 0x86dd
+ETH_TYPE_ARP = 0x0806
+ETH_TYPE_LLDP = 0x88cc
+VLAN_ETH_TYPES = (0x8100, 0x88a8)
+TOPOLOGY_ETH_TYPES = (ETH_TYPE_LLDP, ETH_TYPE_ARP)
+PORT_PROTOCOLS = (6, 17, 132)     # TCP, UDP, SCTP
+IPV4_HEADER = struct.Struct(">BxxxxxHxBxx4s4s")   # version/IHL, flags/fragment offset, protocol, src, dst
+IPV6_HEADER = struct.Struct(">xxxxxxBx16s16s")    # next header, src, dst
+L4_PORTS = struct.Struct(">HH")
+PORT_FLOW_KEYS = {4: struct.Struct(">B4s4sHH"), 16: struct.Struct(">B16s16sHH")}   # by address length
+
+# fields of an Ethernet frame, ip_src/ip_dst are the raw 4 or 16 address bytes,
+# None where the frame has no such field
+PacketFields = namedtuple("PacketFields", "eth_type vlan ip_src ip_dst ip_proto l4_src l4_dst")
+
+
+# offset of the Ethernet frame inside a packet_in
+def packet_in_data_offset(msg):
+    match_length = MATCH_HEADER.unpack_from(msg, PACKET_IN_MATCH_OFFSET)[1]
+    return PACKET_IN_MATCH_OFFSET + (match_length + 7) // 8 * 8 + 2
+
+
+# offset of the Ethernet frame inside a packet_out, len(msg) for buffered packets
+def packet_out_data_offset(msg):
+    return PACKET_OUT_ACTIONS_OFFSET + UINT16.unpack_from(msg, PACKET_OUT_ACTIONS_LEN_OFFSET)[0]
+
+
+# Ethernet type, outer VLAN id and offset of the layer 3 header of the frame at offset eth,
+# behind any VLAN tags. The one place the tags are walked, (None, None, None) if it is truncated
+def frame_header(msg, eth):
+    end = len(msg)
+    pos = eth + 12
+    if pos + 2 > end:
+        return None, None, None
+    eth_type = UINT16.unpack_from(msg, pos)[0]
+    vlan = None
+    while eth_type in VLAN_ETH_TYPES and pos + 6 <= end:
+        if vlan is None:
+            vlan = UINT16.unpack_from(msg, pos + 2)[0] & 0x0fff
+        pos += 4
+        eth_type = UINT16.unpack_from(msg, pos)[0]
+    return eth_type, vlan, pos + 2
+
+
+# Ethernet type of the frame at offset eth, behind any VLAN tags, None if it is truncated
+def frame_eth_type(msg, eth):
+    return frame_header(msg, eth)[0]
+
+
+# the ingress port from the packet_in's match, None if the switch left it out
+def packet_in_in_port(msg):
+    pos = PACKET_IN_MATCH_OFFSET + MATCH_HEADER.size
+    end = min(len(msg), PACKET_IN_MATCH_OFFSET + MATCH_HEADER.unpack_from(msg, PACKET_IN_MATCH_OFFSET)[1])
+    while pos + OXM_HEADER.size <= end:
+        oxm = OXM_HEADER.unpack_from(msg, pos)[0]
+        if oxm == OXM_IN_PORT and pos + 8 <= end:
+            return UINT32.unpack_from(msg, pos + 4)[0]
+        pos += OXM_HEADER.size + (oxm & 0xff)
+    return None
+
+
+# bytes identifying the flow of a packet_in: IP protocol, addresses and L4 ports,
+# or the Ethernet addresses and type for non-IP frames. The switch is not part of it,
+# so the same flow seen by different switches has the same key.
+def flow_key(msg):
+    return frame_flow_key(msg, packet_in_data_offset(msg))
+
+
+# flow_key of the frame at offset eth, of a packet_in or a packet_out
+def frame_flow_key(msg, eth):
+    key = fields_flow_key(classify_frame(msg, eth))
+    if key is None:
+        return msg[eth:eth + 14]
+    return key
+
+
+# the IP part of flow_key, None for non-IP frames
+def ip_flow_key(msg, eth=None):
+    if eth is None:
+        eth = packet_in_data_offset(msg)
+    return fields_flow_key(classify_frame(msg, eth))
+
+
+# the IP part of flow_key from the fields classify_frame found
+def fields_flow_key(fields):
+    eth_type, vlan, src, dst, protocol, l4_src, l4_dst = fields
+    if src is None:
+        return None
+    if l4_src is None:
+        return UINT8.pack(protocol) + src + dst
+    return PORT_FLOW_KEYS[len(src)].pack(protocol, src, dst, l4_src, l4_dst)
+
+
+# the IP flow_key of the packets the OXM match at offset selects, None unless the match pins the
+# IP protocol, both addresses and, for TCP/UDP/SCTP, both ports, all without a mask
+def match_flow_key(msg, offset):
+    end = min(len(msg), offset + MATCH_HEADER.unpack_from(msg, offset)[1])
+    pos = offset + MATCH_HEADER.size
+    values = {}
+    while pos + OXM_HEADER.size <= end:
+        oxm = OXM_HEADER.unpack_from(msg, pos)[0]
+        value = pos + OXM_HEADER.size
+        pos = value + (oxm & 0xff)
+        if oxm >> 16 == OFPXMC_OPENFLOW_BASIC and not oxm & 0x100 and pos <= end:
+            values[(oxm >> 9) & 0x7f] = msg[value:pos]
+    protocol = values.get(OXM_IP_PROTO)
+    if protocol is None or len(protocol) != UINT8.size:
+        return None
+    for src, dst in OXM_IP_ADDRESSES:
+        if src in values and dst in values:
+            key = protocol + values[src] + values[dst]
+            break
+    else:
+        return None
+    ports = OXM_L4_PORTS.get(UINT8.unpack(protocol)[0])
+    if ports is None:
+        return key
+    if ports[0] not in values or ports[1] not in values:
+        return None
+    return key + values[ports[0]] + values[ports[1]]
+
+
+# ethertype, outer VLAN id, IPv4/IPv6 addresses, protocol and L4 ports of the frame at offset eth
+def classify_frame(msg, eth):
+    end = len(msg)
+    eth_type, vlan, l3 = frame_header(msg, eth)
+    if eth_type == ETH_TYPE_IPV4 and l3 + IPV4_HEADER.size <= end:
+        version_ihl, fragment, protocol, src, dst = IPV4_HEADER.unpack_from(msg, l3)
+        l4 = l3 + (version_ihl & 0x0f) * 4
+        if protocol in PORT_PROTOCOLS and fragment & 0x1fff == 0 and l4 + 4 <= end:
+            l4_src, l4_dst = L4_PORTS.unpack_from(msg, l4)
+            return PacketFields(eth_type, vlan, src, dst, protocol, l4_src, l4_dst)
+        return PacketFields(eth_type, vlan, src, dst, protocol, None, None)
+    if eth_type == ETH_TYPE_IPV6 and l3 + IPV6_HEADER.size <= end:
+        protocol, src, dst = IPV6_HEADER.unpack_from(msg, l3)
+        l4 = l3 + IPV6_HEADER.size
+        if protocol in PORT_PROTOCOLS and l4 + 4 <= end:
+            l4_src, l4_dst = L4_PORTS.unpack_from(msg, l4)
+            return PacketFields(eth_type, vlan, src, dst, protocol, l4_src, l4_dst)
+        return PacketFields(eth_type, vlan, src, dst, protocol, None, None)
+    return PacketFields(eth_type, vlan, None, None, None, None, None)
+
+
+def classify_packet_in(msg):
+    return classify_frame(msg, packet_in_data_offset(msg))
+
+
+def classify_packet_out(msg):
+    return classify_frame(msg, packet_out_data_offset(msg))
+
+
+# LLDP or ARP, the packet_ins the master needs for topology discovery
+def is_topology_packet_in(msg):
+    return frame_eth_type(msg, packet_in_data_offset(msg)) in TOPOLOGY_ETH_TYPES
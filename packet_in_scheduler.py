@@ -0,0 +1,489 @@
+from collections import OrderedDict
+import json
+import logging
+import os
+import random
+import struct
+import time
+import zlib
+
+from packet_classifier import flow_key, frame_flow_key, match_flow_key, packet_out_data_offset
+
+'''
+Packet_in scheduling over the tunnels (scheduler_modify.py) or the controller
+connections of a switch (sch.py), both called targets here
+
+A PacketInScheduler holds every policy a deployment may use and lets one of them pick
+the target of each packet_in. The others keep receiving the hooks, so switching policy
+at runtime (set_policy, or a change of the policy file) starts with warm state.
+
+Policy interface:
+    select(switch, packet_in, candidates)           the target for this packet_in
+    on_request(switch, packet_in, target)           the packet_in was forwarded to target
+    on_response(switch, target, response_time)      its PACKET_OUT/FLOW_MOD came back
+    on_dropped(switch, target, expired)             superseded, taken for another target, or never answered in time
+    on_connect(target) / on_disconnect(target)
+
+A packet_in is answered by the controller's PACKET_OUT(13) or FLOW_MOD(14) with the same
+buffer_id coming back through the target. Unbuffered packet_ins are matched by flow instead:
+switches send them with xid 0 and controllers answer with xids of their own, so an answer
+is the PACKET_OUT carrying a frame of the same flow, or the FLOW_MOD whose match pins it.
+Targets are mapped to the controller they belong to by `key`, statistics are kept per
+controller.
+
+Policy file (JSON), re-read whenever it changes:
+    {"policy": "weighted_round_robin", "weights": {"192.168.56.101": 3}}
+'''
+
+OFP_NO_BUFFER = 0xffffffff
+BUFFER_ID = struct.Struct(">I")
+PACKET_IN_BUFFER_ID_OFFSET = 8
+PACKET_OUT_BUFFER_ID_OFFSET = 8
+FLOW_MOD_BUFFER_ID_OFFSET = 32
+FLOW_MOD_MATCH_OFFSET = 48
+
+
+# key matching a packet_in with the controller's answer: (switch, buffer_id) for a buffered
+# packet_in, (switch, OFP_NO_BUFFER, flow_key) for an unbuffered one
+def packet_in_request_key(switch, msg):
+    buffer_id = BUFFER_ID.unpack_from(msg, PACKET_IN_BUFFER_ID_OFFSET)[0]
+    if buffer_id != OFP_NO_BUFFER:
+        return switch, buffer_id
+    return switch, buffer_id, flow_key(msg)
+
+
+# the request key a PACKET_OUT(13) or FLOW_MOD(14) answers, None for a truncated message,
+# an unbuffered PACKET_OUT without a frame or an unbuffered FLOW_MOD not pinning one flow
+def response_request_key(switch, type, msg):
+    offset = PACKET_OUT_BUFFER_ID_OFFSET if type == 13 else FLOW_MOD_BUFFER_ID_OFFSET
+    if len(msg) < offset + BUFFER_ID.size:
+        return None
+    buffer_id = BUFFER_ID.unpack_from(msg, offset)[0]
+    if buffer_id != OFP_NO_BUFFER:
+        return switch, buffer_id
+    if type == 13:
+        eth = packet_out_data_offset(msg)
+        key = frame_flow_key(msg, eth) if eth + 14 <= len(msg) else None
+    else:
+        key = match_flow_key(msg, FLOW_MOD_MATCH_OFFSET) if len(msg) > FLOW_MOD_MATCH_OFFSET + 4 else None
+    if key is None:
+        return None
+    return switch, buffer_id, key
+
+
+# what a policy gets to know about a packet_in
+class PacketIn(object):
+    __slots__ = ("msg", "xid", "special")
+
+    def __init__(self, msg, xid, special=False):
+        self.msg = msg
+        self.xid = xid
+        self.special = special      # LLDP/ARP, topology discovery
+
+
+class SchedulingPolicy(object):
+    name = None
+    key = staticmethod(lambda target: target)
+
+    def select(self, switch, packet_in, candidates):
+        raise NotImplementedError
+
+    def on_request(self, switch, packet_in, target):
+        pass
+
+    def on_response(self, switch, target, response_time):
+        pass
+
+    def on_dropped(self, switch, target, expired):
+        pass
+
+    def on_connect(self, target):
+        pass
+
+    def on_disconnect(self, target):
+        pass
+
+    # settings from the policy file
+    def configure(self, config):
+        pass
+
+
+# (mtime, config) of the policy file, config is None unless the file changed since mtime
+def read_policy_file(path, mtime):
+    try:
+        modified = os.path.getmtime(path)
+    except OSError:
+        return mtime, None
+    if modified == mtime:
+        return mtime, None
+    try:
+        with open(path) as f:
+            return modified, json.load(f)
+    except (IOError, ValueError) as e:
+        logging.error("Unable to read policy file %s: %s" % (path, e))
+        return modified, None
+
+
+class PacketInScheduler(object):
+
+    def __init__(self, policies, active, key=None, timeout=1.0):
+        self.timeout = timeout
+        self.policies = OrderedDict()
+        for policy in policies:
+            if key is not None:
+                policy.key = key
+            self.policies[policy.name] = policy
+        self.policy = self.policies[active]
+        self.pending = OrderedDict() # pending = { sequence: (switch, target, sent time, PacketIn, request key) }, oldest first
+        self.waiting = {}            # waiting = { request key: [sequence, ...] }, oldest first
+        self.sequence = 0
+        self.expired = 0
+        self.policy_file = None
+        self.policy_file_mtime = None
+
+    def set_policy(self, name, config=None):
+        if name not in self.policies:
+            logging.error("Unknown scheduling policy %s, keeping %s" % (name, self.policy.name))
+            return False
+        self.policy = self.policies[name]
+        if config is not None:
+            self.policy.configure(config)
+        logging.info("Scheduling policy: %s" % name)
+        return True
+
+    # polled by the service, applies the policy file whenever it was modified
+    def check_policy_file(self):
+        self.policy_file_mtime, config = read_policy_file(self.policy_file, self.policy_file_mtime)
+        if config is not None:
+            self.apply_config(config)
+
+    # {"policy": name, ...} read from the policy file, or handed over by a worker supervisor
+    def apply_config(self, config):
+        self.set_policy(config.get("policy", self.policy.name), config)
+
+    def select(self, switch, packet_in, candidates):
+        if not candidates:
+            return None
+        return self.policy.select(switch, packet_in, candidates)
+
+    def on_connect(self, target):
+        for policy in self.policies.values():
+            policy.on_connect(target)
+
+    def on_disconnect(self, target):
+        for policy in self.policies.values():
+            policy.on_disconnect(target)
+
+    # the packet_in from switch was forwarded to target, whichever way target was chosen
+    def on_request(self, switch, packet_in, target):
+        now = time.time()
+        self.expire(now)
+        key = packet_in_request_key(switch, packet_in.msg)
+        waiting = self.waiting.setdefault(key, [])
+        if waiting and len(key) == 2:   # a retransmitted buffered packet_in, the old request is superseded
+            self.dropped(self.pending.pop(waiting.pop()), False)
+        # unbuffered packet_ins of one flow are each pending, every answer takes the oldest
+        self.sequence += 1
+        waiting.append(self.sequence)
+        self.pending[self.sequence] = (switch, target, now, packet_in, key)
+        for policy in self.policies.values():
+            policy.on_request(switch, packet_in, target)
+
+    # a PACKET_OUT(13) or FLOW_MOD(14) for switch came back from the controller behind target
+    def on_response(self, switch, type, msg, target):
+        waiting = self.waiting.get(response_request_key(switch, type, msg))
+        if not waiting:
+            return
+        for sequence in waiting:
+            entry = self.pending[sequence]
+            if entry[1] is target:
+                self.forget(sequence, entry)
+                response_time = time.time() - entry[2]
+                for policy in self.policies.values():
+                    policy.on_response(switch, target, response_time)
+                return
+
+    # the packet_ins target has not answered yet, [(switch, PacketIn)] oldest first, for
+    # another target to answer: target is gone or no longer answers
+    def take(self, target):
+        taken = []
+        for sequence, entry in list(self.pending.items()):
+            if entry[1] is target:
+                self.forget(sequence, entry)
+                self.dropped(entry, False)
+                taken.append((entry[0], entry[3]))
+        return taken
+
+    def expire(self, now):
+        pending = self.pending
+        deadline = now - self.timeout
+        while pending:
+            sequence = next(iter(pending))
+            entry = pending[sequence]
+            if entry[2] > deadline:
+                return
+            self.forget(sequence, entry)
+            self.expired += 1
+            self.dropped(entry, True)
+
+    def forget(self, sequence, entry):
+        del self.pending[sequence]
+        waiting = self.waiting[entry[4]]
+        waiting.remove(sequence)
+        if not waiting:
+            del self.waiting[entry[4]]
+
+    def dropped(self, entry, expired):
+        for policy in self.policies.values():
+            policy.on_dropped(entry[0], entry[1], expired)
+
+
+'''
+=======================================================================================
+Built-in policies
+=======================================================================================
+'''
+
+
+class RoundRobinPolicy(SchedulingPolicy):
+    name = "round_robin"
+
+    def __init__(self):
+        self.rr = 0
+
+    def select(self, switch, packet_in, candidates):
+        self.rr = (self.rr + 1) % len(candidates)
+        return candidates[self.rr]
+
+
+# smooth weighted round-robin, weights per controller from the policy file, 1 by default
+class WeightedRoundRobinPolicy(SchedulingPolicy):
+    name = "weighted_round_robin"
+
+    def __init__(self, weights=None):
+        self.weights = weights or {}
+        self.current = {}
+
+    def configure(self, config):
+        self.weights = config.get("weights", self.weights)
+        self.current = {}
+
+    def select(self, switch, packet_in, candidates):
+        total = 0
+        best = None
+        best_weight = None
+        for target in candidates:
+            controller = self.key(target)
+            weight = self.weights.get(controller, 1)
+            current = self.current.get(controller, 0) + weight
+            self.current[controller] = current
+            total += weight
+            if best is None or current > best_weight:
+                best = target
+                best_weight = current
+        self.current[self.key(best)] -= total
+        return best
+
+
+# every packet_in to the switch's master controller, masters = { switch: master target }
+class MasterOnlyPolicy(SchedulingPolicy):
+    name = "master_only"
+
+    def __init__(self, masters):
+        self.masters = masters
+
+    def select(self, switch, packet_in, candidates):
+        master = self.masters.get(switch)
+        if master is None:
+            logging.error("Packet_in can't find master, so We get a random one")
+            return candidates[0]
+        return master
+
+
+class RandomPolicy(SchedulingPolicy):
+    name = "random"
+
+    def select(self, switch, packet_in, candidates):
+        return random.choice(candidates)
+
+
+# the controller with the fewest unanswered packet_ins, round-robin on ties
+class LeastOutstandingPolicy(SchedulingPolicy):
+    name = "least_outstanding"
+
+    def __init__(self):
+        self.rr = 0                  # round-robin factor among the least loaded targets
+        self.inflight = {}           # inflight = { controller: number of unanswered packet_ins }
+
+    def select(self, switch, packet_in, candidates):
+        candidate_num = len(candidates)
+        best_index = None
+        best_count = None
+        for i in range(1, candidate_num + 1):
+            index = (self.rr + i) % candidate_num
+            count = self.inflight.get(self.key(candidates[index]), 0)
+            if best_index is None or count < best_count:
+                best_index = index
+                best_count = count
+                if count == 0:
+                    break
+        self.rr = best_index
+        return candidates[best_index]
+
+    def on_request(self, switch, packet_in, target):
+        controller = self.key(target)
+        self.inflight[controller] = self.inflight.get(controller, 0) + 1
+
+    def on_response(self, switch, target, response_time):
+        self.release(target)
+
+    def on_dropped(self, switch, target, expired):
+        self.release(target)
+
+    def release(self, target):
+        controller = self.key(target)
+        count = self.inflight.get(controller)
+        if count:
+            self.inflight[controller] = count - 1
+
+
+# response time estimate of one controller, smoothed like TCP's srtt/rttvar
+class ResponseTimeEstimate(object):
+
+    def __init__(self):
+        self.mean = 0.0
+        self.deviation = 0.0
+        self.samples = 0
+
+    def add(self, sample, alpha, beta):
+        if self.samples == 0:
+            self.mean = sample
+            self.deviation = sample / 2
+        else:
+            error = sample - self.mean
+            self.mean += alpha * error
+            self.deviation += beta * (abs(error) - self.deviation)
+        self.samples += 1
+
+    def expected(self):
+        return self.mean + self.deviation
+
+
+# the controller with the lowest expected response time, with some exploration
+class EwmaLatencyPolicy(SchedulingPolicy):
+    name = "latency"
+
+    def __init__(self, timeout=1.0, alpha=0.125, beta=0.25, explore=0.05):
+        self.timeout = timeout       # an unanswered packet_in counts as a response after this long
+        self.alpha = alpha
+        self.beta = beta
+        self.explore = explore       # probability of sending a packet_in to a random controller
+        self.estimates = {}          # estimates = { controller: ResponseTimeEstimate }
+
+    def configure(self, config):
+        self.explore = config.get("explore", self.explore)
+
+    def on_disconnect(self, target):
+        self.estimates.pop(self.key(target), None)
+
+    # controllers never measured come first
+    def select(self, switch, packet_in, candidates):
+        if random.random() < self.explore:
+            return random.choice(candidates)
+        best = None
+        best_time = None
+        for target in candidates:
+            estimate = self.estimates.get(self.key(target))
+            if estimate is None:
+                return target
+            expected = estimate.expected()
+            if best is None or expected < best_time:
+                best = target
+                best_time = expected
+        return best
+
+    def on_response(self, switch, target, response_time):
+        self.sample(target, response_time)
+
+    def on_dropped(self, switch, target, expired):
+        if expired:
+            self.sample(target, self.timeout)
+
+    def sample(self, target, response_time):
+        controller = self.key(target)
+        estimate = self.estimates.get(controller)
+        if estimate is None:
+            estimate = self.estimates[controller] = ResponseTimeEstimate()
+        estimate.add(response_time, self.alpha, self.beta)
+
+
+# murmur3's 32 bit finalizer, spreads a hash over all bits
+def mix32(h):
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+# rendezvous hashing of the packet_in's flow: every packet_in of a flow reaches the same
+# controller and only 1/N of the flows move when a controller joins or leaves
+class FlowAffinityPolicy(SchedulingPolicy):
+    name = "flow_hash"
+
+    def __init__(self, cache_size=65536):
+        self.cache_size = cache_size
+        self.cache = OrderedDict()   # cache = { flow key: controller }, least recently used first
+        self.seeds = {}              # seeds = { controller: hash seed }
+        self.members = {}            # members = { controller: number of connected targets }
+
+    def on_connect(self, target):
+        controller = self.key(target)
+        self.members[controller] = self.members.get(controller, 0) + 1
+        if self.members[controller] == 1:    # a new controller takes over its share of the flows
+            self.cache.clear()
+
+    def on_disconnect(self, target):
+        controller = self.key(target)
+        count = self.members.get(controller, 0)
+        if count <= 1:
+            self.members.pop(controller, None)
+            self.cache.clear()
+        else:
+            self.members[controller] = count - 1
+
+    def select(self, switch, packet_in, candidates):
+        flow = flow_key(packet_in.msg)
+        controller = self.cache.pop(flow, None)
+        target = None
+        if controller is not None:
+            for candidate in candidates:
+                if self.key(candidate) == controller:
+                    target = candidate
+                    break
+        if target is None:
+            target = self.rendezvous(flow, candidates)
+            controller = self.key(target)
+        self.cache[flow] = controller
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return target
+
+    # the target whose controller scores highest for this flow
+    def rendezvous(self, flow, candidates):
+        flow_hash = zlib.crc32(flow) & 0xffffffff
+        best = None
+        best_score = -1
+        for target in candidates:
+            score = mix32(flow_hash ^ self.seed(self.key(target)))
+            if score > best_score:
+                best = target
+                best_score = score
+        return best
+
+    def seed(self, controller):
+        seed = self.seeds.get(controller)
+        if seed is None:
+            seed = self.seeds[controller] = zlib.crc32(str(controller).encode()) & 0xffffffff
+        return seed
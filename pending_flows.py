@@ -0,0 +1,134 @@
+from collections import OrderedDict
+import struct
+
+from packet_classifier import ip_flow_key, packet_in_in_port, packet_in_data_offset
+from packet_in_scheduler import packet_in_request_key, response_request_key
+from packet_in_scheduler import BUFFER_ID, PACKET_IN_BUFFER_ID_OFFSET, OFP_NO_BUFFER
+
+'''
+Duplicate packet_in suppression while a flow setup is pending
+
+Until the controller's FLOW_MOD reaches the switch, every packet of a new flow misses
+the table and raises another packet_in. The first packet_in of an IP flow is forwarded
+and opens a pending flow (dpid, flow key); later packet_ins of the same flow are held
+instead of being forwarded. When the PACKET_OUT/FLOW_MOD answering the first one comes
+back (same buffer_id, or for an unbuffered packet_in a frame or match of the same flow,
+whatever its xid), the held packets are sent back to the switch in a PACKET_OUT to
+OFPP_TABLE, so they go through the flow table that now knows the flow (or, if the
+controller installed nothing, raise a fresh packet_in). A pending flow that is not
+answered in time hands its held packet_ins back for forwarding to the controller.
+
+With hold=False the duplicates are dropped instead (the switch frees their buffers).
+'''
+
+OFPP_TABLE = 0xfffffff9
+OFPP_CONTROLLER = 0xfffffffd
+PACKET_OUT_HEADER = struct.Struct(">bbHIIIH6x")     # header, buffer_id, in_port, actions_len
+ACTION_OUTPUT = struct.Struct(">HHIH6x")            # type, len, port, max_len
+
+
+# PACKET_OUT sending the packet of a packet_in through the switch's flow table again
+def reinject_msg(packet_in, xid):
+    buffer_id = BUFFER_ID.unpack_from(packet_in, PACKET_IN_BUFFER_ID_OFFSET)[0]
+    in_port = packet_in_in_port(packet_in)
+    if in_port is None:
+        in_port = OFPP_CONTROLLER
+    data = packet_in[packet_in_data_offset(packet_in):] if buffer_id == OFP_NO_BUFFER else b''
+    length = PACKET_OUT_HEADER.size + ACTION_OUTPUT.size + len(data)
+    return PACKET_OUT_HEADER.pack(4, 13, length, xid, buffer_id, in_port, ACTION_OUTPUT.size) + \
+        ACTION_OUTPUT.pack(0, ACTION_OUTPUT.size, OFPP_TABLE, 0) + data
+
+
+class PendingFlow(object):
+    __slots__ = ("request", "sent", "held")
+
+    def __init__(self, request, sent):
+        self.request = request      # request key of the forwarded packet_in
+        self.sent = sent
+        self.held = []              # held = [ (xid, packet_in) ]
+
+
+class PendingFlowTable(object):
+
+    def __init__(self, timeout=0.5, hold=True, max_held=64):
+        self.timeout = timeout
+        self.hold = hold
+        self.max_held = max_held    # a pending flow holding this many lets the next duplicates through
+        self.flows = OrderedDict()  # flows = { (dpid, flow key): PendingFlow }, oldest first
+        self.requests = {}          # requests = { request key: (dpid, flow key) }
+        # counters
+        self.opened = 0
+        self.held_total = 0
+        self.suppressed = 0
+        self.released = 0
+        self.expired = 0
+
+    # (dpid, flow key) of the packet_in, None for flows that are never deduplicated (non-IP)
+    def flow(self, dpid, msg):
+        key = ip_flow_key(msg)
+        if key is None:
+            return None
+        return dpid, key
+
+    # True if the packet_in belongs to a pending flow and was held or suppressed
+    def absorb(self, flow, xid, msg):
+        entry = self.flows.get(flow)
+        if entry is None:
+            return False
+        if not self.hold:
+            self.suppressed += 1
+            return True
+        if len(entry.held) >= self.max_held:
+            return False
+        entry.held.append((xid, msg))
+        self.held_total += 1
+        return True
+
+    # the packet_in opening flow was forwarded to the controller
+    def add(self, flow, xid, msg, now):
+        if flow in self.flows:
+            return
+        request = packet_in_request_key(flow[0], msg)
+        self.flows[flow] = PendingFlow(request, now)
+        self.requests[request] = flow
+        self.opened += 1
+
+    # a PACKET_OUT(13) or FLOW_MOD(14) passed back to switch dpid, returns the packet_ins
+    # held for the flow it answers
+    def on_response(self, dpid, type, msg):
+        flow = self.requests.pop(response_request_key(dpid, type, msg), None)
+        if flow is None:
+            return []
+        held = self.flows.pop(flow).held
+        self.released += len(held)
+        return held
+
+    # close flows pending for longer than timeout, returns their held packet_ins as (dpid, xid, msg)
+    def expire(self, now):
+        released = []
+        deadline = now - self.timeout
+        while self.flows:
+            flow = next(iter(self.flows))
+            entry = self.flows[flow]
+            if entry.sent > deadline:
+                break
+            del self.flows[flow]
+            self.drop_request(flow, entry)
+            self.expired += 1
+            for xid, msg in entry.held:
+                released.append((flow[0], xid, msg))
+        return released
+
+    # the switch is gone, so are its pending flows
+    def forget(self, dpid):
+        for flow in [flow for flow in self.flows if flow[0] == dpid]:
+            self.drop_request(flow, self.flows.pop(flow))
+
+    # a retransmitted packet_in may have moved the request key to another flow
+    def drop_request(self, flow, entry):
+        if self.requests.get(entry.request) == flow:
+            del self.requests[entry.request]
+
+    def metrics(self):
+        return {"pending": len(self.flows), "opened": self.opened, "held": self.held_total,
+                "suppressed": self.suppressed, "released": self.released, "expired": self.expired}
@@ -0,0 +1,84 @@
+import time
+
+'''
+Messages for a dpid whose controller connection is still being opened
+
+The proxy opens the controller connection of a dpid on the switch's HELLO; what the
+tunnel brings for that dpid before the connection is made is kept here, at most `limit`
+messages per dpid, and handed back in arrival order once it is up. A message over the
+limit, or queued for a connection that failed, is dropped and counted.
+'''
+
+
+class PendingQueue(object):
+
+    def __init__(self, limit=256):
+        self.limit = limit
+        self.queues = {}        # queues = { dpid: ([ messages ], time the connection was started) }
+        self.dropped = 0
+        self.flushed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+        self.connections = 0
+
+    def __contains__(self, dpid):
+        return dpid in self.queues
+
+    # False if a connection for dpid is already being opened
+    def start(self, dpid):
+        if dpid in self.queues:
+            return False
+        self.queues[dpid] = ([], time.time())
+        return True
+
+    # False if the message was dropped, or dpid has no connection being opened
+    def add(self, dpid, msg):
+        entry = self.queues.get(dpid)
+        if entry is None:
+            return False
+        msgs = entry[0]
+        if len(msgs) >= self.limit:
+            self.dropped += 1
+            return False
+        msgs.append(msg)
+        self.max_depth = max(self.max_depth, len(msgs))
+        return True
+
+    # the connection of dpid is up: its queued messages, oldest first
+    def release(self, dpid):
+        entry = self.queues.pop(dpid, None)
+        if entry is None:
+            return []
+        msgs, started = entry
+        wait = time.time() - started
+        self.max_wait = max(self.max_wait, wait)
+        self.total_wait += wait
+        self.connections += 1
+        self.flushed += len(msgs)
+        return msgs
+
+    # the connection of dpid could not be opened, its queued messages are lost
+    def fail(self, dpid):
+        entry = self.queues.pop(dpid, None)
+        if entry is None:
+            return
+        self.failed += 1
+        self.dropped += len(entry[0])
+
+    def depth(self, dpid):
+        entry = self.queues.get(dpid)
+        return len(entry[0]) if entry is not None else 0
+
+    def metrics(self):
+        now = time.time()
+        return {"connecting": len(self.queues),
+                "queued": sum(len(msgs) for msgs, started in self.queues.values()),
+                "oldest_wait": max([now - started for msgs, started in self.queues.values()] or [0.0]),
+                "max_depth": self.max_depth,
+                "flushed": self.flushed,
+                "dropped": self.dropped,
+                "failed": self.failed,
+                "max_wait": self.max_wait,
+                "mean_wait": self.total_wait / self.connections if self.connections else 0.0}
@@ -3,11 +3,21 @@ from twisted.internet.protocol import ClientFactory
 from twisted.internet.protocol import ServerFactory
 
 from twisted.internet import reactor
+from twisted.internet.address import UNIXAddress
 
 import struct
 import logging
 import random
 
+from openflow_framer import OpenFlowFramer, TunnelFramer
+from openflow_framer import tunnel_control_msg, parse_tunnel_control, parse_tunnel_stripe
+from openflow_framer import TUNNEL_OFFER, TUNNEL_SWITCH, TUNNEL_VERSION_1, TUNNEL_VERSION_2
+from openflow_writer import CoalescingWriter
+from connection_registry import ConnectionRegistry
+from pending_queue import PendingQueue
+from shm_ring import listen_ring, connect_ring, start_rings
+from tunnel_stripes import StripeGroup, pick_stripe
+
 
 logging.basicConfig(level=logging.INFO)
 
@@ -16,8 +26,7 @@ logging.basicConfig(level=logging.INFO)
 class OpenFlowTunnelProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = TunnelFramer()
 
     def connectionMade(self):
         self.factory.add_tunnelConnection(self)
@@ -29,66 +38,35 @@ class OpenFlowTunnelProtocol(Protocol):
         logging.info("Losing a tunnel connection")
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.debug("Receiving new data from switch %d, buffer data %d" % (len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 10:
-                    # logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">QH", self.data_buffer[:10])
-                #logging.debug("DPID:%s length:%s" % parsed_header)
-                self.pending_bytes = parsed_header[1] + 10
-
-            if self.pending_bytes > available_bytes:
-                # logging.debug("Waiting switch entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.forward_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        frames = self.framer.feed(data)
+        # logging.debug("Receiving new data from tunnel %d, %d msgs, buffer data %d" % (len(data), len(frames), self.framer.pending_bytes()))
+        if frames:
+            self.factory.forward_openflow_batch(frames, self)
 
 
 # Handle Connections between Tunnels and Controllers
 class OpenFlowClientProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = OpenFlowFramer()
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.d
-        # ebug("Receiving new data from controller %d, buffer data %d"%(len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 8:
-                    #logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">bbHI", self.data_buffer[:8])
-                #logging.debug("Controller Msg Version:%d Type:%d Length:%d ID:%d" % parsed_header)
-                self.pending_bytes = parsed_header[2]
-
-            if self.pending_bytes > available_bytes:
-                #logging.debug("Waiting controller entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_controller_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        msgs = self.framer.feed(data)
+        # logging.debug("Receiving new data from controller %d, %d msgs, buffer data %d"%(len(data), len(msgs), self.framer.pending_bytes()))
+        if msgs:
+            self.factory.handle_controller_openflow_batch(msgs, self)
 
     def connectionMade(self):
         logging.info("Connecting to a controller!")
-        self.transport.setTcpNoDelay(True)
-        self.factory.add_controllerConnection(self, self.factory.dpid)
+        if not isinstance(self.transport.getPeer(), UNIXAddress):
+            self.transport.setTcpNoDelay(True)
         type = 0
         xid = random.randint(2,65534)
         version = 4
         length = 8
         reply_msg = struct.pack(">bbHI", version, type, length, xid)
         self.transport.write(reply_msg)
+        self.factory.add_controllerConnection(self, self.factory.dpid)     # after our HELLO, it flushes the pending messages
 
     def connectionLost(self, reason):
         logging.info("Losting a controller!")
@@ -97,32 +75,122 @@ class OpenFlowClientProtocol(Protocol):
 
 
 class OpenFlowService():
-    tunnel = None
-
-    dpid_controller = {}
-    controller_dpid = {}
+    WRITE_MAX_DELAY = 0       # seconds a tunnel write may wait to be coalesced, 0 flushes once per reactor iteration
+    WRITE_MAX_BYTES = 65536   # flush the tunnel output at once when this many bytes are waiting
+    TUNNEL_VERSION = TUNNEL_VERSION_2   # highest tunnel framing accepted from a scheduler's offer
+    PENDING_LIMIT = 256       # messages kept for a dpid while its controller connection is opened
+    CONTROLLER_TRANSPORT = "tcp"    # "tcp", or "unix"/"ring" for a colocated controller or adapter listening on CONTROLLER_SOCKET
+    CONTROLLER_HOST = "localhost"
+    CONTROLLER_PORT = 6633
+    CONTROLLER_SOCKET = "/tmp/openflow_controller.sock"
+    CONTROLLER_RING_CAPACITY = 1 << 16      # bytes per direction of the ring to the controller, 2 rings per dpid
+    TUNNEL_RING = None        # Unix socket path for schedulers on this host, tunnels over shared-memory rings
+    ORPHAN_TIMEOUT = 30.0     # seconds the controller connection of a dpid waits for a tunnel to bring the dpid back
+
+    connections = ConnectionRegistry()     # tunnels and controller connections, { dpid: controller } and back
+    dpid_tunnel = {}    # dpid_tunnel = { dpid: tunnel its switch is behind }, one per scheduler or scheduler worker
+    tunnel_dpids = {}   # tunnel_dpids = { tunnel: set of the dpids behind it }
+    orphans = {}        # orphans = { dpid whose tunnel is gone: delayed call closing its controller connection }
+    stripe_groups = {}  # stripe_groups = { group id: StripeGroup }, the tunnels a scheduler stripes its switches over
+    pending = PendingQueue(PENDING_LIMIT)  # messages for the dpids whose controller connection is not made yet
 
     def add_tunnelConnection(self, conn):
-        self.tunnel = conn
-
+        conn.address = conn.transport.getPeer().host
+        conn.writer = CoalescingWriter(conn.transport, self.WRITE_MAX_DELAY, self.WRITE_MAX_BYTES)
+        self.connections.add_tunnel(conn)
+        self.tunnel_dpids[conn] = set()
+        conn.stripe_group = None
+
+    # the other schedulers keep going. The dpids behind a stripe move to the stripe their
+    # scheduler picks for them too. Otherwise the controller connections of the dpids stay
+    # open for ORPHAN_TIMEOUT, in case their switches come back through a tunnel
     def remove_tunnelConnection(self, conn):
-        self.tunnel = None
-        logging.info("Shutting down the tunnel!!!")
-        reactor.stop()
+        conn.writer.close()
+        self.connections.remove(conn)
+        group = conn.stripe_group
+        if group is not None:
+            group.remove(conn)
+            if len(group) == 0:
+                del self.stripe_groups[group.id]
+        dpids = self.tunnel_dpids.pop(conn, ())
+        for dpid in dpids:
+            del self.dpid_tunnel[dpid]
+            if group is not None and len(group) > 0:
+                self.route_dpid(dpid, group.stripes[pick_stripe(dpid, group.stripes)])
+            elif self.connections.connection(dpid) is not None or dpid in self.pending:
+                self.orphans[dpid] = reactor.callLater(self.ORPHAN_TIMEOUT, self.close_orphan, dpid)
+        logging.info("Lost the tunnel from %s with %d dpids, %d tunnels left"
+                     % (conn.address, len(dpids), len(self.connections.tunnels)))
+
+    # dpid is behind tunnel from now on
+    def route_dpid(self, dpid, tunnel):
+        current = self.dpid_tunnel.get(dpid)
+        if current is tunnel:
+            return
+        if current is not None:     # a switch reconnected through another scheduler
+            self.tunnel_dpids[current].discard(dpid)
+        self.dpid_tunnel[dpid] = tunnel
+        self.tunnel_dpids[tunnel].add(dpid)
+        orphan = self.orphans.pop(dpid, None)
+        if orphan is not None and orphan.active():
+            orphan.cancel()
+
+    # no tunnel brought dpid back, the controller sees its switch go
+    def close_orphan(self, dpid):
+        if dpid in self.pending:    # not connected yet, look again once it is
+            self.orphans[dpid] = reactor.callLater(self.ORPHAN_TIMEOUT, self.close_orphan, dpid)
+            return
+        del self.orphans[dpid]
+        controller = self.connections.connection(dpid)
+        if controller is not None:
+            logging.info("No tunnel for dpid:%d, closing its controller connection" % dpid)
+            controller.transport.loseConnection()
+
+    def tunnel_metrics(self):
+        return {"tunnels": [{"address": tunnel.address, "dpids": len(dpids)} for tunnel, dpids in self.tunnel_dpids.items()],
+                "orphans": len(self.orphans)}
 
     def add_controllerConnection(self, conn, dpid):
-        self.dpid_controller[dpid] = conn
-        self.controller_dpid[conn] = dpid
+        self.connections.add_controller(conn, dpid=dpid)
+        msgs = self.pending.release(dpid)
+        if msgs:
+            logging.debug("Flushing %d pending msgs to controller, dpid:%d" % (len(msgs), dpid))
+            conn.transport.write(b''.join(msgs))
+
+    # one controller connection per dpid, whatever the transport
+    def connect_controller(self, dpid):
+        clientF = self.getOpenFlowClientFactory(dpid)
+        logging.debug("Established a connection to controller")
+        if self.CONTROLLER_TRANSPORT == "unix":
+            reactor.connectUNIX(self.CONTROLLER_SOCKET, clientF)
+        elif self.CONTROLLER_TRANSPORT == "ring":
+            connect_ring(self.CONTROLLER_SOCKET, clientF, self.CONTROLLER_RING_CAPACITY)
+        else:
+            reactor.connectTCP(self.CONTROLLER_HOST, self.CONTROLLER_PORT, clientF)
+
+    def controller_connection_failed(self, dpid, reason):
+        logging.error("Unable to connect to controller for dpid:%s, dropping %d pending msgs: %s"
+                      % (dpid, self.pending.depth(dpid), reason.getErrorMessage()))
+        self.pending.fail(dpid)
+
+    def pending_metrics(self):
+        return self.pending.metrics()
 
     def remove_controllerConnection(self, conn, dpid):
-        if dpid in self.dpid_controller:
-            print "Losing a connection, removing conn and dpid"
-            conn = self.dpid_controller[dpid]
-            del self.dpid_controller[dpid]
-            del self.controller_dpid[conn]
+        if conn in self.connections:
+            print("Losing a connection, removing conn and dpid")
+            self.connections.remove(conn)
+            orphan = self.orphans.pop(dpid, None)
+            if orphan is not None and orphan.active():
+                orphan.cancel()
         else:
             logging.debug("Unable to remove dpid non-exist")
 
+    # a batch holds every complete message of one read from the controller
+    def handle_controller_openflow_batch(self, msgs, conn):
+        for msg in msgs:
+            self.handle_controller_openflow_msg(msg, conn)
+
     def handle_controller_openflow_msg(self, msg, conn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
         # logging.debug("Controller Msg Version:%d Type:%d Length:%d ID:%d" % openflow_header)
@@ -148,43 +216,92 @@ class OpenFlowService():
                 role_msg = "Master"
             elif role == 3:
                 role_msg = "Slave"
-            logging.info("Role_request: change role to %s generation_id: %d DPID: %d==================================" % (role_msg, generation_id, self.controller_dpid[conn]))
+            logging.info("Role_request: change role to %s generation_id: %d DPID: %d==================================" % (role_msg, generation_id, self.connections.dpid(conn)))
             # role = 2
             role_reply = struct.pack(">bbHIIIQ", version, type+1, length, xid, role, padding, generation_id)
-            conn.transport.write(str(role_reply))
+            conn.transport.write(role_reply)
             logging.debug("Role_reply: change role to Master")
 
-        elif conn in self.dpid_controller.values():
-            dpid = self.controller_dpid[conn]
-            header = struct.pack(">QH", dpid, length)
-            msg = header+msg
+        elif self.connections.dpid(conn) in self.dpid_tunnel:
+            dpid = self.connections.dpid(conn)
             logging.debug("Controller===>Tunnel, type:%s, dpid:%d, xid:%d" % (type, dpid, xid))
-            self.tunnel.transport.write(str(msg))
+            self.dpid_tunnel[dpid].writer.write_tunnel(dpid, msg)
+        elif self.connections.dpid(conn) in self.orphans:
+            logging.debug("Dropping controller msg type:%s for dpid:%d, its tunnel is gone" % (type, self.connections.dpid(conn)))
         else:
             logging.error("Unexpected Error for handling controller msg: no dpid")
 
-    def forward_openflow_msg(self, msg, conn):
+    # a batch holds every complete (dpid, msg) frame of one read from the tunnel
+    def forward_openflow_batch(self, frames, conn):
+        for dpid, msg in frames:
+            self.forward_openflow_msg(dpid, msg, conn)
+
+    # a scheduler offering v2 gets our SWITCH, every frame we send after it is v2
+    def handle_tunnel_control(self, control, conn):
+        exp_type, version = control
+        if exp_type == TUNNEL_OFFER and version == TUNNEL_VERSION_2 and self.TUNNEL_VERSION == TUNNEL_VERSION_2 \
+                and conn.writer.tunnel_version == TUNNEL_VERSION_1:
+            conn.writer.write_tunnel(0, tunnel_control_msg(TUNNEL_SWITCH, TUNNEL_VERSION_2))
+            conn.writer.set_tunnel_version(TUNNEL_VERSION_2)
+            logging.info("Tunnel to scheduler switched to protocol version %d" % version)
+        elif exp_type == TUNNEL_SWITCH:
+            logging.info("Tunnel from scheduler switched to protocol version %d" % version)
+        else:
+            logging.debug("Ignoring tunnel control type:%d version:%d" % control)
+
+    def forward_openflow_msg(self, dpid, msg, conn):
         #print "Len %d"%(len(msg))
-        openflow_header = struct.unpack(">QHbbHI", msg[:18])
-        dpid = openflow_header[0]
-        type = openflow_header[3]
+        if dpid == 0:
+            control = parse_tunnel_control(msg)
+            if control is not None:
+                self.handle_tunnel_control(control, conn)
+                return
+            stripe = parse_tunnel_stripe(msg)
+            if stripe is not None:
+                self.handle_tunnel_stripe(stripe, conn)
+                return
+            openflow_header = struct.unpack(">bbHI", msg[:8])
+            if openflow_header[1] == 2:     # the scheduler's heartbeat for the tunnel, answered on dpid 0
+                reply = struct.pack(">bbHI", openflow_header[0], 3, openflow_header[2], openflow_header[3]) + msg[8:]
+                conn.writer.write_tunnel(0, reply)
+                return
+        openflow_header = struct.unpack(">bbHI", msg[:8])
+        type = openflow_header[1]
+        self.route_dpid(dpid, conn)     # a reconnecting switch may come through another scheduler
         # logging.debug("Tunnel Msg Version: Type:%d DPID:%d" % (type, dpid))
-        if dpid not in self.dpid_controller:
+        controller = self.connections.connection(dpid)
+        if controller is None:
             if type == 0:
-                clientF = self.getOpenFlowClientFactory(dpid)
-                logging.debug("Established a connection to controller")
-                reactor.connectTCP("localhost", 6633, clientF)
+                if self.pending.start(dpid):
+                    self.connect_controller(dpid)
+            elif dpid in self.pending:
+                if not self.pending.add(dpid, msg):
+                    logging.warning("Pending queue full, dropping type:%s dpid:%s xid:%d" % (type, dpid, openflow_header[3]))
             else:
-                logging.error("Protocol error!!!!! Type:%s dpid:%s xid:%d"%(type,dpid,openflow_header[5]))
-        elif dpid in self.dpid_controller:
+                logging.error("Protocol error!!!!! Type:%s dpid:%s xid:%d"%(type,dpid,openflow_header[3]))
+        elif type == 0:     # a scheduler announcing its switch again, over a new tunnel
+            logging.debug("Controller connection of dpid:%d kept" % dpid)
+        else:
             logging.debug("Tunnel===>Controller, type:%s, dpid:%d"%( type, dpid))
-            self.dpid_controller[dpid].transport.write(str(msg[10:]))
+            controller.transport.write(msg)
+
 
+    # the tunnel is one of the stripes a scheduler spreads its switches over
+    def handle_tunnel_stripe(self, stripe, conn):
+        group_id, index, count = stripe
+        group = self.stripe_groups.get(group_id)
+        if group is None:
+            group = self.stripe_groups[group_id] = StripeGroup(conn.address, count, group_id)
+        if group.add(conn, index) is None:
+            logging.error("Tunnel from %s claims stripe %d of group %x, which has %d" % (conn.address, index, group_id, group.count))
+            return
+        conn.stripe_group = group
+        logging.info("Tunnel from %s is stripe %d of %d" % (conn.address, index, count))
 
     def getOpenFlowServerFactory(self):
         f = ServerFactory()
         f.protocol = OpenFlowTunnelProtocol
-        f.forward_openflow_msg = self.forward_openflow_msg
+        f.forward_openflow_batch = self.forward_openflow_batch
         f.add_tunnelConnection = self.add_tunnelConnection
         f.remove_tunnelConnection = self.remove_tunnelConnection
         return f
@@ -194,13 +311,24 @@ class OpenFlowService():
         f.protocol = OpenFlowClientProtocol
         f.dpid = dpid
         f.add_controllerConnection = self.add_controllerConnection
-        f.handle_controller_openflow_msg = self.handle_controller_openflow_msg
+        f.handle_controller_openflow_batch = self.handle_controller_openflow_batch
         f.remove_controllerConnection = self.remove_controllerConnection
+        f.clientConnectionFailed = lambda connector, reason: self.controller_connection_failed(dpid, reason)
         return f
 
 
 
-s = OpenFlowService()
-reactor.listenTCP(9999, s.getOpenFlowServerFactory())
-logging.info("Start running server")
-reactor.run()
\ No newline at end of file
+# listen for the schedulers' tunnels; the caller runs the reactor
+def start_proxy(s, port=9999):
+    if s.CONTROLLER_TRANSPORT == "ring":     # refused now rather than at the first switch
+        start_rings()
+    reactor.listenTCP(port, s.getOpenFlowServerFactory())
+    if s.TUNNEL_RING is not None:
+        listen_ring(s.TUNNEL_RING, s.getOpenFlowServerFactory())
+
+
+if __name__ == "__main__":
+    s = OpenFlowService()
+    start_proxy(s)
+    logging.info("Start running server")
+    reactor.run()
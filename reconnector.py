@@ -0,0 +1,85 @@
+from twisted.internet import reactor
+
+import random
+import time
+
+'''
+Connections made again after they are lost, with exponential backoff
+
+A connection that was lost, or could not be made, is tried again after
+initial * factor ** failures seconds (failures in a row, at most `maximum` seconds),
+spread by +-`jitter` so that the connections to a restarted controller do not all come
+back in the same instant. A connection that stayed up for `stable` seconds clears its
+failures, one that is lost right after being made keeps backing off.
+
+Connections are identified by a key, the client factory of the connection in practice,
+and made again by the callable handed to lost()/failed().
+'''
+
+
+class Reconnector(object):
+
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.2, stable=10.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.stable = stable
+        self.failures = {}          # failures = { key: failures in a row }
+        self.connected_at = {}      # connected_at = { key: time the connection was made }
+        self.retries = {}           # retries = { key: delayed call making the connection again }
+        # counters
+        self.attempts = 0
+        self.reconnections = 0
+
+    # the connection of key is up, True if it was up before: a reconnection
+    def connected(self, key):
+        self.retries.pop(key, None)
+        again = key in self.connected_at
+        if again:
+            self.reconnections += 1
+        self.connected_at[key] = time.time()
+        return again
+
+    # the connection of key was lost, connect() is called after the backoff
+    def lost(self, key, connect):
+        up = self.connected_at.get(key)
+        if up is not None and time.time() - up >= self.stable:
+            self.failures.pop(key, None)
+        return self.retry(key, connect)
+
+    # the connection of key could not be made
+    def failed(self, key, connect):
+        return self.retry(key, connect)
+
+    # seconds until connect() is called
+    def retry(self, key, connect):
+        failures = self.failures.get(key, 0)
+        self.failures[key] = failures + 1
+        delay = min(self.maximum, self.initial * self.factor ** failures)
+        delay *= 1.0 + random.uniform(-self.jitter, self.jitter)
+        self.cancel(key)
+        self.retries[key] = reactor.callLater(delay, self.attempt, key, connect)
+        return delay
+
+    def attempt(self, key, connect):
+        del self.retries[key]
+        self.attempts += 1
+        connect()
+
+    def cancel(self, key):
+        retry = self.retries.pop(key, None)
+        if retry is not None and retry.active():
+            retry.cancel()
+
+    # the connection of key is not wanted anymore
+    def stop(self, key):
+        self.cancel(key)
+        self.failures.pop(key, None)
+        self.connected_at.pop(key, None)
+
+    def metrics(self):
+        return {"retrying": len(self.retries),
+                "max_failures": max(list(self.failures.values()) or [0]),
+                "attempts": self.attempts,
+                "reconnections": self.reconnections}
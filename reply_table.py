@@ -0,0 +1,115 @@
+from collections import deque
+import logging
+import time
+
+'''
+Requests waiting for the switch's reply, keyed by (switch, request type, xid)
+
+Every tracked request also sits in a hashed timer wheel: `wheel_size` slots of `tick`
+seconds each, a request lands in the slot of its deadline and is checked when the wheel
+turns past that slot (deadlines more than one revolution away stay for later turns).
+The wheel turns lazily on every track/pop, so requests the switch never answers are
+dropped after `timeout` seconds at O(1) cost per request, counted per request type.
+A request answered in time is not looked for in the wheel, its slot entry is skipped
+when the slot comes up.
+'''
+
+
+class ReplyEntry(object):
+    __slots__ = ("target", "deadline")
+
+    def __init__(self, target, deadline):
+        self.target = target        # connection the reply goes back to
+        self.deadline = deadline    # tick after which the request is dropped
+
+
+class ReplyTable(object):
+
+    def __init__(self, timeout=30.0, tick=1.0, wheel_size=64):
+        self.timeout = timeout
+        self.tick = tick
+        self.wheel_size = wheel_size
+        self.slots = [[] for i in range(wheel_size)]    # slots = [ [(key, ReplyEntry)] ]
+        self.current_tick = int(time.time() / tick)
+        self.entries = {}           # entries = { (switch, type, xid): deque of ReplyEntry, oldest first }
+        # counters
+        self.tracked = 0
+        self.answered = 0
+        self.expired = 0
+        self.timeouts = {}          # timeouts = { request type: number of requests never answered }
+
+    def __len__(self):
+        return len(self.entries)
+
+    # a request of this type and xid was sent to the switch for target
+    def track(self, switch, type, xid, target):
+        now_tick = self.turn(time.time())
+        key = (switch, type, xid)
+        entry = ReplyEntry(target, now_tick + int(self.timeout / self.tick) + 1)
+        pool = self.entries.get(key)
+        if pool is None:
+            pool = self.entries[key] = deque()
+        pool.append(entry)
+        self.slots[entry.deadline % self.wheel_size].append((key, entry))
+        self.tracked += 1
+
+    # the target waiting for the reply to request type/xid, None if there is none.
+    # more=True leaves the request in place, a multipart reply with more parts to come
+    def pop(self, switch, type, xid, more=False):
+        self.turn(time.time())
+        key = (switch, type, xid)
+        pool = self.entries.get(key)
+        if not pool:
+            return None
+        if more:
+            return pool[0].target
+        entry = pool.popleft()
+        if not pool:
+            del self.entries[key]
+        self.answered += 1
+        return entry.target
+
+    # the switch is gone, so are the requests waiting for it
+    def forget(self, switch):
+        for key in [key for key in self.entries if key[0] == switch]:
+            del self.entries[key]
+
+    # expire the requests of every slot passed since the last turn, returns the current tick
+    def turn(self, now):
+        now_tick = int(now / self.tick)
+        first = max(self.current_tick + 1, now_tick - self.wheel_size + 1)
+        for tick in range(first, now_tick + 1):
+            index = tick % self.wheel_size
+            slot = self.slots[index]
+            if not slot:
+                continue
+            remaining = []
+            for key, entry in slot:
+                if entry.deadline > now_tick:
+                    remaining.append((key, entry))
+                else:
+                    self.expire(key, entry)
+            self.slots[index] = remaining
+        if now_tick > self.current_tick:
+            self.current_tick = now_tick
+        return self.current_tick
+
+    def expire(self, key, entry):
+        pool = self.entries.get(key)
+        if not pool:
+            return
+        for pending in pool:
+            if pending is entry:
+                pool.remove(pending)
+                break
+        else:
+            return      # answered in time
+        if not pool:
+            del self.entries[key]
+        self.expired += 1
+        self.timeouts[key[1]] = self.timeouts.get(key[1], 0) + 1
+        logging.debug("No reply to request type %d xid %d from switch %s" % (key[1], key[2], key[0]))
+
+    def metrics(self):
+        return {"waiting": len(self.entries), "tracked": self.tracked, "answered": self.answered,
+                "expired": self.expired, "timeouts": dict(self.timeouts)}
@@ -3,10 +3,10 @@ from twisted.internet.protocol import ClientFactory
 from twisted.internet.protocol import ServerFactory
 
 from twisted.internet import reactor
+from twisted.internet import task
 
-from scapy.layers.l2 import Ether
-from scapy.layers.inet import UDP, TCP
 import time
+from collections import OrderedDict
 
 from twink.ofp4 import parse
 import traceback
@@ -14,23 +14,28 @@ import traceback
 import struct
 import logging
 import random
-import sys
+
+from openflow_framer import OpenFlowFramer
+from openflow_writer import PriorityWriter, LANE_CONTROL, LANE_TOPOLOGY, LANE_BULK, LANE_FENCE
+from packet_classifier import frame_eth_type, packet_out_data_offset, is_topology_packet_in, TOPOLOGY_ETH_TYPES
+from admission_control import PacketInAdmission
+from reply_table import ReplyTable
+from multipart_coalescer import MultipartCoalescer
+from connection_registry import ConnectionRegistry
+from packet_in_scheduler import PacketInScheduler, PacketIn
+from packet_in_scheduler import RoundRobinPolicy, WeightedRoundRobinPolicy, MasterOnlyPolicy, RandomPolicy
+from packet_in_scheduler import LeastOutstandingPolicy, EwmaLatencyPolicy, FlowAffinityPolicy
+from failure_detector import FailureDetector
+from reconnector import Reconnector
 
 # logging.basicConfig(level=logging.DEBUG)
 logging.basicConfig(level=logging.ERROR)
 
 
-# The program will exit when an exception happens
-def exit_fwst():
-    reactor.stop()
-    sys.exit(1)
-
-
 # Server: Handle the connections from switches
 class OpenFlowServerProtocol(Protocol):
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = ''
+        self.framer = OpenFlowFramer()
 
     def connectionMade(self):
         self.factory.add_switchConnection(self)
@@ -41,72 +46,89 @@ class OpenFlowServerProtocol(Protocol):
         logging.info("Losing a switch connection!")
 
     def dataReceived(self, data):
-        self.data_buffer += data
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 8:
-                    return
-                parsed_header = struct.unpack(">bbHI", self.data_buffer[:8])
-                self.pending_bytes = parsed_header[2]
-            if self.pending_bytes > available_bytes:
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_switch_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        msgs = self.framer.feed(data)
+        if msgs:
+            self.factory.handle_switch_openflow_batch(msgs, self)
 
 
 # Client: Handle the connections from controllers
 class OpenFlowClientProtocol(Protocol):
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = ''
+        self.framer = OpenFlowFramer()
 
     def dataReceived(self, data):
-        self.data_buffer += data
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 8:
-                    return
-                parsed_header = struct.unpack(">bbHI", self.data_buffer[:8])
-                self.pending_bytes = parsed_header[2]
-            if self.pending_bytes > available_bytes:
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_controller_openflow_msg(openflow_msg, self, self.factory.switchConn)
-            self.pending_bytes = 0
+        msgs = self.framer.feed(data)
+        if msgs:
+            self.factory.handle_controller_openflow_batch(msgs, self, self.factory.switchConn)
 
     def connectionMade(self):
         logging.info("Connecting to a controller!")
         self.transport.setTcpNoDelay(True)
         self.factory.add_controllerConnection(self, self.factory.switchConn)
         hello_msg = self.factory.ofmsg_generator(0)
-        self.transport.write(hello_msg)
-        reactor.callLater(5, self.send_echo_request)
+        self.writer.write(hello_msg, LANE_CONTROL)
+        self.echoes = OrderedDict()     # echoes = { xid: sent time } of the unanswered echo requests, oldest first
+        self.echo_call = reactor.callLater(self.factory.echo_interval, self.send_echo_request)
 
+    # the replies are the controller's heartbeats for the failure detector
     def send_echo_request(self):
-        echo_msg = self.factory.ofmsg_generator(2)
-        self.transport.write(echo_msg)
-        reactor.callLater(5, self.send_echo_request)
+        xid = random.randint(2, 65534000)
+        if len(self.echoes) >= self.factory.max_echoes:
+            self.echoes.popitem(last=False)
+        self.echoes[xid] = time.time()
+        echo_msg = self.factory.ofmsg_generator(2, xid)
+        self.writer.write(echo_msg, LANE_CONTROL)
+        self.echo_call = reactor.callLater(self.factory.echo_interval, self.send_echo_request)
 
     def connectionLost(self, reason):
         logging.info("Losing a controller!")
+        if self.echo_call.active():
+            self.echo_call.cancel()
         self.factory.remove_controllerConnection(self, self.factory.switchConn)
-        exit_fwst()
 
 
 class OpenFlowService():
     test = 1
-    switch_to_controller = {}  # a dictionary: Switch_conn --> [a list of controllers]
-    switch_reply_keeper = {}  # Switch_connection --> keeper, keeper is a dict : key(type-xid) --> an array of controller_connections.
+    connections = ConnectionRegistry()  # switches, Switch_conn --> [a list of controllers] and its master
+    REPLY_TIMEOUT = 30.0    # seconds a request from a controller waits for the switch's reply
+    switch_reply_keeper = ReplyTable(REPLY_TIMEOUT)  # (Switch_connection, type, xid) --> controller_connections waiting for the reply
     CONTROLLER_IPS = ["192.168.56.101", "192.168.56.102", "192.168.56.103"]
     CONTROLLER_REPLY_TYPES = [5, 7, 18, 20, 24, 26]  # reply from switch is required when receiveing these messages from controllers
     SWITCH_REPLY_TYPES = [6, 8, 19, 21, 25, 27]  # reply from switch corresponds to CONTROLLER_REPLY_TYPES
-    switch_to_master = {}    # Switch_conn --> its master controller
-    robin_round_factor = 0
+    MULTIPART_COALESCING = True     # one MULTIPART_REQUEST(18) to the switch for equivalent requests of all controllers
+    MULTIPART_CACHE_TTL = 1.0       # seconds a complete MULTIPART_REPLY(19) answers equivalent requests, 0 for none
+    multipart_coalescer = MultipartCoalescer(MULTIPART_CACHE_TTL, REPLY_TIMEOUT)
+    # the policy choosing the controller of each packet_in, switched at runtime through the policy file
+    packet_in_scheduler = PacketInScheduler(
+        [RoundRobinPolicy(), WeightedRoundRobinPolicy(), MasterOnlyPolicy(connections.masters), RandomPolicy(),
+         LeastOutstandingPolicy(), EwmaLatencyPolicy(), FlowAffinityPolicy()],
+        "round_robin", key=lambda conn: conn.factory.controller_ip)
+    SCHEDULING_POLICY_FILE = "scheduling_policy.json"   # {"policy": "weighted_round_robin", "weights": {ip: weight}}
+    POLICY_CHECK_INTERVAL = 1.0
+    PACKET_IN_RATE = None           # packet_ins per second admitted from one switch, e.g. 1000, None for no limit
+    PACKET_IN_BURST = 200           # packet_ins a switch may send at once over its rate
+    PACKET_IN_GLOBAL_RATE = None    # packet_ins per second admitted from all switches together, e.g. 5000
+    PACKET_IN_GLOBAL_BURST = 1000
+    PACKET_IN_OVERLOAD = "drop"     # or "defer" to queue packet_ins over the limit until there are tokens
+    packet_in_admission = PacketInAdmission(PACKET_IN_RATE, PACKET_IN_BURST, PACKET_IN_GLOBAL_RATE,
+                                            PACKET_IN_GLOBAL_BURST, PACKET_IN_OVERLOAD)
+    BULK_TYPES = [10, 11, 13, 14, 18, 19]   # packet_in, flow_removed, packet_out, flow_mod, multipart: the bulk lane
+    CONTROL_TYPES = [0, 2, 3, 24, 25]       # hello, echo, role: may overtake anything, the rest is a fence
+    BACKLOG_LIMIT = 65536           # bytes a connection may buffer before the topology and bulk lanes are held back
+    LANE_QUANTA = None              # None for strict priority, or bytes per round for each lane, e.g. [0, 4096, 1024]
+    CONTROLLER_PORT = 6633
+    ECHO_INTERVAL = 1.0             # seconds between ECHO_REQUESTs to a controller, the replies are its heartbeats
+    MAX_ECHOES = 16                 # unanswered ECHO_REQUESTs kept per controller, the oldest is given up beyond
+    SUSPECT_PHI = 8.0               # a controller whose missing heartbeat reaches this phi gets no packet_ins
+    DEAD_AFTER = 3.0                # seconds a controller stays suspected before its connection is closed
+    SLOW_RTT = 0.5                  # seconds of smoothed echo round trip over which a controller gets no new packet_ins
+    REINTEGRATION_RAMP = 10.0       # seconds a reconnected or recovered controller takes to get its full share
+    LIVENESS_CHECK_INTERVAL = 0.25
+    failure_detector = FailureDetector(ECHO_INTERVAL, SUSPECT_PHI, DEAD_AFTER, SLOW_RTT, ramp=REINTEGRATION_RAMP)
+    RECONNECT_INITIAL_DELAY = 0.5   # seconds before a lost controller connection is made again, doubling with every failure in a row
+    RECONNECT_MAX_DELAY = 30.0      # up to this
+    reconnector = Reconnector(RECONNECT_INITIAL_DELAY, RECONNECT_MAX_DELAY)
+    unscheduled = 0                 # packet_ins dropped as their switch had no controller
     # udp_start_time = {}
     # udp_stop_time = []
     # tcp_start_time = {}
@@ -117,93 +139,176 @@ class OpenFlowService():
     # SWITCH_REPLY_TYPES = [6, 8, 19, 21, 27]
 
     def add_switchConnection(self, conn):
-        if conn not in self.switch_to_controller:
-            self.switch_to_controller[conn] = []
-            self.switch_reply_keeper[conn] = {}
+        conn.writer = PriorityWriter(conn.transport, self.BACKLOG_LIMIT, self.LANE_QUANTA)
+        if conn not in self.connections:
+            self.connections.add_switch(conn)
         else:
             logging.warning("Unexpected situation!!!! Switch already in ")
 
     def remove_switchConnection(self, conn):
-        if conn in self.switch_to_controller:
-            del self.switch_to_controller[conn]
-            del self.switch_reply_keeper[conn]
+        conn.writer.close()
+        if conn in self.connections:
+            self.connections.remove(conn)
+            self.switch_reply_keeper.forget(conn)
+            self.multipart_coalescer.forget(conn)
+            self.packet_in_admission.forget(conn)
         else:
             logging.warning("Unexpected situation Switch not in when removing")
 
     def add_controllerConnection(self, controller_conn, switch_conn):
-        if switch_conn in self.switch_to_controller:
-            pool = self.switch_to_controller[switch_conn]
-            if controller_conn not in pool:
-                pool.append(controller_conn)
+        controller_conn.writer = PriorityWriter(controller_conn.transport, self.BACKLOG_LIMIT, self.LANE_QUANTA)
+        if switch_conn in self.connections:
+            if controller_conn not in self.connections:
+                self.connections.add_controller(controller_conn, switch_conn)
+                self.packet_in_scheduler.on_connect(controller_conn)
+                again = self.reconnector.connected(controller_conn.factory)
+                self.failure_detector.add(controller_conn, time.time(), ramp=again)
             else:
                 logging.warning("Controller already in switch")
         else:
             logging.warning("Unexpected not such switch when adding controller")
 
     def remove_controllerConnection(self, controller_conn, switch_conn):
-        if switch_conn in self.switch_to_controller:
-            pool = self.switch_to_controller[switch_conn]
-            if controller_conn in pool:
-                pool.remove(controller_conn)
+        controller_conn.writer.close()
+        if switch_conn in self.connections:
+            if self.connections.controller_switch(controller_conn) is switch_conn:
+                self.failure_detector.remove(controller_conn)
+                packet_ins = self.packet_in_scheduler.take(controller_conn)
+                self.connections.remove(controller_conn)
+                self.packet_in_scheduler.on_disconnect(controller_conn)
+                self.reroute_packet_ins(packet_ins)
             else:
                 logging.warning("Controller not in switch pool when removing ")
         else:
             logging.warning("Unexpected not such switch when removing controller")
 
+    # a lost controller connection is made again with backoff, as long as its switch is connected
+    def retry_controller(self, factory, connector, failed=False):
+        if factory.switchConn not in self.connections:
+            self.reconnector.stop(factory)
+            return
+        connect = lambda: self.reconnect_controller(factory, connector)
+        if failed:
+            delay = self.reconnector.failed(factory, connect)
+        else:
+            delay = self.reconnector.lost(factory, connect)
+        logging.info("Connecting to controller %s again in %.1f s" % (factory.controller_ip, delay))
+
+    def reconnect_controller(self, factory, connector):
+        if factory.switchConn in self.connections:
+            connector.connect()
+        else:
+            self.reconnector.stop(factory)
+
+    # an ECHO_REPLY(3) matching an unanswered echo request is a heartbeat, and a round trip sample.
+    # A round trip longer than the echo interval still counts, the controller is slow, not dead
+    def echo_reply(self, controller_conn, xid):
+        sent = controller_conn.echoes.pop(xid, None)
+        if sent is None:
+            logging.debug("Unexpected echo reply xid:%d" % xid)
+            return
+        now = time.time()
+        self.failure_detector.heartbeat(controller_conn, now, now - sent)
+
+    def start_liveness_check(self):
+        self.liveness_check = task.LoopingCall(self.check_liveness)
+        self.liveness_check.start(self.LIVENESS_CHECK_INTERVAL, now=False)
+
+    # a suspected controller hands its unanswered packet_ins to the other controllers of its switch,
+    # a dead one is closed and connected again
+    def check_liveness(self):
+        suspected, dead, recovered = self.failure_detector.check(time.time())
+        for conn in suspected:
+            logging.warning("Controller %s suspected, phi %.1f" % (conn.factory.controller_ip, self.failure_detector.phi(conn, time.time())))
+            self.reroute_packet_ins(self.packet_in_scheduler.take(conn))
+        for conn in dead:
+            logging.error("Controller %s not answering, closing its connection" % conn.factory.controller_ip)
+            conn.transport.abortConnection()
+        for conn in recovered:
+            logging.warning("Controller %s answering again" % conn.factory.controller_ip)
+
+    # the packet_ins a controller did not answer go to the other controllers of their switches
+    def reroute_packet_ins(self, packet_ins):
+        for swiconn, packet_in in packet_ins:
+            if swiconn in self.connections:
+                self.send_packet_in(swiconn, packet_in)
+        if packet_ins:
+            logging.warning("Rerouted %d packet_ins" % len(packet_ins))
+
+    # controllers watched, suspected and reintegrated, and the reconnections
+    def liveness_metrics(self):
+        metrics = self.failure_detector.metrics(time.time())
+        metrics["reconnect"] = self.reconnector.metrics()
+        return metrics
+
     # find the controller according to the reply message received from the switch
-    # according to the switch_conn and (msg_type, xid)
+    # according to the switch_conn and (msg_type, xid), None if it is gone
     def find_controller_given_reply(self, switch_conn, type, xid, hasmore=False):
-        if switch_conn in self.switch_reply_keeper:
-            temp = self.switch_reply_keeper[switch_conn]
-            mykey = "%s-%s" % (type, xid)
-            if mykey in temp:
-                pool = temp[mykey]
-                if not hasmore:
-                    result = pool.pop()
-                else:
-                    result = pool[0]
-                if len(pool) == 0:
-                    del temp[mykey]
-                return result
-            else:
-                logging.error("Unable to find a connection to reply")
-                return None
-        else:
+        if switch_conn not in self.connections:
             logging.warning("Unable to find switch in reply keeper")
             return None
+        controller_conn = self.switch_reply_keeper.pop(switch_conn, type, xid, hasmore)
+        if controller_conn is None:
+            logging.error("Unable to find a connection to reply")
+        elif self.connections.controller_switch(controller_conn) is not switch_conn:
+            logging.info("Dropping the reply type:%d xid:%d, its controller is gone" % (type + 1, xid))
+            return None
+        return controller_conn
 
     # record the controller connection when a reply is required from the switch
     # according to the switch_conn and (msg_type, xid)
     def record_controller_request(self, switch_conn, controller_conn, type, xid):
-        if switch_conn in self.switch_reply_keeper:
-            temp = self.switch_reply_keeper[switch_conn]
-            mykey = "%s-%s" % (type, xid)
-            if mykey in temp:
-                pool = temp[mykey]
-                pool.append(controller_conn)
-            else:
-                temp[mykey] = []
-                temp[mykey].append(controller_conn)
-        else:
+        if switch_conn not in self.connections:
             logging.warning("Unable to record controller as switch not in reply keeper")
-            exit_fwst()
+            return
+        self.switch_reply_keeper.track(switch_conn, type, xid, controller_conn)
+
+    # an equivalent request is either waiting for the switch, answered from the cache, or sent
+    def coalesce_multipart_request(self, switch_conn, controller_conn, xid, msg):
+        request, replies = self.multipart_coalescer.request(switch_conn, xid, msg, controller_conn)
+        if request is not None:
+            switch_conn.writer.write(request, LANE_BULK)
+        elif replies is not None:
+            for reply in replies:
+                controller_conn.writer.write(reply, LANE_BULK)
+
+    # the parts of a coalesced MULTIPART_REPLY(19) go to every controller still connected, False if not coalesced
+    def fan_out_multipart_reply(self, switch_conn, xid, msg):
+        replies = self.multipart_coalescer.reply(switch_conn, xid, msg)
+        if replies is None:
+            return False
+        for controller_conn, reply in replies:
+            if self.connections.controller_switch(controller_conn) is switch_conn:
+                controller_conn.writer.write(reply, LANE_BULK)
+        return True
+
+    # requests waiting for the switches' replies, and those never answered per type
+    def reply_metrics(self):
+        metrics = self.switch_reply_keeper.metrics()
+        metrics["multipart"] = self.multipart_coalescer.metrics()
+        return metrics
 
     # register the operation in factory to share among client_protocol instances
-    def getOpenFlowClientFactory(self, switchConn):
+    def getOpenFlowClientFactory(self, switchConn, controller_ip):
         f = ClientFactory()
         f.protocol = OpenFlowClientProtocol
         f.switchConn = switchConn
+        f.controller_ip = controller_ip
         f.add_controllerConnection = self.add_controllerConnection
-        f.handle_controller_openflow_msg = self.handle_controller_openflow_msg
+        f.handle_controller_openflow_batch = self.handle_controller_openflow_batch
         f.remove_controllerConnection = self.remove_controllerConnection
         f.ofmsg_generator = self.ofmsg_generator
+        f.echo_interval = self.ECHO_INTERVAL
+        f.max_echoes = self.MAX_ECHOES
+        f.clientConnectionLost = lambda connector, reason: self.retry_controller(f, connector)
+        f.clientConnectionFailed = lambda connector, reason: self.retry_controller(f, connector, True)
         return f
 
     # register the operation in factory to share among server_protocol instances
     def getOpenFlowServerFactory(self):
         f = ServerFactory()
         f.protocol = OpenFlowServerProtocol
-        f.handle_switch_openflow_msg = self.handle_switch_openflow_msg
+        f.handle_switch_openflow_batch = self.handle_switch_openflow_batch
         f.add_switchConnection = self.add_switchConnection
         f.remove_switchConnection = self.remove_switchConnection
         return f
@@ -218,15 +323,21 @@ class OpenFlowService():
         return msg
 
     # is_special_packets means the packets are LLDP(88cc) and (0806), which are used to construct the network topology
+    # the ethertype follows the packet_in's match, whose length depends on the switch
     def is_special_packets(self, packet):
-        raw_packet_type = packet[54:56]
-        ptype = struct.unpack(">BB", raw_packet_type)
-        stringtype = "%02x%02x" % ptype
-        if stringtype == "88cc":
-            return True
-        elif stringtype == "0806":
-            return True
-        return False
+        return is_topology_packet_in(packet)
+
+    # priority lane of a message: LLDP/ARP packet_outs go ahead of the bulk lane, hello/echo/role
+    # ahead of both. Barriers, *_MOD and the other control messages go ahead of both as well,
+    # but only after everything queued before them: they must not overtake an earlier flow_mod
+    def message_lane(self, type, msg):
+        if type in self.CONTROL_TYPES:
+            return LANE_CONTROL
+        if type not in self.BULK_TYPES:
+            return LANE_FENCE
+        if type == 13 and frame_eth_type(msg, packet_out_data_offset(msg)) in TOPOLOGY_ETH_TYPES:
+            return LANE_TOPOLOGY
+        return LANE_BULK
 
     '''
     ======================================================================================
@@ -235,53 +346,38 @@ class OpenFlowService():
     '''
     # this function is called when the program received Packet_in
     # If this packet is a special packet, it should be sent to its master for topology construction
-    # Otherwise, the packet would be sent to any one of the controllers it connect
-    def schedule(self, swiconn, isSpecialPacket):
-        if isSpecialPacket:
+    # Otherwise, the active policy of packet_in_scheduler picks one of the controllers it connect:
+    # round_robin, weighted_round_robin, master_only, random, least_outstanding, latency or flow_hash
+    # Suspected controllers are left out, reintegrated ones get a growing share. None if there is no controller
+    def schedule(self, swiconn, packet_in):
+        now = time.time()
+        if packet_in.special:
             conn = self.find_master(swiconn)
-            if conn is None:
+            if conn is None or self.failure_detector.suspected(conn, now):
                 logging.error("We get a random one")
-                return self.switch_to_controller[swiconn][0]
+                candidates = self.failure_detector.available(self.connections.switch_controllers(swiconn), now)
+                return candidates[0] if candidates else None
             return conn
+        candidates = self.failure_detector.available(self.connections.switch_controllers(swiconn), now)
+        return self.packet_in_scheduler.select(swiconn, packet_in, candidates)
 
-        # '''
-        # ===============================================================================
-        #             All the packets forward to the first controller
-        # ===============================================================================
-        # '''
-        # return self.switch_to_controller[swiconn][0]
-
-        '''
-        ===============================================================================
-                    Robin-round
-        ===============================================================================
-        '''
-        controller_num = len(self.switch_to_controller[swiconn])
-        self.robin_round_factor = (self.robin_round_factor + 1) % controller_num
-        return self.switch_to_controller[swiconn][self.robin_round_factor]
-
-        # '''
-        # ===============================================================================
-        #             Packets are sent back to the master
-        # ===============================================================================
-        # '''
-        # conn = self.find_master(swiconn)
-        # if conn is None:
-        #     logging.error("Packet_in can't find master, so We get a random one")
-        #     return self.switch_to_controller[swiconn][0]
-        # return conn
-        #
-        # '''
-        # ===============================================================================
-        #             Weighted Robin-round
-        # ===============================================================================
-        # '''
+    # switch the scheduling policy at runtime, without a restart
+    def set_scheduling_policy(self, name, config=None):
+        return self.packet_in_scheduler.set_policy(name, config)
+
+    def start_policy_watch(self):
+        self.packet_in_scheduler.policy_file = self.SCHEDULING_POLICY_FILE
+        self.policy_watch = task.LoopingCall(self.packet_in_scheduler.check_policy_file)
+        self.policy_watch.start(self.POLICY_CHECK_INTERVAL)
 
     # find the master controller given switch_conn
     def find_master(self, swiconn):
-        if swiconn not in self.switch_to_master:
-            return None
-        return self.switch_to_master[swiconn]
+        return self.connections.master(swiconn)
+
+    # a batch holds every complete message of one read from the switch
+    def handle_switch_openflow_batch(self, msgs, swiconn):
+        for msg in msgs:
+            self.handle_switch_openflow_msg(msg, swiconn)
 
     def handle_switch_openflow_msg(self, msg, swiconn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
@@ -293,44 +389,36 @@ class OpenFlowService():
 
         if type == 0:
             for ip in self.CONTROLLER_IPS:
-                clientF = self.getOpenFlowClientFactory(swiconn)
+                clientF = self.getOpenFlowClientFactory(swiconn, ip)
                 logging.debug("Established a connection to controller")
-                reactor.connectTCP(ip, 6633, clientF)
+                reactor.connectTCP(ip, self.CONTROLLER_PORT, clientF)
             reply_msg = self.ofmsg_generator(0, xid)
             logging.debug("Fabricate a hello")
-            swiconn.transport.write(reply_msg)
+            swiconn.writer.write(reply_msg, LANE_CONTROL)
         elif type == 2:
             reply_msg = self.ofmsg_generator(3, xid, msg[8:])
-            swiconn.transport.write(reply_msg)
+            swiconn.writer.write(reply_msg, LANE_CONTROL)
             logging.debug("Fabricate a echo reply")
 
         elif type == 10:
-            if swiconn not in self.switch_to_controller:
-                logging.error("No controller given swi")
-                exit_fwst()
-            conn = self.schedule(swiconn, self.is_special_packets(msg))
-            # if self.is_special_packets(msg):
-            # print "Special Swi %s Controller %s" %(swiconn.transport.getPeer(), conn.transport.getPeer())
-            if conn is None:
-                logging.error("Not available schedule")
-                exit_fwst()
-            conn.transport.write(msg)
-            # temp = self.switch_to_controller[swiconn]
-            # temp[0].transport.write(msg)
-            self.measure(msg)
+            self.packet_in_admission.admit(swiconn, self.forward_packet_in, swiconn, xid, msg)
 
         elif type == 25:
             body = struct.unpack(">IIQ", msg[8:])
             role = body[0]
             controller_conn = self.find_controller_given_reply(swiconn, type - 1, xid)
+            if controller_conn is None:
+                return
             logging.info(
                 "Role %d request %s <==> %s" % (role, swiconn.transport.getPeer(), controller_conn.transport.getPeer()))
             if role == 2:
-                self.switch_to_master[swiconn] = controller_conn
+                self.connections.set_master(swiconn, controller_conn)
                 logging.info("Updating Master Controller Information for %s  <==> %s" % (
                 swiconn.transport.getPeer(), controller_conn.transport.getPeer()))
-            controller_conn.transport.write(msg)
+            controller_conn.writer.write(msg, LANE_CONTROL)
 
+        elif type == 19 and self.fan_out_multipart_reply(swiconn, xid, msg):
+            pass
         elif type in self.SWITCH_REPLY_TYPES:
             hasMore = False
             if type == 19:
@@ -340,18 +428,55 @@ class OpenFlowService():
             controller_conn = self.find_controller_given_reply(swiconn, type - 1, xid, hasMore)
             if controller_conn is None:
                 logging.error("Controller can not find...It must be a bugggggggggggg")
-                exit_fwst()
-            controller_conn.transport.write(msg)
+                return
+            controller_conn.writer.write(msg, self.message_lane(type, msg))
         else:
             con = self.find_master(swiconn)
-            if con is None:
+            if con is None:     # none elected yet, or the master is gone: every controller gets it
                 logging.error("No master!!!")
-                exit_fwst()
-            con.transport.write(msg)
+                for con in self.connections.switch_controllers(swiconn):
+                    con.writer.write(msg, self.message_lane(type, msg))
+                return
+            con.writer.write(msg, self.message_lane(type, msg))
             # temp = self.switch_to_controller[swiconn]
             # for t1 in temp:
             #     t1.transport.write(msg)
 
+    # a packet_in admitted by packet_in_admission, possibly after being deferred
+    def forward_packet_in(self, swiconn, xid, msg):
+        if swiconn not in self.connections:
+            logging.error("No controller given swi")
+            return
+        packet_in = PacketIn(msg, xid, self.is_special_packets(msg))
+        if self.send_packet_in(swiconn, packet_in):
+            self.measure(msg)
+
+    # False if the switch has no controller to take it
+    def send_packet_in(self, swiconn, packet_in):
+        conn = self.schedule(swiconn, packet_in)
+        # if self.is_special_packets(msg):
+        # print "Special Swi %s Controller %s" %(swiconn.transport.getPeer(), conn.transport.getPeer())
+        if conn is None:
+            logging.error("Not available schedule")
+            self.unscheduled += 1
+            return False
+        conn.writer.write(packet_in.msg, LANE_TOPOLOGY if packet_in.special else LANE_BULK)
+        # temp = self.switch_to_controller[swiconn]
+        # temp[0].transport.write(msg)
+        self.packet_in_scheduler.on_request(swiconn, packet_in, conn)
+        return True
+
+    # packet_ins admitted, dropped and deferred by the token buckets, and those no controller could take
+    def packet_in_metrics(self):
+        metrics = self.packet_in_admission.metrics()
+        metrics["unscheduled"] = self.unscheduled
+        return metrics
+
+    # a batch holds every complete message of one read from the controller
+    def handle_controller_openflow_batch(self, msgs, controller_conn, swi_conn):
+        for msg in msgs:
+            self.handle_controller_openflow_msg(msg, controller_conn, swi_conn)
+
     def handle_controller_openflow_msg(self, msg, controller_conn, swi_conn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
         type = openflow_header[1]
@@ -365,6 +490,7 @@ class OpenFlowService():
             logging.debug("It is a hello from controller")
         elif type == 3:
             logging.debug("It is an echo reply")
+            self.echo_reply(controller_conn, xid)
         # elif type == 24:
         #     body = struct.unpack(">IIQ", msg[8:])
         #     role = body[0]
@@ -375,11 +501,15 @@ class OpenFlowService():
         #     role_reply = struct.pack(">IIQ", role, padding, generation_id)
         #     reply_msg = self.ofmsg_generator(25, xid, role_reply)
         #     controller_conn.transport.write(reply_msg)
+        elif type == 18 and self.MULTIPART_COALESCING and self.multipart_coalescer.coalescible(msg):
+            self.coalesce_multipart_request(swi_conn, controller_conn, xid, msg)
         elif type in self.CONTROLLER_REPLY_TYPES:
             self.record_controller_request(swi_conn, controller_conn, type, xid)
-            swi_conn.transport.write(msg)
+            swi_conn.writer.write(msg, self.message_lane(type, msg))
         else:
-            swi_conn.transport.write(msg)
+            swi_conn.writer.write(msg, self.message_lane(type, msg))
+        if type == 13 or type == 14:    # packet_out/flow_mod answering a packet_in, a live response time sample
+            self.packet_in_scheduler.on_response(swi_conn, type, msg, controller_conn)
         if type == 13:
             self.measure(msg)
 
@@ -430,6 +560,8 @@ class OpenFlowService():
 
 
 s = OpenFlowService()
+s.start_policy_watch()
+s.start_liveness_check()
 reactor.listenTCP(6633, s.getOpenFlowServerFactory())
 logging.info("Start running server")
 reactor.run()
@@ -3,10 +3,36 @@ from twisted.internet.protocol import ClientFactory
 from twisted.internet.protocol import ServerFactory
 
 from twisted.internet import reactor
+from twisted.internet import task
 
 import struct
 import logging
 import random
+import time
+import sys
+from collections import OrderedDict
+
+from openflow_framer import OpenFlowFramer, TunnelFramer, TUNNEL_HEADER
+from openflow_framer import tunnel_control_msg, parse_tunnel_control, tunnel_stripe_msg
+from openflow_framer import TUNNEL_OFFER, TUNNEL_SWITCH, TUNNEL_VERSION_1, TUNNEL_VERSION_2
+from openflow_writer import CoalescingWriter
+from flow_control import TunnelFlowControl
+from admission_control import PacketInAdmission
+from pending_flows import PendingFlowTable, reinject_msg
+from decision_cache import DecisionCache
+from reply_table import ReplyTable
+from multipart_coalescer import MultipartCoalescer
+from handshake_cache import HandshakeCache
+from connection_registry import ConnectionRegistry
+from shm_ring import connect_ring
+from tunnel_stripes import StripeGroup
+from failure_detector import FailureDetector
+from reconnector import Reconnector
+from scheduler_workers import WorkerSupervisor, reuseport_listen, start_worker_channel, worker_index
+from packet_in_scheduler import PacketInScheduler, PacketIn
+from packet_in_scheduler import RoundRobinPolicy, WeightedRoundRobinPolicy, RandomPolicy
+from packet_in_scheduler import LeastOutstandingPolicy, EwmaLatencyPolicy, FlowAffinityPolicy
+
 logging.basicConfig(level=logging.DEBUG)
 
 '''
@@ -28,6 +54,10 @@ struct header {
 Initialization: Datapath_ID for the messages such as "HELLO" is 0
 before the scheduler receives the switch's datapath_ID
 The controller is associated with the transaction ID of the packet
+
+Version 2 of the protocol batches several of these records behind one frame header,
+it is negotiated when the tunnel connects and falls back to version 1 for old proxies
+(see openflow_framer.py)
 '''
 
 
@@ -37,8 +67,7 @@ The controller is associated with the transaction ID of the packet
 class OpenFlowProxyServerProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = OpenFlowFramer()
 
     def connectionMade(self):
         self.factory.add_switchConnection(self)
@@ -50,25 +79,10 @@ class OpenFlowProxyServerProtocol(Protocol):
         logging.info("Losing a switch connection!")
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.debug("Receiving new data from switch %d, buffer data %d"%(len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 8:
-                    # logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">bbHI", self.data_buffer[:8])
-                # logging.debug("Switch Msg Version:%d Type:%d Length:%d ID:%d" % parsed_header)
-                self.pending_bytes = parsed_header[2]
-
-            if self.pending_bytes > available_bytes:
-                # logging.debug("Waiting switch entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_switch_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        msgs = self.framer.feed(data)
+        # logging.debug("Receiving new data from switch %d, %d msgs, buffer data %d"%(len(data), len(msgs), self.framer.pending_bytes()))
+        if msgs:
+            self.factory.handle_switch_openflow_batch(msgs, self)
 
 
 '''################## Handle connections between scheduler and ONOS tunnels ##########################'''
@@ -77,33 +91,20 @@ class OpenFlowProxyServerProtocol(Protocol):
 class OpenFlowClientProtocol(Protocol):
 
     def __init__(self):
-        self.pending_bytes = 0
-        self.data_buffer = bytearray()
+        self.framer = TunnelFramer()
 
     def dataReceived(self, data):
-        self.data_buffer.extend(data)
-        # logging.debug("Receiving new data from controller %d, buffer data %d"%(len(data), len(self.data_buffer)))
-        while True:
-            available_bytes = len(self.data_buffer)
-            if self.pending_bytes == 0:
-                if available_bytes < 10:
-                    # logging.debug("Waiting Header")
-                    return
-                parsed_header = struct.unpack(">QH", self.data_buffer[:10])
-                #logging.debug("Tunnel Msg DPID:%d length:%d" % parsed_header)
-                self.pending_bytes = parsed_header[1]+10
-            if self.pending_bytes > available_bytes:
-                # logging.debug("Waiting controller entire message %d" % self.pending_bytes)
-                return
-            openflow_msg = self.data_buffer[:self.pending_bytes]
-            self.data_buffer = self.data_buffer[self.pending_bytes:]
-            self.factory.handle_tunnel_openflow_msg(openflow_msg, self)
-            self.pending_bytes = 0
+        frames = self.framer.feed(data)
+        # logging.debug("Receiving new data from controller %d, %d msgs, buffer data %d"%(len(data), len(frames), self.framer.pending_bytes()))
+        if frames:
+            self.factory.handle_tunnel_openflow_batch(frames, self)
 
     def connectionMade(self):
         logging.info("Connecting to a tunnel!")
         self.transport.setTcpNoDelay(True)
         self.factory.add_tunnelConnection(self)
+        self.echoes = OrderedDict()     # echoes = { xid: sent time } of the unanswered echo requests, oldest first
+        self.echo_call = reactor.callLater(self.factory.echo_interval, self.send_echo_request)
         # try:
         #     self.transport.setTcpKeepAlive(1)
         # except AttributeError:
@@ -115,8 +116,20 @@ class OpenFlowClientProtocol(Protocol):
         # reply_msg = struct.pack(">bbHI", version, type, length, xid)
         # self.transport.write(reply_msg)
 
+    # on dpid 0, v2 proxies answer them and are watched by the failure detector
+    def send_echo_request(self):
+        if self.writer.tunnel_version == TUNNEL_VERSION_2:
+            xid = random.randint(2, 65534000)
+            if len(self.echoes) >= self.factory.max_echoes:
+                self.echoes.popitem(last=False)
+            self.echoes[xid] = time.time()
+            self.writer.write_tunnel(0, self.factory.ofmsg_generator(2, xid))
+        self.echo_call = reactor.callLater(self.factory.echo_interval, self.send_echo_request)
+
     def connectionLost(self, reason):
         logging.info("Losing a tunnel!")
+        if self.echo_call.active():
+            self.echo_call.cancel()
         self.factory.remove_tunnelConnection(self)
 
 
@@ -125,18 +138,63 @@ class OpenFlowClientProtocol(Protocol):
 
 class OpenFlowService():
 
-    switches = []
-    tunnels = []
-    dpid2sw_dict = {}     # dpid2sw_dict = { Datapath ID: switch_connection }
-    sw2dpid_dict = {}     # sw2dpid_dict = { switch_connection: Datapath ID }
+    connections = ConnectionRegistry()     # switches and tunnels, { Datapath ID: switch_connection } and back
 
     #xid2tun = {}          # xid2tun = { transaction ID: tunnel }
-    rr = 0                # round-robin factor
-    reply_keeper = {}     # reply_keeper = { (DPID, TYPE, XID): [tunnel] }
+    # the policy choosing the tunnel of each packet_in, switched at runtime through the policy file
+    packet_in_scheduler = PacketInScheduler(
+        [RoundRobinPolicy(), WeightedRoundRobinPolicy(), RandomPolicy(),
+         LeastOutstandingPolicy(), EwmaLatencyPolicy(), FlowAffinityPolicy()],
+        "least_outstanding", key=lambda conn: conn.address)
+    SCHEDULING_POLICY_FILE = "scheduling_policy.json"   # {"policy": "weighted_round_robin", "weights": {ip: weight}}
+    POLICY_CHECK_INTERVAL = 1.0
+    WORKERS = 1                     # more runs a supervisor and this many scheduler processes sharing port 6633
+    supervisor = None               # control channel to the supervisor, in a worker process
+    REPLY_TIMEOUT = 30.0  # seconds a request from a tunnel waits for the switch's reply
+    reply_keeper = ReplyTable(REPLY_TIMEOUT)     # reply_keeper = { (DPID, TYPE, XID): tunnels waiting, oldest first }
+    MULTIPART_COALESCING = True     # one MULTIPART_REQUEST(18) to the switch for equivalent requests of all tunnels
+    MULTIPART_CACHE_TTL = 1.0       # seconds a complete MULTIPART_REPLY(19) answers equivalent requests, 0 for none
+    multipart_coalescer = MultipartCoalescer(MULTIPART_CACHE_TTL, REPLY_TIMEOUT)
+    HANDSHAKE_CACHE = True          # answer FEATURES_REQUEST and PORT_DESC/DESC requests from what the switch told us
+    handshake_cache = HandshakeCache()
     SWITCH_REPLY_TYPES = [3, 8, 19, 21, 25, 27]  # messages from switches to tunnel
     TUNNEL_IGNORE_TYPES = [9, 13, 14, 15, 16, 17, 28, 29] # messages from tunnel, no reply from switch is required
-
-    def ofmsg_generator(self, type, xid, data=''):
+    WRITE_MAX_DELAY = 0       # seconds a write may wait to be coalesced, 0 flushes once per reactor iteration
+    WRITE_MAX_BYTES = 65536   # flush a connection's output at once when this many bytes are waiting
+    TUNNEL_VERSION = TUNNEL_VERSION_2   # tunnel framing offered to the proxies, TUNNEL_VERSION_1 never offers v2
+    TUNNEL_HIGH_WATERMARK = 4194304     # stop reading from the switches once a tunnel has this many bytes queued
+    TUNNEL_LOW_WATERMARK = 1048576      # and read again once every congested tunnel is under this
+    TUNNEL_STRIPES = 1                  # tunnel connections per proxy, more spreads the switches over them
+    stripe_groups = {}                  # stripe_groups = { proxy address: StripeGroup }, with TUNNEL_STRIPES > 1
+    STRIPE_SETTLE_DELAY = 0.5           # seconds a new stripe group waits for the rest of its stripes before it is used
+    congested_tunnels = set()
+    ECHO_INTERVAL = 1.0             # seconds between ECHO_REQUESTs on a tunnel, the proxy's replies are its heartbeats
+    MAX_ECHOES = 16                 # unanswered ECHO_REQUESTs kept per tunnel, the oldest is given up beyond
+    SUSPECT_PHI = 8.0               # a tunnel whose missing heartbeat reaches this phi gets no packet_ins
+    DEAD_AFTER = 3.0                # seconds a tunnel stays suspected before it is closed
+    SLOW_RTT = 0.5                  # seconds of smoothed echo round trip over which a tunnel gets no new packet_ins
+    REINTEGRATION_RAMP = 10.0       # seconds a reconnected or recovered tunnel takes to get its full share
+    LIVENESS_CHECK_INTERVAL = 0.25
+    failure_detector = FailureDetector(ECHO_INTERVAL, SUSPECT_PHI, DEAD_AFTER, SLOW_RTT, ramp=REINTEGRATION_RAMP)
+    RECONNECT_INITIAL_DELAY = 0.5   # seconds before a lost tunnel is connected again, doubling with every failure in a row
+    RECONNECT_MAX_DELAY = 30.0      # up to this
+    reconnector = Reconnector(RECONNECT_INITIAL_DELAY, RECONNECT_MAX_DELAY)
+    unscheduled = 0                 # packet_ins dropped while there was no tunnel
+    PACKET_IN_RATE = None           # packet_ins per second admitted from one switch, e.g. 1000, None for no limit
+    PACKET_IN_BURST = 200           # packet_ins a switch may send at once over its rate
+    PACKET_IN_GLOBAL_RATE = None    # packet_ins per second admitted from all switches together, e.g. 5000
+    PACKET_IN_GLOBAL_BURST = 1000
+    PACKET_IN_OVERLOAD = "drop"     # or "defer" to queue packet_ins over the limit until there are tokens
+    packet_in_admission = PacketInAdmission(PACKET_IN_RATE, PACKET_IN_BURST, PACKET_IN_GLOBAL_RATE,
+                                            PACKET_IN_GLOBAL_BURST, PACKET_IN_OVERLOAD)
+    PENDING_FLOW_TIMEOUT = 0.5      # seconds the duplicates of a new flow wait for the controller's answer
+    PENDING_FLOW_HOLD = True        # False drops the duplicates instead of holding them
+    pending_flows = PendingFlowTable(PENDING_FLOW_TIMEOUT, PENDING_FLOW_HOLD)
+    DECISION_CACHE = False          # True answers repeated packet_ins with the FLOW_MOD the controller sent last time
+    DECISION_CACHE_TTL = 10.0       # seconds a learned decision is replayed, hits do not extend it
+    decision_cache = DecisionCache(DECISION_CACHE_TTL)
+
+    def ofmsg_generator(self, type, xid, data=b''):
         if xid == 0:
             xid = random.randint(2, 65534000)
         version = 4
@@ -145,29 +203,197 @@ class OpenFlowService():
         return msg
 
     def add_switchConnection(self, conn):
-        self.switches.append(conn)
+        conn.writer = CoalescingWriter(conn.transport, self.WRITE_MAX_DELAY, self.WRITE_MAX_BYTES)
+        self.connections.add_switch(conn)
+        if self.congested_tunnels:
+            conn.transport.pauseProducing()
 
     def remove_switchConnection(self, conn):
         # msg = self.ofmsg_generator(1, 0)  # send an error msg to all the controllers to drop the connection
         # for tunnel in self.tunnels:
-        #     tunnel.transport.write(str(msg))
+        #     tunnel.transport.write(msg)
         #     self.switch_to_tunnel(msg, conn, 0, )
         #     logging.info("Brocasting error msg")
-        self.switches.remove(conn)
-        if conn in self.sw2dpid_dict:
-            dpid = self.sw2dpid_dict[conn]
-            del self.dpid2sw_dict[dpid]
-            del self.sw2dpid_dict[conn]
+        conn.writer.close()
+        dpid = self.connections.remove(conn).dpid
+        if dpid is not None:
+            self.packet_in_admission.forget(dpid)
+            self.pending_flows.forget(dpid)
+            self.decision_cache.forget(dpid)
+            self.reply_keeper.forget(dpid)
+            self.multipart_coalescer.forget(dpid)
+            self.handshake_cache.forget(dpid)
+            for group in self.stripe_groups.values():
+                group.forget(dpid)
 
     def add_tunnelConnection(self, conn):
-        self.tunnels.append(conn)
+        conn.address = conn.transport.getPeer().host
+        conn.reconnected = self.reconnector.connected(conn.factory)
+        conn.writer = CoalescingWriter(conn.transport, self.WRITE_MAX_DELAY, self.WRITE_MAX_BYTES)
+        if self.TUNNEL_VERSION == TUNNEL_VERSION_2:     # a v1 proxy drops the offer and the tunnel stays v1
+            conn.writer.write_tunnel(0, tunnel_control_msg(TUNNEL_OFFER, TUNNEL_VERSION_2))
+        conn.flow_control = TunnelFlowControl(conn, self.tunnel_congested, self.tunnel_drained,
+                                              self.TUNNEL_HIGH_WATERMARK, self.TUNNEL_LOW_WATERMARK)
+        conn.tunnel = conn      # the tunnel the rest of the service sees, the stripe group of a stripe
+        if self.TUNNEL_STRIPES > 1:
+            self.add_stripe(conn)
+            return
+        self.add_tunnel(conn)
+
+    def add_tunnel(self, tunnel):
+        self.connections.add_tunnel(tunnel)
+        self.packet_in_scheduler.on_connect(tunnel)
+        self.report_tunnel(tunnel, True)
+        self.announce_switches(tunnel)
+
+    # a tunnel made after the switches connected, or again after it was lost, gets the HELLO of
+    # each of them for its proxy to open (or keep) their controller connections
+    def announce_switches(self, tunnel):
+        for switch in self.connections.switches:
+            dpid = self.connections.dpid(switch)
+            if dpid is not None:
+                tunnel.writer.write_tunnel(dpid, self.ofmsg_generator(0, 0))
+
+    def add_stripe(self, conn):
+        group = self.stripe_groups.get(conn.address)
+        if group is None:
+            group = self.stripe_groups[conn.address] = StripeGroup(conn.address, self.TUNNEL_STRIPES)
+        index = group.add(conn)
+        if index is None:
+            logging.warning("Already %d tunnels to %s, closing another one" % (group.count, conn.address))
+            conn.tunnel = None
+            conn.factory.retry = False
+            conn.transport.loseConnection()
+            return
+        conn.tunnel = group
+        conn.writer.write_tunnel(0, tunnel_stripe_msg(group.id, index, group.count))
+        logging.info("Tunnel to %s is stripe %d of %d" % (conn.address, index, group.count))
+        if group in self.connections:
+            self.rebalance_stripes(group, index)
+        elif len(group) == 1:   # the first stripe back waits for the others, or it would take every switch
+            group.settle = reactor.callLater(self.STRIPE_SETTLE_DELAY, self.settle_stripe_group, group)
+        elif len(group) == group.count:
+            self.settle_stripe_group(group)
+
+    # the stripes of a new group are up, or the others were given enough time
+    def settle_stripe_group(self, group):
+        if group.settle.active():
+            group.settle.cancel()
+        self.add_tunnel(group)
+
+    # stripe index came back: the switches it would get move to it once everything they sent on
+    # their current stripe reached the proxy, which answers the barrier echo after that
+    def rebalance_stripes(self, group, index):
+        for source, dpids in group.rebalance(index).items():
+            xid = random.randint(2, 65534000)
+            group.barrier(xid, source, dpids)
+            group.stripes[source].writer.write_tunnel(0, self.ofmsg_generator(2, xid))
+            logging.info("Moving %d switches from stripe %d back to stripe %d of %s" % (len(dpids), source, index, group.address))
 
     def remove_tunnelConnection(self, conn):
-        self.tunnels.remove(conn)
-        if len(self.tunnels) == 0:
-            logging.info("No available tunnel anymore")
-            reactor.stop()
-            exit(1)
+        conn.writer.close()
+        conn.flow_control.stopProducing()
+        self.failure_detector.remove(conn)
+        tunnel = conn.tunnel
+        if tunnel is None:      # closed for a full stripe group
+            return
+        if tunnel is not conn:
+            dpids = tunnel.remove(conn)
+            logging.info("Lost stripe %d to %s, moving its %d switches" % (conn.stripe_index, conn.address, len(dpids)))
+            if len(tunnel) > 0:
+                return
+            del self.stripe_groups[tunnel.address]
+            if tunnel not in self.connections:      # it was still settling
+                tunnel.settle.cancel()
+                return
+        packet_ins = self.packet_in_scheduler.take(tunnel)
+        self.packet_in_scheduler.on_disconnect(tunnel)
+        self.connections.remove(tunnel)
+        self.report_tunnel(tunnel, False)
+        if len(self.connections.tunnels) == 0:
+            logging.error("No available tunnel anymore, dropping packet_ins until one is back")
+        self.reroute_packet_ins(packet_ins)
+
+    # a lost tunnel is connected again with backoff, and so is one that could not be made
+    def retry_tunnel(self, factory, connector, failed=False):
+        if not factory.retry:
+            self.reconnector.stop(factory)
+            return
+        if failed:
+            delay = self.reconnector.failed(factory, connector.connect)
+        else:
+            delay = self.reconnector.lost(factory, connector.connect)
+        logging.info("Connecting to tunnel %s again in %.1f s" % (connector.getDestination(), delay))
+
+    # an ECHO_REPLY(3) on dpid 0 matching an unanswered echo request is a heartbeat of the tunnel,
+    # however late, the first one starts watching it. On a stripe it may pass a barrier of its group instead
+    def echo_reply(self, conn, xid):
+        if conn.tunnel is not conn and conn.tunnel is not None and conn.tunnel.barrier_passed(xid, self.ofmsg_generator(0, 0)):
+            return
+        sent = conn.echoes.pop(xid, None)
+        if sent is None:
+            logging.debug("Unexpected echo reply xid:%d" % xid)
+            return
+        now = time.time()
+        if conn not in self.failure_detector:
+            self.failure_detector.add(conn, sent, ramp=conn.reconnected and conn.tunnel is conn)
+        self.failure_detector.heartbeat(conn, now, now - sent)
+
+    def start_liveness_check(self):
+        self.liveness_check = task.LoopingCall(self.check_liveness)
+        self.liveness_check.start(self.LIVENESS_CHECK_INTERVAL, now=False)
+
+    # a suspected tunnel hands its unanswered packet_ins to the others, a dead one is closed and
+    # connected again. The stripes of a group are only closed, their switches move to the others
+    def check_liveness(self):
+        suspected, dead, recovered = self.failure_detector.check(time.time())
+        for conn in suspected:
+            logging.warning("Tunnel %s suspected, phi %.1f" % (conn.address, self.failure_detector.phi(conn, time.time())))
+            if conn.tunnel is conn:
+                self.reroute_packet_ins(self.packet_in_scheduler.take(conn))
+        for conn in dead:
+            logging.error("Tunnel %s not answering, closing it" % conn.address)
+            conn.transport.abortConnection()
+        for conn in recovered:
+            logging.warning("Tunnel %s answering again" % conn.address)
+
+    # the packet_ins a tunnel did not answer go to the other tunnels
+    def reroute_packet_ins(self, packet_ins):
+        for dpid, packet_in in packet_ins:
+            if self.connections.connection(dpid) is not None:
+                self.send_packet_in(dpid, packet_in)
+        if packet_ins:
+            logging.warning("Rerouted %d packet_ins" % len(packet_ins))
+
+    # tunnels watched, suspected and reintegrated, and the reconnections
+    def liveness_metrics(self):
+        metrics = self.failure_detector.metrics(time.time())
+        metrics["reconnect"] = self.reconnector.metrics()
+        return metrics
+
+    # a worker tells its supervisor, which keeps the tunnel membership of all workers
+    def report_tunnel(self, conn, up):
+        if self.supervisor is not None:
+            self.supervisor.send({"tunnel": {"address": conn.address, "up": up}})
+
+    # a tunnel crossed its high watermark: stop reading from every switch until it drains
+    def tunnel_congested(self, tunnel):
+        self.congested_tunnels.add(tunnel)
+        logging.warning("Tunnel congested %s, pausing %d switches" % (tunnel.flow_control.metrics(), len(self.connections.switches)))
+        if len(self.congested_tunnels) == 1:
+            for switch in self.connections.switches:
+                switch.transport.pauseProducing()
+
+    def tunnel_drained(self, tunnel):
+        self.congested_tunnels.discard(tunnel)
+        logging.warning("Tunnel drained %s" % tunnel.flow_control.metrics())
+        if len(self.congested_tunnels) == 0:
+            for switch in self.connections.switches:
+                switch.transport.resumeProducing()
+
+    def tunnel_metrics(self):
+        return [tunnel.flow_control.metrics() for tunnel in self.connections.tunnels]
+
     #
     # def xid_2_tunnel(self, dpid,  xid, remove=True):
     #     if dpid in self.xid2tun and xid in self.xid2tun[dpid]:    # REMOVE=TRUE: the packet is a reply packet from the switch
@@ -177,58 +403,190 @@ class OpenFlowService():
     #         return tunnel
     #     return None
 
-    def reply_2_tunnel(self, dpid, type, xid):
-        mykey = "%s-%s-%s" % (dpid, type, xid)
-        if mykey not in self.reply_keeper:
-            logging.debug("Key not in keeper %s"%mykey)
-            return None
-        pool = self.reply_keeper[mykey]
-        if len(pool) == 0:
-            logging.debug("Pool == 0")
+    # the tunnel waiting for this reply, it keeps waiting while more parts of a multipart reply follow.
+    # None if there is none or it is gone
+    def reply_2_tunnel(self, dpid, type, xid, more=False):
+        tunnel = self.reply_keeper.pop(dpid, type, xid, more)
+        if tunnel is None:
+            logging.debug("Key not in keeper %s-%s-%s" % (dpid, type, xid))
+        elif tunnel not in self.connections:
+            logging.info("Dropping the reply type:%d xid:%d, its tunnel is gone" % (type + 1, xid))
             return None
-        rep = pool[0]
-        pool.remove(rep)
-        logging.debug("Removing a connection in keeper[%s], remaining %d"%(mykey,len(pool)))
-        return rep
+        return tunnel
 
 
+    # writes are buffered per connection and leave with one writeSequence per reactor iteration
     def write_tunnel(self, dpid, msg, tunnel_conn):
-        header = struct.pack(">QH", dpid, len(msg))
-        fmsg = header + msg
-        tunnel_conn.transport.write(fmsg)
+        tunnel_conn.writer.write_tunnel(dpid, msg)
         logging.debug("Writing a msg to tunnel %d"%dpid)
 
+    def broadcast_tunnel(self, dpid, msg):
+        header = TUNNEL_HEADER.pack(dpid, len(msg))
+        for tunnel in self.connections.tunnels:
+            tunnel.writer.write_tunnel(dpid, msg, header)
+        logging.debug("Broadcasting a msg to %d tunnels %d"%(len(self.connections.tunnels), dpid))
+
     def write_switch(self, msg, switch_conn):
-        switch_conn.transport.write(msg)
+        switch_conn.writer.write(msg)
         logging.debug("Writing a msg to switch")
 
-    def scheduling(self):
-        tunnel_num = len(self.tunnels)
-        self.rr = (self.rr+1)%tunnel_num
-        logging.info("Packet_in msg: switch==>tunnel%d" % self.rr)
-        return self.tunnels[0]
+    # the active policy of packet_in_scheduler picks the tunnel of a packet_in: round_robin,
+    # weighted_round_robin, random, least_outstanding (default), latency or flow_hash.
+    # Suspected tunnels are left out, reintegrated ones get a growing share. None if there is no tunnel
+    def scheduling(self, dpid, packet_in):
+        candidates = self.failure_detector.available(self.connections.tunnels, time.time())
+        tunnel = self.packet_in_scheduler.select(dpid, packet_in, candidates)
+        if tunnel is None:
+            return None
+        self.packet_in_scheduler.on_request(dpid, packet_in, tunnel)
+        logging.debug("Packet_in msg: switch==>tunnel %s" % tunnel.address)
+        return tunnel
+
+    # switch the scheduling policy at runtime, without a restart
+    def set_scheduling_policy(self, name, config=None):
+        return self.packet_in_scheduler.set_policy(name, config)
+
+    # the policy file as read by the supervisor
+    def apply_policy_config(self, config):
+        self.packet_in_scheduler.apply_config(config)
+
+    def start_policy_watch(self):
+        self.packet_in_scheduler.policy_file = self.SCHEDULING_POLICY_FILE
+        self.policy_watch = task.LoopingCall(self.packet_in_scheduler.check_policy_file)
+        self.policy_watch.start(self.POLICY_CHECK_INTERVAL)
+
+    # a packet_in admitted by packet_in_admission, possibly after being deferred
+    # the first packet_in of a flow opens a pending flow holding its duplicates
+    def forward_packet_in(self, dpid, xid, msg, flow=None):
+        if not self.send_packet_in(dpid, PacketIn(msg, xid)):
+            return
+        if flow is not None:
+            self.pending_flows.add(flow, xid, msg, time.time())
+        if self.DECISION_CACHE:
+            self.decision_cache.expect(dpid, msg, time.time())
+
+    # False if there is no tunnel to take it
+    def send_packet_in(self, dpid, packet_in):
+        tunnel = self.scheduling(dpid, packet_in)
+        if tunnel is None:
+            logging.error("No tunnel for packet_in of dpid:%d" % dpid)
+            self.unscheduled += 1
+            return False
+        self.write_tunnel(dpid, packet_in.msg, tunnel)
+        return True
+
+    # a packet_in hitting the decision cache is answered here, without a controller round trip
+    def install_cached_decision(self, dpid, xid, msg, switch_conn):
+        decision = self.decision_cache.lookup(dpid, xid, msg, time.time())
+        if decision is None:
+            return False
+        flow_mod, unbuffered = decision
+        self.write_switch(flow_mod, switch_conn)
+        if unbuffered:      # the packet itself goes through the flow just installed
+            self.write_switch(reinject_msg(msg, xid), switch_conn)
+        return True
+
+    # the flow setup was answered: the held packets go through the switch's flow table again
+    def release_pending_flow(self, dpid, type, msg, switch_conn):
+        for held_xid, held in self.pending_flows.on_response(dpid, type, msg):
+            self.write_switch(reinject_msg(held, held_xid), switch_conn)
+
+    # pending flows not answered in time hand their held packet_ins to the controller
+    def expire_pending_flows(self):
+        for dpid, xid, msg in self.pending_flows.expire(time.time()):
+            self.packet_in_admission.admit(dpid, self.forward_packet_in, dpid, xid, msg)
+
+    def start_pending_flow_expiry(self):
+        self.pending_flow_expiry = task.LoopingCall(self.expire_pending_flows)
+        self.pending_flow_expiry.start(self.PENDING_FLOW_TIMEOUT / 2, now=False)
+
+    # packet_ins admitted, dropped and deferred by the token buckets, held by the pending flows
+    def packet_in_metrics(self):
+        metrics = self.packet_in_admission.metrics()
+        metrics["pending_flows"] = self.pending_flows.metrics()
+        metrics["decision_cache"] = self.decision_cache.metrics()
+        metrics["unscheduled"] = self.unscheduled
+        return metrics
+
+    # an equivalent request is either waiting for the switch, answered from the cache, or sent
+    def coalesce_multipart_request(self, dpid, xid, msg, tunnel, switch_conn):
+        request, replies = self.multipart_coalescer.request(dpid, xid, msg, tunnel)
+        if request is not None:
+            self.write_switch(request, switch_conn)
+        elif replies is not None:
+            for reply in replies:
+                self.write_tunnel(dpid, reply, tunnel)
+
+    # the parts of a coalesced MULTIPART_REPLY(19) go to every tunnel still connected, False if not coalesced
+    def fan_out_multipart_reply(self, dpid, xid, msg):
+        replies = self.multipart_coalescer.reply(dpid, xid, msg)
+        if replies is None:
+            return False
+        for tunnel, reply in replies:
+            if tunnel in self.connections:
+                self.write_tunnel(dpid, reply, tunnel)
+        return True
+
+    # requests waiting for the switches' replies, and those never answered per type
+    def reply_metrics(self):
+        metrics = self.reply_keeper.metrics()
+        metrics["multipart"] = self.multipart_coalescer.metrics()
+        metrics["handshake"] = self.handshake_cache.metrics()
+        return metrics
+
+    # a batch holds every complete (dpid, msg) frame of one read from the tunnel
+    def handle_tunnel_openflow_batch(self, frames, conn):
+        for dpid, msg in frames:
+            self.handle_tunnel_openflow_msg(dpid, msg, conn)
+
+    # the proxy accepted our offer and sends v2 frames from now on, so do we after our own SWITCH
+    def handle_tunnel_control(self, control, conn):
+        exp_type, version = control
+        if exp_type == TUNNEL_SWITCH and version == TUNNEL_VERSION_2 and conn.writer.tunnel_version == TUNNEL_VERSION_1:
+            conn.writer.write_tunnel(0, tunnel_control_msg(TUNNEL_SWITCH, TUNNEL_VERSION_2))
+            conn.writer.set_tunnel_version(TUNNEL_VERSION_2)
+            logging.info("Tunnel switched to protocol version %d" % version)
+        else:
+            logging.debug("Ignoring tunnel control type:%d version:%d" % control)
 
-    def handle_tunnel_openflow_msg(self, msg, conn):
-        header = struct.unpack(">QH", msg[:10])
-        dpid = header[0]
-        msg = msg[10:]
+    def handle_tunnel_openflow_msg(self, dpid, msg, conn):
+        if dpid == 0:
+            control = parse_tunnel_control(msg)
+            if control is not None:
+                self.handle_tunnel_control(control, conn)
+                return
+            version, type, length, xid = struct.unpack(">bbHI", msg[:8])
+            if type == 3:
+                self.echo_reply(conn, xid)
+                return
+        conn = conn.tunnel      # replies go back through the stripe group, on the stripe of dpid
         openflow_header = struct.unpack(">bbHI", msg[:8])
         type = openflow_header[1]
         xid = openflow_header[3]
         logging.debug("Received a tunnel msg type:%d xid:%s" % (type, xid))
 
-        if dpid not in self.dpid2sw_dict:   # all the messages sent to the tunnels should has its own dpid
+        swi = self.connections.connection(dpid)
+        if swi is None:   # all the messages sent to the tunnels should has its own dpid, the switch may just have left
             logging.error("Unexpected Error in dpid to switch")
-            exit(1)
-        swi = self.dpid2sw_dict[dpid]
-        self.write_switch(str(msg), swi)
+            return
+        if (type == 5 or type == 18) and self.HANDSHAKE_CACHE:
+            replies = self.handshake_cache.answer(dpid, type, xid, msg)
+            if replies is not None:
+                for reply in replies:
+                    self.write_tunnel(dpid, reply, conn)
+                return
+        if type == 18 and self.MULTIPART_COALESCING and self.multipart_coalescer.coalescible(msg):
+            self.coalesce_multipart_request(dpid, xid, msg, conn, swi)
+            return
+        self.write_switch(msg, swi)
+        if type == 13 or type == 14:    # PACKET_OUT/FLOW_MOD answers a packet_in scheduled to this tunnel
+            self.packet_in_scheduler.on_response(dpid, type, msg, conn)
+            self.release_pending_flow(dpid, type, msg, swi)
+            if self.DECISION_CACHE:
+                self.decision_cache.on_response(dpid, type, msg, time.time())
 
         if type not in self.TUNNEL_IGNORE_TYPES:
-            mykey = "%s-%s-%s"%(dpid, type, xid)
-            if mykey not in self.reply_keeper:
-                self.reply_keeper[mykey] = []
-            self.reply_keeper[mykey].append(conn)
-            logging.debug("Writing a key:%s"%mykey)
+            self.reply_keeper.track(dpid, type, xid, conn)
         # if type not in self.TUNNEL_IGNORE_TYPES:  # write down the xid for the message because reply from switch is needed
         #     if dpid not in self.xid2tun:
         #         self.xid2tun[dpid] = {}
@@ -237,6 +595,11 @@ class OpenFlowService():
         # else:
         #     logging.debug("No need to save")
 
+    # a batch holds every complete message of one read from the switch
+    def handle_switch_openflow_batch(self, msgs, conn):
+        for msg in msgs:
+            self.handle_switch_openflow_msg(msg, conn)
+
     def handle_switch_openflow_msg(self, msg, conn):
         openflow_header = struct.unpack(">bbHI", msg[:8])
         type = openflow_header[1]
@@ -244,24 +607,19 @@ class OpenFlowService():
         length = openflow_header[2]
         logging.debug("Received Switch message: Type %d xid:%d length:%d"%(type,xid,length))
 
-        if len(self.tunnels) == 0:
-            logging.error("No tunnels")
-            reactor.stop()
-            exit(1)
-
         # scheduler sends HELLO(0) to switch and then sends FEATURE_REQUEST(5) to get switch datapath ID
         if type == 0:
-            self.write_switch(str(msg), conn)
+            self.write_switch(msg, conn)
             logging.debug("Scheduler sends hello message to switch")
             # scheduler sends a OFPT_REATURES_REQUEST(5) to switch to get its DPID
             msg = self.ofmsg_generator(5, 0)
-            self.write_switch(str(msg), conn)
+            self.write_switch(msg, conn)
             logging.debug("Scheduler sends feature_request to switch to obtain its DPID")
 
         # When ECHO_REQUEST(2) is received from switch, scheduler sends ECHO_REPLY(3) back to switch
         elif type == 2:
             reply_msg = self.ofmsg_generator(3, xid)
-            self.write_switch(str(reply_msg), conn)
+            self.write_switch(reply_msg, conn)
             logging.debug("Scheduler sends echo_reply to switch")
 
         # Different actions are taken which depend on whether the scheduler or the tunnel sends the FEATURE_REQUEST(5)
@@ -269,62 +627,79 @@ class OpenFlowService():
             # logging.debug("Switch sends feature_reply to scheduler")
             dpid = struct.unpack(">Q", msg[8:16])[0]
             # logging.debug("Got a DPID:%d" % dpid)
-            if dpid not in self.dpid2sw_dict:      # FEATURE_REQUEST(5) comes from scheduler, no need to reply to tunnel
-                self.dpid2sw_dict[dpid] = conn
-                self.sw2dpid_dict[conn] = dpid
+            if self.connections.connection(dpid) is None:      # FEATURE_REQUEST(5) comes from scheduler, no need to reply to tunnel
+                self.connections.bind_dpid(conn, dpid)
                 logging.debug("Got switch DPID:%s" % dpid)
+                if self.HANDSHAKE_CACHE:    # fetch what every controller will ask for
+                    self.handshake_cache.learn_features(dpid, msg)
+                    for request in self.handshake_cache.warm_up(dpid):
+                        self.write_switch(request, conn)
                 # role = 2
                 # generation_id = 0
                 # padding = 0
                 # role_reply = struct.pack(">IIQ", role, padding, generation_id)
                 # reply_msg = self.ofmsg_generator(24, 0, role_reply)
-                # conn.transport.write(str(reply_msg))
+                # conn.transport.write(reply_msg)
                 # logging.debug("Send Role_request to switch")
                 lmsg = self.ofmsg_generator(0, 0)   # scheduler sends Hello to all tunnels
-                for tunnel in self.tunnels:
-                    self.write_tunnel(dpid, lmsg, tunnel)
-                    logging.info("Switch==>Tunnel: Hello")
+                self.broadcast_tunnel(dpid, lmsg)
+                logging.info("Switch==>Tunnel: Hello")
             else:   # FEATURE_REQUEST(5) comes from tunnel, reply to tunnel according to its xid
+                if self.HANDSHAKE_CACHE:
+                    self.handshake_cache.learn_features(dpid, msg)
                 tunnel = self.reply_2_tunnel(dpid, type-1, xid)
                 if tunnel is None:
                     logging.error("Tunnel Not supposed to be None when sending type 6")
-                    exit(1)
-                self.write_tunnel(dpid, str(msg), tunnel)
+                    return
+                self.write_tunnel(dpid, msg, tunnel)
 
         elif type == 19:   # Equal or more than one MULTIPART_REPLY(19) are sent from the switch
-            dpid = self.sw2dpid_dict[conn]
-            tunnel = self.reply_2_tunnel(dpid, type - 1, xid)
+            dpid = self.connections.dpid(conn)
+            if self.HANDSHAKE_CACHE and self.handshake_cache.on_reply(dpid, xid, msg):  # answers our own warm-up
+                return
+            if self.fan_out_multipart_reply(dpid, xid, msg):
+                return
+            more = struct.unpack(">HH", msg[8:12])[1] & 1 == 1     # OFPMPF_REPLY_MORE
+            tunnel = self.reply_2_tunnel(dpid, type - 1, xid, more)
             if tunnel is None:
                 logging.error("Tunnel Not Found! ")
-                exit(1)
-            self.write_tunnel(dpid, str(msg), tunnel)
+                return
+            self.write_tunnel(dpid, msg, tunnel)
 
         elif type == 10:  # Packet_in(10) message should be sent to the tunnel according to the scheduling algorithm
             logging.debug("Switch sends packet_in to scheduler")
-            tunnel = self.scheduling()
-            dpid = self.sw2dpid_dict[conn]
-            self.write_tunnel(dpid, str(msg), tunnel)
+            dpid = self.connections.dpid(conn)
+            if self.DECISION_CACHE and self.install_cached_decision(dpid, xid, msg, conn):
+                return
+            flow = self.pending_flows.flow(dpid, msg)
+            if flow is None or not self.pending_flows.absorb(flow, xid, msg):
+                self.packet_in_admission.admit(dpid, self.forward_packet_in, dpid, xid, msg, flow)
 
         # elif type == 25:
         #     logging.debug("Role_reply dump!!!!!!!!!!!!!!!!!!!")
 
         else:
-            dpid = self.sw2dpid_dict[conn]
+            dpid = self.connections.dpid(conn)
             if type in self.SWITCH_REPLY_TYPES:        # Sent back the reply message to the tunnel according to its xid and delete the item from the dictionary
                 tunnel = self.reply_2_tunnel(dpid, type - 1, xid)
                 if tunnel is None:
                     logging.error("Tunnel Not Found! ")
-                    exit(1)
-                self.write_tunnel(dpid, str(msg), tunnel)
+                    return
+                self.write_tunnel(dpid, msg, tunnel)
             else:
+                if type == 1 and self.HANDSHAKE_CACHE and self.handshake_cache.on_error(dpid, xid):     # fails our own warm-up
+                    return
+                if type == 12 and self.DECISION_CACHE:     # PORT_STATUS, the decisions may name a port that changed
+                    self.decision_cache.invalidate(dpid)
+                if type == 12 and self.HANDSHAKE_CACHE:
+                    self.handshake_cache.on_port_status(dpid, msg)
                 logging.info("Broadcasting!!! Type: %d" % type)   # The message is initialized by switch and is sent to all tunnels
-                for tunnel1 in self.tunnels:
-                    self.write_tunnel(dpid, str(msg), tunnel1)
+                self.broadcast_tunnel(dpid, msg)
 
     def getOpenFlowServerFactory(self):
         f = ServerFactory()
         f.protocol = OpenFlowProxyServerProtocol
-        f.handle_switch_openflow_msg = self.handle_switch_openflow_msg
+        f.handle_switch_openflow_batch = self.handle_switch_openflow_batch
         f.add_switchConnection = self.add_switchConnection
         f.remove_switchConnection = self.remove_switchConnection
         return f
@@ -333,16 +708,46 @@ class OpenFlowService():
         f = ClientFactory()
         f.protocol = OpenFlowClientProtocol
         f.add_tunnelConnection = self.add_tunnelConnection
-        f.handle_tunnel_openflow_msg = self.handle_tunnel_openflow_msg
+        f.handle_tunnel_openflow_batch = self.handle_tunnel_openflow_batch
         f.remove_tunnelConnection = self.remove_tunnelConnection
+        f.ofmsg_generator = self.ofmsg_generator
+        f.echo_interval = self.ECHO_INTERVAL
+        f.max_echoes = self.MAX_ECHOES
+        f.retry = True
+        f.clientConnectionLost = lambda connector, reason: self.retry_tunnel(f, connector)
+        f.clientConnectionFailed = lambda connector, reason: self.retry_tunnel(f, connector, True)
         return f
 
 # tunnel_IPS= ["10.0.3.254"]
 tunnel_IPS= ["10.0.3.7","10.0.3.254"]
-s = OpenFlowService()
-reactor.listenTCP(6633, s.getOpenFlowServerFactory())
-clientF = s.getOpenFlowClientFactory()
-for ip in tunnel_IPS:
-    reactor.connectTCP(ip, 9999, clientF)
-logging.info("Start running server")
-reactor.run()
+tunnel_RINGS = []      # Unix socket paths of proxies on this host, tunnels over shared-memory rings instead of TCP
+
+
+# listen for switches and open the tunnels, in this process or a worker; the caller runs the reactor
+def start_scheduler(s, port=6633, tunnel_ips=tunnel_IPS, tunnel_rings=tunnel_RINGS, tunnel_port=9999):
+    if worker_index() is not None:
+        s.supervisor = start_worker_channel({"policy": s.apply_policy_config})
+        reuseport_listen(port, s.getOpenFlowServerFactory())
+    else:
+        s.start_policy_watch()
+        reactor.listenTCP(port, s.getOpenFlowServerFactory())
+    s.start_pending_flow_expiry()
+    s.start_liveness_check()
+    for ip in tunnel_ips:      # a factory per tunnel, for its reconnections
+        for stripe in range(s.TUNNEL_STRIPES):
+            reactor.connectTCP(ip, tunnel_port, s.getOpenFlowClientFactory())
+    for path in tunnel_rings:
+        for stripe in range(s.TUNNEL_STRIPES):
+            connect_ring(path, s.getOpenFlowClientFactory())
+
+
+if __name__ == "__main__":
+    s = OpenFlowService()
+    if s.WORKERS > 1 and worker_index() is None:     # the supervisor only starts and watches the workers
+        supervisor = WorkerSupervisor(sys.argv[0], s.WORKERS, s.SCHEDULING_POLICY_FILE, s.POLICY_CHECK_INTERVAL)
+        supervisor.start()
+        logging.info("Start running %d scheduler workers" % s.WORKERS)
+    else:
+        start_scheduler(s)
+        logging.info("Start running server")
+    reactor.run()
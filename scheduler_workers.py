@@ -0,0 +1,217 @@
+from twisted.internet.protocol import ProcessProtocol
+from twisted.protocols.basic import LineOnlyReceiver
+from twisted.internet import reactor
+from twisted.internet import stdio
+from twisted.internet import task
+from twisted.internet.error import ReactorNotRunning
+
+import json
+import logging
+import os
+import socket
+import sys
+
+from packet_in_scheduler import read_policy_file
+
+'''
+Several scheduler processes sharing the switch port
+
+A supervisor starts WORKERS copies of the scheduler script with WORKER_ARG. Each worker
+listens on the switch port through its own SO_REUSEPORT socket, so the kernel spreads
+the switch connections over the workers, and connects to every tunnel itself: a switch
+and everything about it (dpid, pending requests, caches) lives in one worker. A worker
+that exits is started again after `respawn_delay` seconds.
+
+The supervisor and a worker talk over a control channel of JSON lines, the worker's
+stdin one way and its file descriptor 3 the other:
+    supervisor -> worker    {"policy": config}              the policy file changed
+    worker -> supervisor    {"tunnel": {"address": address, "up": bool}}   a tunnel (dis)connected
+The supervisor is the only reader of the policy file, and keeps which workers are
+connected to each tunnel for its metrics. A worker whose supervisor is gone stops.
+'''
+
+WORKER_ARG = "--worker"
+CHANNEL_FD = 3
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)     # missing from Python 2's socket module on Linux
+
+
+# listen on port through a socket shared with the other workers
+def reuseport_listen(port, factory, interface='', backlog=50):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    listening = reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()    # the reactor has its own copy of the descriptor
+    return listening
+
+
+# the index of this worker, None if the process was not started by a supervisor
+def worker_index(argv=None):
+    argv = sys.argv if argv is None else argv
+    if WORKER_ARG not in argv:
+        return None
+    return int(argv[argv.index(WORKER_ARG) + 1])
+
+
+class ControlChannel(LineOnlyReceiver):
+    delimiter = b'\n'
+    MAX_LENGTH = 1048576
+
+    def __init__(self, handlers, lost=None):
+        self.handlers = handlers    # handlers = { message key: callable(value) }
+        self.lost = lost
+
+    def lineReceived(self, line):
+        try:
+            message = json.loads(line)
+        except ValueError:
+            logging.error("Bad control message %r" % line[:64])
+            return
+        for key, value in message.items():
+            handler = self.handlers.get(key)
+            if handler is not None:
+                handler(value)
+
+    def send(self, message):
+        self.transport.write(json.dumps(message).encode() + self.delimiter)
+
+    def connectionLost(self, reason):
+        if self.lost is not None:
+            self.lost()
+
+
+# the worker's end of the control channel
+def start_worker_channel(handlers):
+    channel = ControlChannel(handlers, lost=supervisor_lost)
+    stdio.StandardIO(channel, stdin=0, stdout=CHANNEL_FD)
+    return channel
+
+
+def supervisor_lost():
+    logging.error("Supervisor gone, stopping the worker")
+    try:
+        reactor.stop()
+    except ReactorNotRunning:   # already stopping, e.g. on SIGTERM
+        pass
+
+
+class WorkerProcess(ProcessProtocol):
+
+    def __init__(self, supervisor, index):
+        self.supervisor = supervisor
+        self.index = index
+        self.channel = ControlChannel({"tunnel": self.tunnel_changed})
+
+    def connectionMade(self):
+        self.channel.makeConnection(ChildStdin(self.transport))
+        self.supervisor.worker_started(self)
+
+    def childDataReceived(self, fd, data):
+        if fd == CHANNEL_FD:
+            self.channel.dataReceived(data)
+
+    def tunnel_changed(self, tunnel):
+        self.supervisor.tunnel_changed(self, tunnel["address"], tunnel["up"])
+
+    def send(self, message):
+        self.channel.send(message)
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+
+# the transport the control channel writes to: the worker's stdin
+class ChildStdin(object):
+    disconnecting = False
+
+    def __init__(self, process_transport):
+        self.process_transport = process_transport
+
+    def write(self, data):
+        self.process_transport.writeToChild(0, data)
+
+    def writeSequence(self, data):
+        self.write(b''.join(data))
+
+    def loseConnection(self):
+        self.process_transport.closeChildFD(0)
+
+
+class WorkerSupervisor(object):
+
+    def __init__(self, script, workers, policy_file=None, check_interval=1.0, respawn_delay=1.0):
+        self.script = script
+        self.count = workers
+        self.policy_file = policy_file
+        self.policy_file_mtime = None
+        self.policy_config = None
+        self.check_interval = check_interval
+        self.respawn_delay = respawn_delay
+        self.workers = {}           # workers = { index: WorkerProcess }
+        self.tunnels = {}           # tunnels = { tunnel address: set of worker indexes connected to it }
+        self.stopping = False
+        self.respawns = 0
+
+    def start(self):
+        for index in range(self.count):
+            self.spawn(index)
+        if self.policy_file is not None:
+            self.policy_watch = task.LoopingCall(self.check_policy_file)
+            self.policy_watch.start(self.check_interval)
+        reactor.addSystemEventTrigger("before", "shutdown", self.stop)
+
+    def spawn(self, index):
+        if self.stopping:
+            return
+        worker = WorkerProcess(self, index)
+        args = [sys.executable, self.script, WORKER_ARG, str(index)]
+        reactor.spawnProcess(worker, sys.executable, args, env=os.environ,
+                             childFDs={0: "w", 1: 1, 2: 2, CHANNEL_FD: "r"})
+        logging.info("Started scheduler worker %d" % index)
+
+    def worker_started(self, worker):
+        self.workers[worker.index] = worker
+        if self.policy_config is not None:
+            worker.send({"policy": self.policy_config})
+
+    def worker_ended(self, worker, reason):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+        for address in list(self.tunnels):
+            self.tunnels[address].discard(worker.index)
+        if not self.stopping:
+            logging.warning("Scheduler worker %d ended: %s" % (worker.index, reason.getErrorMessage()))
+            self.respawns += 1
+            reactor.callLater(self.respawn_delay, self.spawn, worker.index)
+
+    def tunnel_changed(self, worker, address, up):
+        workers = self.tunnels.setdefault(address, set())
+        if up:
+            workers.add(worker.index)
+        else:
+            workers.discard(worker.index)
+
+    # { tunnel address: number of workers connected to it }
+    def membership(self):
+        return dict((address, len(workers)) for address, workers in self.tunnels.items())
+
+    def broadcast(self, message):
+        for worker in self.workers.values():
+            worker.send(message)
+
+    def check_policy_file(self):
+        self.policy_file_mtime, config = read_policy_file(self.policy_file, self.policy_file_mtime)
+        if config is not None:
+            self.policy_config = config
+            self.broadcast({"policy": config})
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers.values():   # a worker stops once its control channel is closed
+            worker.transport.closeChildFD(0)
+
+    def metrics(self):
+        return {"workers": len(self.workers), "respawns": self.respawns, "tunnels": self.membership()}
@@ -0,0 +1,496 @@
+from zope.interface import implementer
+from twisted.internet.interfaces import ITransport, IConsumer, IPushProducer
+from twisted.internet.protocol import Protocol
+from twisted.internet.protocol import ClientFactory
+from twisted.internet import reactor
+
+from collections import deque
+import errno
+import itertools
+import logging
+import mmap
+import os
+import platform
+import struct
+import socket
+import tempfile
+
+'''
+Shared-memory tunnel between a scheduler and a proxy on the same host
+
+Each direction is a single-producer/single-consumer byte ring in a memory-mapped file,
+so the tunnel bytes (the usual >QH or v2 framed records) are copied into the ring by one
+process and out of it by the other, never through the kernel. A Unix domain socket
+between the two carries the rest:
+    - the connecting side creates both rings and sends their paths in one line, the
+      listening side maps them and unlinks the files
+    - after that, a byte on the socket is a doorbell: "the ring you read has data, or the
+      ring you write has room". A writer rings after every writeSequence (once per
+      CoalescingWriter flush) with a send of its own, so the doorbell does not wait
+      for the reactor's next write
+    - the socket closing is the tunnel closing
+A writer keeps what does not fit in the ring and sets the ring's waiting flag, which the
+reader answers with a doorbell once it made room. In case that doorbell is lost (the two
+processes update the flag and the counters without a lock), the writer also retries
+every `retry_interval` seconds while it has a backlog.
+
+The counters are plain stores with no fences: a reader that sees a new head must also see
+the bytes written before it, which x86 guarantees (stores are not reordered with other
+stores) and weaker memory models such as ARM's do not, so rings are refused there.
+
+The files are unlinked as soon as the listening side has mapped them. Those of a process
+that died before that are removed by the next process on the host to use rings, once when
+it starts them (start_rings), not on every connection.
+
+Each tunnel maps two rings of `capacity` bytes, 2 MiB with the default RING_CAPACITY, on
+both sides. A writer holding more than fits keeps the rest, so a smaller capacity costs
+doorbells, not messages.
+
+listen_ring and connect_ring take the factories given to listenTCP and connectTCP; the
+tunnel protocols get a RingTransport, which has the parts of a TCP transport they use
+(writes, producers, getPeer().host being the socket path).
+'''
+
+RING_MAGIC = 0x4f46524e     # "OFRN"
+RING_INFO = struct.Struct("=IIQ")   # magic, unused, capacity
+COUNTER = struct.Struct("=Q")
+HEAD = 64           # bytes ever written, only the producer stores it
+TAIL = 128          # bytes ever read, only the consumer stores it
+WAITING = 192       # 1 while the producer holds bytes the ring had no room for
+DATA = 256          # the counters have a cache line each, the data follows
+RING_CAPACITY = 1 << 20
+RING_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+RING_PREFIX = "openflow_ring_"
+RING_MACHINES = ("x86_64", "amd64", "x86", "i386", "i486", "i586", "i686")     # total store order
+DOORBELL = b'\x01'
+HANDSHAKE_MAX = 4096
+
+ring_names = itertools.count(1)
+rings_started = False
+
+
+# a path for a new ring of this process
+def ring_path(suffix):
+    return os.path.join(RING_DIR, "%s%d_%d.%s" % (RING_PREFIX, os.getpid(), next(ring_names), suffix))
+
+
+# rings rely on x86 store ordering, see above
+def check_ring_platform():
+    machine = platform.machine().lower()
+    if machine not in RING_MACHINES:
+        raise RuntimeError("Shared-memory ring tunnels need x86 store ordering, not available on %s" % machine)
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
+# ring files whose creator is gone, left by a crash before the peer mapped them
+def remove_stale_rings():
+    for name in os.listdir(RING_DIR):
+        if not name.startswith(RING_PREFIX):
+            continue
+        try:
+            pid = int(name[len(RING_PREFIX):].split("_", 1)[0])
+        except ValueError:
+            continue
+        if pid != os.getpid() and not process_alive(pid):
+            try:
+                os.unlink(os.path.join(RING_DIR, name))
+                logging.info("Removed stale ring %s" % name)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    logging.warning("Unable to remove stale ring %s: %s" % (name, e))
+
+
+# the first ring tunnel of this process: refuse the platform, or remove what dead processes left
+def start_rings():
+    global rings_started
+    if rings_started:
+        return
+    check_ring_platform()
+    remove_stale_rings()
+    rings_started = True
+
+
+class ShmRing(object):
+
+    def __init__(self, path, create=False, capacity=RING_CAPACITY):
+        self.path = path
+        self.closed = False
+        if create:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+        else:
+            fd = os.open(path, os.O_RDWR)
+        try:
+            if create:
+                os.ftruncate(fd, DATA + capacity)
+            self.map = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        if create:
+            RING_INFO.pack_into(self.map, 0, RING_MAGIC, 0, capacity)
+        magic, unused, self.capacity = RING_INFO.unpack_from(self.map, 0)
+        if magic != RING_MAGIC or DATA + self.capacity > len(self.map):
+            self.map.close()
+            raise ValueError("%s is not a ring" % path)
+
+    def load(self, offset):
+        return COUNTER.unpack_from(self.map, offset)[0]
+
+    # bytes waiting to be read
+    def __len__(self):
+        return self.load(HEAD) - self.load(TAIL)
+
+    # the number of bytes of data written, as many as there was room for
+    def write(self, data):
+        head = self.load(HEAD)
+        count = min(len(data), self.capacity - (head - self.load(TAIL)))
+        if count <= 0:
+            return 0
+        start = head % self.capacity
+        first = min(count, self.capacity - start)
+        self.map[DATA + start:DATA + start + first] = data[:first]
+        if count > first:
+            self.map[DATA:DATA + count - first] = data[first:count]
+        COUNTER.pack_into(self.map, HEAD, head + count)
+        return count
+
+    # everything written so far
+    def read(self):
+        tail = self.load(TAIL)
+        count = self.load(HEAD) - tail
+        if count == 0:
+            return b''
+        start = tail % self.capacity
+        first = min(count, self.capacity - start)
+        data = self.map[DATA + start:DATA + start + first]
+        if count > first:
+            data += self.map[DATA:DATA + count - first]
+        COUNTER.pack_into(self.map, TAIL, tail + count)
+        return data
+
+    def set_waiting(self):
+        COUNTER.pack_into(self.map, WAITING, 1)
+
+    # True if the producer was waiting for room, the flag is cleared
+    def take_waiting(self):
+        if self.load(WAITING) == 0:
+            return False
+        COUNTER.pack_into(self.map, WAITING, 0)
+        return True
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.map.close()
+
+    # the mapping stays valid, in this process and the peer's
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class RingAddress(object):
+    type = "RING"
+    port = 0
+
+    def __init__(self, path):
+        self.host = path
+        self.name = path
+
+    def __eq__(self, other):
+        return isinstance(other, RingAddress) and other.host == self.host
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.host)
+
+    def __repr__(self):
+        return "RingAddress(%r)" % self.host
+
+
+@implementer(ITransport, IConsumer, IPushProducer)
+class RingTransport(object):
+
+    def __init__(self, channel, outbound, inbound, address, retry_interval=0.001, clock=None):
+        self.channel = channel      # the Unix socket: doorbells and the end of the tunnel
+        self.outbound = outbound
+        self.inbound = inbound
+        self.address = address
+        self.retry_interval = retry_interval
+        self.clock = clock or reactor
+        self.protocol = None
+        self.backlog = deque()      # what the outbound ring had no room for
+        self.backlog_bytes = 0
+        self.bufferSize = 65536     # a streaming producer is paused above this backlog
+        self.retry = None
+        self.producer = None
+        self.streaming = False
+        self.producer_paused = False
+        self.paused = False
+        self.connected = True
+        self.disconnecting = False
+        # metrics
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.doorbells = 0
+        self.ring_full = 0
+
+    def write(self, data):
+        self.writeSequence([data])
+
+    def writeSequence(self, chunks):
+        if not self.connected or self.disconnecting:
+            return
+        if self.backlog:
+            self.queue(chunks)
+            return
+        sent = 0
+        for index, chunk in enumerate(chunks):
+            count = self.outbound.write(chunk)
+            sent += count
+            if count < len(chunk):
+                self.queue([chunk[count:]] + list(chunks[index + 1:]))
+                break
+        if sent:
+            self.bytes_sent += sent
+            self.ring()
+
+    def queue(self, chunks):
+        if not self.backlog:
+            self.ring_full += 1
+        for chunk in chunks:
+            self.backlog.append(chunk)
+            self.backlog_bytes += len(chunk)
+        self.wait_for_room()
+        if self.streaming and not self.producer_paused and self.backlog_bytes > self.bufferSize:
+            self.producer_paused = True
+            self.producer.pauseProducing()
+
+    def wait_for_room(self):
+        self.outbound.set_waiting()
+        if self.retry is None:
+            self.retry = self.clock.callLater(self.retry_interval, self.drain)
+
+    # the reader made room: move the backlog into the ring
+    def drain(self):
+        if self.retry is not None:
+            if self.retry.active():
+                self.retry.cancel()
+            self.retry = None
+        if not self.connected:
+            return
+        sent = 0
+        while self.backlog:
+            chunk = self.backlog[0]
+            count = self.outbound.write(chunk)
+            sent += count
+            self.backlog_bytes -= count
+            if count < len(chunk):
+                self.backlog[0] = chunk[count:]
+                break
+            self.backlog.popleft()
+        if sent:
+            self.bytes_sent += sent
+            self.ring()
+        if self.backlog:
+            self.wait_for_room()
+        elif self.disconnecting:
+            self.channel.loseConnection()
+        elif self.producer is not None and (self.producer_paused or not self.streaming):
+            self.producer_paused = False
+            self.producer.resumeProducing()
+
+    # straight to the socket, not through the reactor's write buffer
+    def ring(self):
+        self.doorbells += 1
+        try:
+            self.channel.socket.send(DOORBELL)
+        except socket.error:    # full of doorbells the peer has yet to read, or closed
+            pass
+
+    # a doorbell from the peer
+    def doorbell(self):
+        if not self.paused:
+            self.receive()
+        if self.backlog:
+            self.drain()
+
+    def receive(self):
+        data = self.inbound.read()
+        if self.inbound.take_waiting():
+            self.ring()
+        if data:
+            self.bytes_received += len(data)
+            self.protocol.dataReceived(data)
+
+    def loseConnection(self):
+        if self.disconnecting:
+            return
+        self.disconnecting = True
+        if not self.backlog:
+            self.channel.loseConnection()
+
+    def abortConnection(self):
+        self.channel.abortConnection()
+
+    def connection_lost(self):
+        self.connected = False
+        if self.retry is not None and self.retry.active():
+            self.retry.cancel()
+        self.retry = None
+        self.backlog.clear()
+        self.backlog_bytes = 0
+        if self.producer is not None:
+            self.producer.stopProducing()
+
+    def getPeer(self):
+        return self.address
+
+    def getHost(self):
+        return self.address
+
+    # the tunnel protocols expect a TCP transport
+    def setTcpNoDelay(self, enabled):
+        pass
+
+    def setTcpKeepAlive(self, enabled):
+        pass
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        self.streaming = streaming
+        self.producer_paused = False
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.receive()
+
+    def stopProducing(self):
+        self.loseConnection()
+
+    def metrics(self):
+        return {"sent": self.bytes_sent, "received": self.bytes_received, "doorbells": self.doorbells,
+                "ring_full": self.ring_full, "backlog": self.backlog_bytes, "unread": len(self.outbound)}
+
+
+# the Unix socket of one ring tunnel, the tunnel protocol itself runs on a RingTransport
+class RingChannelProtocol(Protocol):
+
+    def __init__(self):
+        self.rings = []
+        self.ring_transport = None
+        self.wrapped = None
+        self.handshake = b''
+
+    def connectionMade(self):
+        if not self.factory.creates_rings:
+            return
+        outbound = ShmRing(ring_path("up"), create=True, capacity=self.factory.capacity)
+        self.rings.append(outbound)
+        inbound = ShmRing(ring_path("down"), create=True, capacity=self.factory.capacity)
+        self.rings.append(inbound)
+        self.transport.socket.send(("%s %s\n" % (outbound.path, inbound.path)).encode())   # before any doorbell
+        self.start(outbound, inbound)
+
+    def dataReceived(self, data):
+        if self.ring_transport is None:
+            self.handshake += data
+            if b'\n' not in self.handshake:
+                if len(self.handshake) > HANDSHAKE_MAX:
+                    self.transport.loseConnection()
+                return
+            line, data = self.handshake.split(b'\n', 1)
+            if not self.attach(line):
+                self.transport.loseConnection()
+                return
+            data = DOORBELL     # the peer may have written before we mapped the rings
+        if data:
+            self.ring_transport.doorbell()
+
+    # the listening side maps the rings the connecting side created
+    def attach(self, line):
+        try:
+            up, down = line.decode().split(" ")
+            for path in (up, down):
+                self.rings.append(ShmRing(path))
+        except (ValueError, EnvironmentError) as e:
+            logging.error("Bad ring tunnel handshake %r: %s" % (line[:64], e))
+            return False
+        for ring in self.rings:
+            ring.unlink()
+        self.start(self.rings[1], self.rings[0])
+        return True
+
+    def start(self, outbound, inbound):
+        self.ring_transport = RingTransport(self.transport, outbound, inbound, RingAddress(self.factory.path))
+        self.wrapped = self.factory.wrapped_factory.buildProtocol(self.ring_transport.address)
+        if self.wrapped is None:
+            self.transport.loseConnection()
+            return
+        self.ring_transport.protocol = self.wrapped
+        self.wrapped.makeConnection(self.ring_transport)
+
+    def connectionLost(self, reason):
+        if self.ring_transport is not None:
+            self.ring_transport.connection_lost()
+            if self.wrapped is not None:
+                self.wrapped.connectionLost(reason)
+        for ring in self.rings:
+            ring.close()
+            if self.factory.creates_rings:     # never attached by the peer
+                ring.unlink()
+
+
+class RingChannelFactory(ClientFactory):
+    protocol = RingChannelProtocol
+
+    def __init__(self, wrapped_factory, path, creates_rings, capacity=RING_CAPACITY):
+        self.wrapped_factory = wrapped_factory
+        self.path = path
+        self.creates_rings = creates_rings
+        self.capacity = capacity
+
+    def startFactory(self):
+        self.wrapped_factory.doStart()
+
+    def stopFactory(self):
+        self.wrapped_factory.doStop()
+
+    def clientConnectionFailed(self, connector, reason):
+        if hasattr(self.wrapped_factory, "clientConnectionFailed"):
+            self.wrapped_factory.clientConnectionFailed(connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if hasattr(self.wrapped_factory, "clientConnectionLost"):
+            self.wrapped_factory.clientConnectionLost(connector, reason)
+
+
+# listenTCP for ring tunnels: the peers connect to the Unix socket at path
+def listen_ring(path, factory, capacity=RING_CAPACITY):
+    start_rings()
+    if os.path.exists(path):    # left by a previous run
+        os.unlink(path)
+    return reactor.listenUNIX(path, RingChannelFactory(factory, path, False, capacity))
+
+
+# connectTCP for ring tunnels
+def connect_ring(path, factory, capacity=RING_CAPACITY):
+    start_rings()
+    return reactor.connectUNIX(path, RingChannelFactory(factory, path, True, capacity))
@@ -0,0 +1,156 @@
+import random
+
+'''
+Several parallel tunnels between a scheduler and one proxy, the switches spread over them
+
+A stripe group is `count` tunnel connections from a scheduler to the same proxy. To the
+rest of the scheduler the group is one tunnel: the packet_in policies, the reply table
+and the broadcasts all see the group. The group writes each message on the stripe of
+its dpid. The messages of one switch therefore keep their order, and a large multipart
+reply only delays the switches that share its stripe.
+
+A dpid gets stripe dpid % count, or the next live stripe after it, and keeps that
+stripe until the stripe dies. The dead stripe's dpids are then given out again the
+same way, over the stripes still alive. When a stripe comes back, rebalance() moves the
+dpids it would get back to it at a barrier: their writes are held, the scheduler sends
+an echo on the stripe they are leaving and once its reply is in, everything they sent
+before reached the proxy, barrier_passed() hands them to the stripe that came back and
+writes what was held there. No dpid has messages in flight on two stripes.
+
+Each stripe announces its group id, index and count to the proxy (tunnel_stripe_msg).
+When a stripe dies, the proxy moves the dpids it was answering on that stripe with the
+same pick_stripe.
+'''
+
+
+# the index of the stripe of dpid, None if all of them are dead
+def pick_stripe(dpid, stripes):
+    count = len(stripes)
+    for offset in range(count):
+        index = (dpid + offset) % count
+        if stripes[index] is not None:
+            return index
+    return None
+
+
+class StripeGroup(object):
+
+    def __init__(self, address, count, id=None):
+        self.address = address
+        self.count = count
+        self.id = random.getrandbits(32) if id is None else id
+        self.stripes = [None] * count   # stripes = [ tunnel connection, None while it is down ], by index
+        self.assigned = {}              # assigned = { dpid: stripe index }
+        self.stripe_dpids = [set() for index in range(count)]
+        self.moving = {}                # moving = { dpid: index of the stripe it moves to at its barrier }
+        self.held = {}                  # held = { moving dpid: [(msg, header)] written meanwhile }
+        self.barriers = {}              # barriers = { echo xid: (index of the stripe left, dpids leaving it) }
+        self.writer = self              # the scheduler writes to a group as to one tunnel
+        self.flow_control = self        # and reads its metrics the same way
+        self.moved = 0
+        self.rebalanced = 0
+
+    # the number of live stripes
+    def __len__(self):
+        return self.count - self.stripes.count(None)
+
+    # the index taken by conn, None if the group is full
+    def add(self, conn, index=None):
+        if index is None:
+            if None not in self.stripes:
+                return None
+            index = self.stripes.index(None)
+        elif index >= self.count or self.stripes[index] is not None:
+            return None
+        self.stripes[index] = conn
+        conn.stripe_index = index
+        return index
+
+    # the dpids of the dead stripe, they get a live stripe on their next message.
+    # Nothing is in flight on it anymore: the dpids leaving it move on right away
+    def remove(self, conn):
+        index = conn.stripe_index
+        if self.stripes[index] is not conn:
+            return set()
+        self.stripes[index] = None
+        for xid, (source, dpids) in list(self.barriers.items()):
+            if source == index:
+                self.barrier_passed(xid)
+        dpids = self.stripe_dpids[index]
+        self.stripe_dpids[index] = set()
+        for dpid in dpids:
+            del self.assigned[dpid]
+        self.moved += len(dpids)
+        return dpids
+
+    # the stripe connection of dpid, None if no stripe is alive
+    def stripe(self, dpid):
+        index = self.assigned.get(dpid)
+        if index is None:
+            index = pick_stripe(dpid, self.stripes)
+            if index is None:
+                return None
+            self.assigned[dpid] = index
+            self.stripe_dpids[index].add(dpid)
+        return self.stripes[index]
+
+    def forget(self, dpid):
+        index = self.assigned.pop(dpid, None)
+        if index is not None:
+            self.stripe_dpids[index].discard(dpid)
+        self.moving.pop(dpid, None)
+        self.held.pop(dpid, None)
+
+    # stripe index is back: the dpids it would get now start moving to it.
+    # Returns { index of a stripe they leave: dpids }, each needs a barrier on that stripe
+    def rebalance(self, index):
+        leaving = {}
+        for dpid, current in self.assigned.items():
+            if current != index and dpid not in self.moving and pick_stripe(dpid, self.stripes) == index:
+                self.moving[dpid] = index
+                self.held[dpid] = []
+                leaving.setdefault(current, set()).add(dpid)
+        return leaving
+
+    # the barrier echo xid was sent on stripe index for the dpids leaving it
+    def barrier(self, xid, index, dpids):
+        self.barriers[xid] = (index, dpids)
+
+    # the reply to the barrier echo xid is in: its dpids go to their new stripe, announce
+    # first if given, then what they wrote meanwhile. False if xid is no barrier
+    def barrier_passed(self, xid, announce=None):
+        barrier = self.barriers.pop(xid, None)
+        if barrier is None:
+            return False
+        source, dpids = barrier
+        for dpid in dpids:
+            target = self.moving.pop(dpid, None)
+            if target is None:      # forgotten meanwhile
+                continue
+            held = self.held.pop(dpid)
+            self.stripe_dpids[self.assigned.pop(dpid)].discard(dpid)
+            stripe = self.stripes[target] if self.stripes[target] is not None else self.stripe(dpid)
+            if stripe is None:
+                continue
+            self.assigned[dpid] = stripe.stripe_index
+            self.stripe_dpids[stripe.stripe_index].add(dpid)
+            self.rebalanced += 1
+            if announce is not None:
+                stripe.writer.write_tunnel(dpid, announce)
+            for msg, header in held:
+                stripe.writer.write_tunnel(dpid, msg, header)
+        return True
+
+    def write_tunnel(self, dpid, msg, header=None):
+        held = self.held.get(dpid)
+        if held is not None:
+            held.append((msg, header))
+            return
+        stripe = self.stripe(dpid)
+        if stripe is not None:
+            stripe.writer.write_tunnel(dpid, msg, header)
+
+    def metrics(self):
+        return {"address": self.address, "group": self.id, "moved": self.moved, "rebalanced": self.rebalanced,
+                "stripes": [None if stripe is None else dict(stripe.flow_control.metrics(), dpids=len(dpids))
+                            for stripe, dpids in zip(self.stripes, self.stripe_dpids)]}